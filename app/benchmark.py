@@ -0,0 +1,322 @@
+"""
+Benchmark hiệu năng các đường nóng trên dữ liệu tổng hợp (1k -> 1M dòng).
+
+Thành phần:
+- retrieval:  tìm top-k cho 1 câu truy vấn (naive = np.matmul + argsort như gpt.py ban đầu,
+              các loại index trong vector_index.py, và exact chia 4 shard search song song)
+- indexing:   thời gian build index; encoding (tuỳ chọn --encode) đo encoder thật
+- extraction: extract_final_answer trên output "Bước 1/2/3" tổng hợp
+- scoring:    evaluate_answer từng dòng và score_batch (compat / fast)
+
+Mỗi case báo latency p50/p95/p99, throughput (item/giây) và bộ nhớ đỉnh (tracemalloc,
+đo ở 1 lượt chạy riêng để không làm sai latency).
+
+    python app/benchmark.py --sizes 1000 10000 100000
+    python app/benchmark.py --save-baseline               # lưu results/benchmark_baseline.json
+    python app/benchmark.py --compare --threshold 0.2     # báo hồi quy > 20% so với baseline
+"""
+import argparse
+import json
+import platform
+import random
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+
+import scoring
+from extraction import Step3Parser, extract_final_answer
+from sharded_index import ShardedIndex, plan_shards
+from vector_index import INDEX_KINDS, build_index, topk_rows
+
+COMPONENTS = ("retrieval", "indexing", "extraction", "scoring", "encoding")
+DEFAULT_BASELINE = Path("results") / "benchmark_baseline.json"
+
+# Độ lệch nhỏ hơn các ngưỡng này coi là nhiễu đo, không tính hồi quy
+_MIN_P95_MS = 0.05
+_MIN_PEAK_MB = 1.0
+
+_SYLLABLES = (
+    "thủ đô việt nam là gì ai người năm nào ở đâu bao nhiêu sông núi hà nội huế "
+    "sài gòn chiến tranh độc lập văn học kinh tế lịch sử triều đại vua quan dân số "
+    "diện tích tỉnh thành phố quốc gia đầu tiên cuối cùng lớn nhất nhỏ nhất được gọi"
+).split()
+
+
+# --- Dữ liệu tổng hợp ---
+
+def synthetic_sentences(n, rng, min_len=6, max_len=20):
+    return [" ".join(rng.choices(_SYLLABLES, k=rng.randint(min_len, max_len))) for _ in range(n)]
+
+
+def synthetic_critiques(n, rng, pool_size=5000):
+    """Output self-critique tổng hợp (nhiều biến thể định dạng), lặp lại từ 1 pool để tiết kiệm RAM"""
+    templates = [
+        "**Bước 1: Câu trả lời ban đầu:**\n{a}\n\n**Bước 2: Tự phản biện:**\n{c}\n\n"
+        "**Bước 3: Câu trả lời cuối cùng (đã xác minh):**\n{f}",
+        "Bước 1: {a}\nBước 2: {c}\nBước 3: {f}",
+        "**Bước 1:** {a}\n\n**Bước 2:** {c}\n\nCâu trả lời cuối cùng: ** {f}",
+        "{a}\n\n{c}\n\n{f}",
+    ]
+    pool = []
+    for _ in range(min(n, pool_size)):
+        sent = synthetic_sentences(3, rng, 4, 60)
+        pool.append(rng.choice(templates).format(a=sent[0], c=sent[1], f=sent[2]))
+    return [pool[i % len(pool)] for i in range(n)]
+
+
+def synthetic_embeddings(n, dim, seed=0, n_topics=None, chunk=65536):
+    """Vector chuẩn hoá có cấu trúc cụm (giống embedding câu hỏi hơn là nhiễu đều)"""
+    rng = np.random.default_rng(seed)
+    n_topics = n_topics or max(8, int(np.sqrt(n)))
+    centers = rng.standard_normal((n_topics, dim)).astype(np.float32)
+    emb = np.empty((n, dim), dtype=np.float32)
+    for start in range(0, n, chunk):
+        stop = min(start + chunk, n)
+        topics = rng.integers(0, n_topics, stop - start)
+        block = centers[topics] + 0.8 * rng.standard_normal((stop - start, dim)).astype(np.float32)
+        block /= np.linalg.norm(block, axis=1, keepdims=True)
+        emb[start:stop] = block
+    return emb
+
+
+# --- Đo ---
+
+def summarize_latencies(latencies, items, total_seconds):
+    lat_ms = np.asarray(latencies) * 1000.0
+    return {
+        "ops": len(latencies),
+        "items": items,
+        "p50_ms": float(np.percentile(lat_ms, 50)),
+        "p95_ms": float(np.percentile(lat_ms, 95)),
+        "p99_ms": float(np.percentile(lat_ms, 99)),
+        "throughput": items / total_seconds if total_seconds > 0 else 0.0,
+        "seconds": total_seconds,
+    }
+
+
+def peak_memory_mb(op, args_list):
+    """Bộ nhớ đỉnh (MB) khi chạy lại op trên vài đầu vào, đo bằng tracemalloc"""
+    tracemalloc.start()
+    try:
+        for args in args_list:
+            op(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak / 1e6
+
+
+def run_case(op, args_list, items_per_op, warmup=1, memory_samples=3):
+    """
+    Chạy op(*args) cho từng args trong args_list, đo latency từng lần.
+    items_per_op: số item xử lý mỗi lần gọi (để tính throughput).
+    """
+    for args in args_list[:warmup]:
+        op(*args)
+    latencies = []
+    start = time.perf_counter()
+    for args in args_list:
+        t0 = time.perf_counter()
+        op(*args)
+        latencies.append(time.perf_counter() - t0)
+    total = time.perf_counter() - start
+    result = summarize_latencies(latencies, items_per_op * len(args_list), total)
+    result["peak_mb"] = peak_memory_mb(op, args_list[:memory_samples])
+    return result
+
+
+# --- Các thành phần ---
+
+def naive_search(emb, q_vec, topk):
+    """Cách tìm kiếm ban đầu của gpt.py: matmul toàn bộ rồi argsort"""
+    scores = emb @ q_vec
+    order = np.argsort(-scores)[:topk]
+    return order, scores[order]
+
+
+def bench_retrieval(n, dim, kinds, n_queries, topk, seed, components):
+    emb = synthetic_embeddings(n, dim, seed)
+    rng = np.random.default_rng(seed + 1)
+    rows = rng.integers(0, n, n_queries)
+    queries = emb[rows] + 0.05 * rng.standard_normal((n_queries, dim)).astype(np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    args_list = [(q[None, :],) for q in queries]
+
+    results = {}
+    if "retrieval" in components:
+        results[f"retrieval/naive/n={n}"] = run_case(lambda q: naive_search(emb, q[0], topk), args_list, 1)
+        results[f"retrieval/topk_rows/n={n}"] = run_case(lambda q: topk_rows(q @ emb.T, topk), args_list, 1)
+        sharded = ShardedIndex(emb, plan_shards(["bench"] * n, shard_size=-(-n // 4)))
+        results[f"retrieval/sharded_exact_x4/n={n}"] = run_case(lambda q: sharded.search(q, topk), args_list, 1)
+
+    for kind in kinds:
+        if "indexing" in components:
+            start = time.perf_counter()
+            tracemalloc.start()
+            index = build_index(kind, emb)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            seconds = time.perf_counter() - start
+            results[f"indexing/{kind}/n={n}"] = {
+                **summarize_latencies([seconds], n, seconds),
+                "peak_mb": peak / 1e6,
+            }
+        else:
+            index = build_index(kind, emb)
+        if "retrieval" in components:
+            results[f"retrieval/{kind}/n={n}"] = run_case(lambda q: index.search(q, topk), args_list, 1)
+    return results
+
+
+def bench_encoding(n, seed, batch_size=64, backend=None):
+    try:
+        from encoders import DEFAULT_MODEL_NAME, load_encoder
+        model = load_encoder(DEFAULT_MODEL_NAME, backend)
+    except Exception as e:
+        print(f"⏭️  Bỏ qua encoding: {e}")
+        return {}
+    texts = synthetic_sentences(n, random.Random(seed))
+    batches = [(texts[i:i + batch_size],) for i in range(0, len(texts), batch_size)]
+    op = lambda batch: model.encode(batch, batch_size=batch_size, normalize_embeddings=True)
+    result = run_case(op, batches, batch_size)
+    result["items"] = n
+    return {f"encoding/{backend or 'default'}/n={n}": result}
+
+
+def parse_streamed(text, chunk_chars=16):
+    """Step3Parser trên output được cắt thành các chunk như khi stream"""
+    parser = Step3Parser()
+    for i in range(0, len(text), chunk_chars):
+        if parser.feed(text[i:i + chunk_chars]):
+            break
+    return parser.close()
+
+
+def bench_extraction(n, seed):
+    texts = synthetic_critiques(n, random.Random(seed))
+    return {
+        f"extraction/extract_final_answer/n={n}": run_case(extract_final_answer, [(t,) for t in texts], 1),
+        f"extraction/step3_stream/n={n}": run_case(parse_streamed, [(t,) for t in texts], 1),
+    }
+
+
+def bench_scoring(n, seed, batch_rows=10000):
+    rng = random.Random(seed)
+    preds = synthetic_sentences(n, rng, 1, 12)
+    gts = [p if rng.random() < 0.3 else s for p, s in zip(preds, synthetic_sentences(n, rng, 1, 8))]
+    pairs = list(zip(preds, gts))
+    results = {
+        f"scoring/evaluate_answer/n={n}": run_case(lambda p, g: scoring.evaluate_answer(p, g), pairs, 1),
+    }
+    chunks = [(preds[i:i + batch_rows], gts[i:i + batch_rows]) for i in range(0, n, batch_rows)]
+    rows = min(n, batch_rows)
+    for mode in scoring.SCORING_MODES:
+        op = lambda p, g, mode=mode: scoring.score_batch(p, g, (0.6,), mode=mode, n_jobs=1)
+        result = run_case(op, chunks, rows, warmup=0)
+        result["items"] = n
+        results[f"scoring/score_batch_{mode}/n={n}"] = result
+    return results
+
+
+# --- Baseline & so sánh ---
+
+def compare(current, baseline, threshold):
+    """
+    Returns: list hồi quy (case, metric, giá trị baseline, giá trị hiện tại, % thay đổi).
+    Throughput giảm hoặc p95/bộ nhớ đỉnh tăng quá threshold thì tính là hồi quy.
+    """
+    regressions = []
+    for case, cur in current.items():
+        base = baseline.get(case)
+        if not base:
+            continue
+        checks = [
+            ("throughput", base["throughput"], cur["throughput"], False, 0.0),
+            ("p95_ms", base["p95_ms"], cur["p95_ms"], True, _MIN_P95_MS),
+            ("peak_mb", base["peak_mb"], cur["peak_mb"], True, _MIN_PEAK_MB),
+        ]
+        for metric, before, after, higher_is_worse, min_abs in checks:
+            if before <= 0 or abs(after - before) < min_abs:
+                continue
+            change = (after - before) / before
+            worse = change > threshold if higher_is_worse else change < -threshold
+            if worse:
+                regressions.append((case, metric, before, after, change * 100))
+    return regressions
+
+
+def print_table(results):
+    print(f"\n{'case':<48} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10} {'item/s':>12} {'peak MB':>9}")
+    for case, r in results.items():
+        print(f"{case:<48} {r['p50_ms']:>10.3f} {r['p95_ms']:>10.3f} {r['p99_ms']:>10.3f} "
+              f"{r['throughput']:>12.1f} {r['peak_mb']:>9.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark retrieval / indexing / extraction / scoring")
+    parser.add_argument("--sizes", nargs="+", type=int, default=[1000, 10000, 100000],
+                        help="Số dòng corpus tổng hợp (1M dòng dim 768 cần ~3 GB RAM)")
+    parser.add_argument("--components", nargs="+", choices=COMPONENTS,
+                        default=["retrieval", "indexing", "extraction", "scoring"])
+    parser.add_argument("--index-kinds", nargs="+", choices=INDEX_KINDS, default=["exact", "ivf", "int8"])
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--queries", type=int, default=200, help="Số truy vấn đo mỗi case retrieval")
+    parser.add_argument("--topk", type=int, default=5)
+    parser.add_argument("--encode-rows", type=int, default=2000, help="[encoding] Số câu encode")
+    parser.add_argument("--backend", default=None, help="[encoding] torch | onnx")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default=None, help="Ghi kết quả JSON")
+    parser.add_argument("--save-baseline", nargs="?", const=str(DEFAULT_BASELINE), default=None,
+                        help="Lưu kết quả làm baseline")
+    parser.add_argument("--compare", nargs="?", const=str(DEFAULT_BASELINE), default=None,
+                        help="So sánh với baseline, thoát mã 1 nếu có hồi quy")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Ngưỡng hồi quy (0.2 = 20%%)")
+    args = parser.parse_args()
+
+    results = {}
+    for n in args.sizes:
+        print(f"⏱️  n={n} ...")
+        if "retrieval" in args.components or "indexing" in args.components:
+            results.update(bench_retrieval(n, args.dim, args.index_kinds, args.queries, args.topk,
+                                           args.seed, args.components))
+        if "extraction" in args.components:
+            results.update(bench_extraction(n, args.seed))
+        if "scoring" in args.components:
+            results.update(bench_scoring(n, args.seed))
+    if "encoding" in args.components:
+        results.update(bench_encoding(args.encode_rows, args.seed, backend=args.backend))
+
+    print_table(results)
+    report = {
+        "meta": {
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "processor": platform.processor(),
+            "dim": args.dim,
+            "seed": args.seed,
+        },
+        "results": results,
+    }
+    for path in filter(None, [args.out, args.save_baseline]):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        Path(path).write_text(json.dumps(report, indent=2), encoding="utf-8")
+        print(f"💾 Đã lưu {path}")
+
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text(encoding="utf-8"))
+        regressions = compare(results, baseline["results"], args.threshold)
+        if not regressions:
+            print(f"✅ Không có hồi quy > {args.threshold:.0%} so với {args.compare}")
+            return
+        print(f"❌ {len(regressions)} hồi quy > {args.threshold:.0%} so với {args.compare}:")
+        for case, metric, before, after, change in regressions:
+            print(f"   {case:<48} {metric:<10} {before:>10.3f} -> {after:>10.3f} ({change:+.1f}%)")
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,37 +1,169 @@
-import json
+import argparse
+import time
 import numpy as np
 import pandas as pd
 from pathlib import Path
-from sentence_transformers import SentenceTransformer
+from storage import find_tables, read_table, resolve_table
+from dedup import DEFAULT_THRESHOLD as DEDUP_THRESHOLD, cluster_near_duplicates
+from encoding import default_workers, encode_corpus
+from encoders import ENCODER_BACKENDS, default_backend, encoder_id
+from vector_index import INDEX_KINDS, build_index, quantization_report, recall_at_k
+from embedding_store import EmbeddingStore, file_sha256, staging_dir, write_index_version
+from sharded_index import CANONICAL_FILE, TABLE_PREFIX, ShardedIndex, plan_shards, shard_index_path, source_name
 
 
 DATA_DIR = Path("data")
 DATA_DIR.mkdir(exist_ok=True)
 
+MODEL_NAME = "sentence-transformers/paraphrase-multilingual-mpnet-base-v2"
+# Bảng benchmark do prepare_data.py tạo (data/benchmark_<nguồn>.parquet hoặc .csv), mỗi nguồn 1 shard
 
-print("📖 Đọc data/benchmark_viquad_v2_train.csv ...")
-df = pd.read_csv(DATA_DIR / "benchmark_viquad_v2_train.csv")
-questions = df["question"].astype(str).tolist()
-answers = df["ground_truth"].astype(str).tolist()  # Cột này là "ground_truth" trong benchmark files
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Build embeddings + index tìm kiếm cho gpt.py")
+    parser.add_argument("--backend", choices=ENCODER_BACKENDS, default=default_backend(),
+                        help="Encoder: torch (SentenceTransformer) hoặc onnx (int8, xem app/encoders.py)")
+    parser.add_argument("--workers", type=int, default=default_workers(),
+                        help="Số process encode song song (mỗi process nạp 1 bản model)")
+    parser.add_argument("--batch-size", type=int, default=64, help="Số câu mỗi batch encode")
+    parser.add_argument("--index", choices=INDEX_KINDS, default="exact",
+                        help="Loại index: exact (argpartition), ivf (phân cụm), graph (đồ thị k-NN)")
+    parser.add_argument("--nlist", type=int, default=None, help="[ivf] Số cụm (mặc định 4*sqrt(N))")
+    parser.add_argument("--nprobe", type=int, default=8, help="[ivf] Số cụm quét khi search")
+    parser.add_argument("--degree", type=int, default=16, help="[graph] Số láng giềng mỗi node")
+    parser.add_argument("--ef", type=int, default=64, help="[graph] Độ rộng beam khi search")
+    parser.add_argument("--rescore", type=int, default=4,
+                        help="[float16/int8/binary] Shortlist = topk*rescore được tính lại bằng float32")
+    parser.add_argument("--dedup-threshold", type=float, default=DEDUP_THRESHOLD,
+                        help="Gộp câu hỏi gần trùng (Jaccard MinHash/LSH, xem app/dedup.py), mỗi cụm giữ 1 dòng")
+    parser.add_argument("--no-dedup", action="store_true", help="Giữ mọi dòng, kể cả câu trùng")
+    parser.add_argument("--quant-report", action="store_true",
+                        help="In bảng bộ nhớ và recall@10 của float16/int8/binary")
+    parser.add_argument("--datasets", nargs="+", default=None,
+                        help="Chỉ index các nguồn này, vd viquad_v2_train xquad_vi (mặc định: mọi data/benchmark_*)")
+    parser.add_argument("--shard-size", type=int, default=0,
+                        help="Chia tiếp mỗi nguồn thành các shard tối đa N dòng (0 = mỗi nguồn 1 shard)")
+    return parser.parse_args()
 
-print("🧠 Nạp model embedding đa ngữ...")
-model = SentenceTransformer(
-    "sentence-transformers/paraphrase-multilingual-mpnet-base-v2"
-)
 
+def main():
+    args = parse_args()
 
-print("🧮 Tính embeddings (chuẩn hoá)...")
-emb = model.encode(questions, normalize_embeddings=True)
-emb = np.asarray(emb, dtype=np.float32)
+    if args.datasets:
+        source_files = [resolve_table(DATA_DIR / f"{TABLE_PREFIX}{name}") for name in args.datasets]
+    else:
+        source_files = find_tables(DATA_DIR, f"{TABLE_PREFIX}*")
+    if not source_files:
+        raise SystemExit("❌ Không có data/benchmark_*.parquet|.csv, hãy chạy python app/prepare_data.py trước")
+    print(f"📖 Đọc {', '.join(str(p) for p in source_files)} ...")
+    tables = [read_table(p, columns=["question", "ground_truth"]) for p in source_files]
+    df = pd.concat(tables, ignore_index=True)
+    questions = df["question"].astype(str).tolist()
+    answers = df["ground_truth"].astype(str).tolist()  # Cột này là "ground_truth" trong benchmark files
+    # Nguồn của từng dòng: các dòng cùng nguồn nằm liền nhau (mỗi nguồn 1 đoạn của corpus)
+    sources = [source_name(p) for p, table in zip(source_files, tables) for _ in range(len(table))]
 
+    # Gom cụm câu hỏi trùng/gần trùng trên mọi nguồn 1 lần. Mỗi cụm giữ dòng đầu tiên của nó trong
+    # từng nguồn (nguồn nào cũng còn shard của mình, lọc theo nguồn vẫn thấy câu đó); các dòng giữ lại
+    # của cùng 1 cụm được ghi cùng đại diện vào canonical.npy để search không trả về câu trùng 2 lần.
+    # Câu giống hệt nhau giữa các nguồn vẫn chỉ encode 1 lần (EmbeddingStore khoá theo nội dung).
+    canonical = None
+    if not args.no_dedup:
+        clusters = cluster_near_duplicates(questions, args.dedup_threshold)
+        first = {}
+        keep = [i for i, key in enumerate(zip(clusters, sources)) if first.setdefault(key, i) == i]
+        # Đại diện của cụm (dòng nhỏ nhất) luôn được giữ: đổi sang số dòng sau khi lọc
+        new_row = {i: row for row, i in enumerate(keep)}
+        canonical = np.array([new_row[clusters[i]] for i in keep], dtype=np.int32)
+        if len(keep) < len(questions):
+            print(f"🧬 Bỏ {len(questions) - len(keep)} câu trùng/gần trùng trong cùng nguồn "
+                  f"(ngưỡng {args.dedup_threshold}), còn {len(keep)} câu")
+            questions = [questions[i] for i in keep]
+            answers = [answers[i] for i in keep]
+            sources = [sources[i] for i in keep]
+        shared = int(len(keep) - len(np.unique(canonical)))
+        if shared:
+            print(f"   {shared} dòng trùng câu của nguồn khác: search chỉ trả về 1 lần")
+        else:
+            canonical = None
 
-print("💾 Lưu index & metadata...")
-(DATA_DIR / "questions.json").write_text(
-    json.dumps(questions, ensure_ascii=False, indent=2), encoding="utf-8"
-)
-(DATA_DIR / "answers.json").write_text(
-    json.dumps(answers, ensure_ascii=False, indent=2), encoding="utf-8"
-)
-np.save(DATA_DIR / "embeddings.npy", emb)
-print("✅ Hoàn tất: data/questions.json, data/answers.json, data/embeddings.npy")
+    # Chỉ nạp model khi thật sự có câu mới cần encode
+    def encode(texts):
+        print(f"🧮 Tính embeddings (chuẩn hoá) cho {len(texts)} câu mới/thay đổi "
+              f"({args.backend}, {args.workers} process, batch {args.batch_size})...")
+        vectors, enc_stats = encode_corpus(
+            texts, MODEL_NAME,
+            batch_size=args.batch_size,
+            workers=args.workers,
+            out_path=DATA_DIR / ".encoded-new.npy",
+            backend=args.backend,
+        )
+        print(f"   -> {enc_stats['rows']} câu trong {enc_stats['seconds']:.1f}s ({enc_stats['rows_per_sec']:.1f} câu/giây)")
+        return vectors
+
+    # Vector của backend onnx (int8) được khoá riêng, không trộn với vector PyTorch
+    store_model = encoder_id(MODEL_NAME, args.backend)
+    # embeddings.npy ghi thẳng vào thư mục tạm của phiên bản mới (không phải chuyển file lúc lưu)
+    staging = staging_dir(DATA_DIR, clean=True)
+    keys, emb, stats = EmbeddingStore(DATA_DIR).embed(
+        questions, store_model, encode, out_path=staging / "embeddings.npy"
+    )
+    (DATA_DIR / ".encoded-new.npy").unlink(missing_ok=True)
+    print(f"   -> {stats['rows']} dòng: dùng lại {stats['reused']}, encode {stats['encoded']}, bỏ {stats['dropped']}")
+
+    shards = plan_shards(sources, args.shard_size)
+    print(f"🗂️  Build index '{args.index}' cho {len(shards)} shard...")
+    params = {
+        "exact": {},
+        "ivf": {"nlist": args.nlist, "nprobe": args.nprobe},
+        "graph": {"degree": args.degree, "ef": args.ef},
+    }.get(args.index, {"rescore": args.rescore})
+    start = time.perf_counter()
+    shard_indexes = {}
+    for shard in shards:
+        shard_indexes[shard["name"]] = build_index(args.index, emb[shard["start"]:shard["stop"]], **params)
+        print(f"   {shard['name']:<24} {shard['stop'] - shard['start']:>8} dòng")
+    # Không gộp dòng trùng ở đây: recall so với quét exact trên cùng các dòng
+    index = ShardedIndex(emb, shards, args.index, params, indexes=shard_indexes)
+    print(f"   -> {time.perf_counter() - start:.2f}s, recall@10 so với exact: {recall_at_k(index, emb, topk=10):.3f}")
+
+    if args.quant_report:
+        print(f"📏 Bộ nhớ và recall@10 theo kiểu nén (rescore={args.rescore}):")
+        print(f"   {'kiểu':<8} {'MB':>9} {'nén':>6} {'recall lượt 1':>14} {'recall rescore':>15}")
+        for row in quantization_report(emb, topk=10, rescore=args.rescore):
+            print(
+                f"   {row['kind']:<8} {row['memory_mb']:>9.2f} {row['compression']:>5.1f}x "
+                f"{row['recall_first_pass']:>14.3f} {row['recall_rescored']:>15.3f}"
+            )
+
+    print("💾 Lưu index & metadata (phiên bản mới)...")
+    for name in shard_indexes:
+        shard_indexes[name].save(staging / shard_index_path(DATA_DIR, args.index, name).name)
+    # Bỏ memmap embeddings (và các index giữ view của nó) trước khi đổi tên thư mục tạm:
+    # Windows không cho đổi tên/chuyển file đang được map
+    emb.flush()
+    del emb, index, shard_indexes
+    manifest = write_index_version(
+        DATA_DIR, questions, answers, staging / "embeddings.npy", keys,
+        manifest={
+            "model": store_model,
+            "backend": args.backend,
+            "index": args.index,
+            "datasets": [
+                {"path": str(p), "sha256": file_sha256(p)} for p in source_files
+            ],
+            "stats": stats,
+            "dedup_threshold": None if args.no_dedup else args.dedup_threshold,
+            "index_params": params,
+            "shards": shards,
+        },
+        extra_writers=[(CANONICAL_FILE, lambda path: np.save(path, canonical))] if canonical is not None else [],
+    )
+    version_dir = f"data/{manifest['dir']}"
+    corpus_names = [name for name in manifest["files"] if name in ("corpus.parquet", "questions.json", "answers.json")]
+    print(f"✅ Hoàn tất phiên bản {manifest['version']}: {', '.join(f'{version_dir}/{n}' for n in corpus_names)}, "
+          f"{version_dir}/embeddings.npy, {len(shards)} shard {version_dir}/index_{args.index}-*.npz")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Log kết quả dạng JSONL: mỗi dòng kết quả được ghi xuống đĩa ngay khi xong.
+Chạy lại sau khi crash sẽ bỏ qua các dòng đã có trong log.
+"""
+import json
+import os
+from pathlib import Path
+
+import pandas as pd
+
+
+class ResultLog:
+    """
+    File JSONL chỉ ghi thêm (append-only). Mỗi bản ghi có cột khoá `key_col`
+    (mặc định 'row_id' = vị trí dòng trong file benchmark).
+    """
+
+    def __init__(self, path, key_col="row_id"):
+        self.path = Path(path)
+        self.key_col = key_col
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._repair()
+        self._fh = None
+
+    def _repair(self):
+        """Cắt bỏ dòng cuối bị ghi dở (khi process bị kill giữa chừng)"""
+        if not self.path.exists():
+            return
+        with open(self.path, "rb+") as f:
+            data = f.read()
+            if data and not data.endswith(b"\n"):
+                f.truncate(data.rfind(b"\n") + 1)
+
+    def iter_records(self):
+        if not self.path.exists():
+            return
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+    def completed_keys(self):
+        """Tập khoá của các dòng đã chạy xong"""
+        return {record[self.key_col] for record in self.iter_records()}
+
+    def append(self, record):
+        """Ghi 1 bản ghi và fsync để không mất khi crash"""
+        if self._fh is None:
+            self._fh = open(self.path, "a", encoding="utf-8")
+        self._fh.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+        self._fh.flush()
+        os.fsync(self._fh.fileno())
+
+    def close(self):
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def to_dataframe(self):
+        """Đọc toàn bộ log (1 lượt), sắp xếp theo khoá, bỏ bản ghi trùng khoá"""
+        df = pd.DataFrame(list(self.iter_records()))
+        if df.empty:
+            return df
+        df = df.drop_duplicates(subset=[self.key_col], keep="last")
+        return df.sort_values(self.key_col).reset_index(drop=True)
@@ -0,0 +1,160 @@
+"""
+Load test lời gọi Self-Critique của gpt.py trên server giả lập: so sánh
+- per_request: tạo client OpenAI mới cho mỗi câu hỏi (cách cũ, mỗi lần mở lại kết nối)
+- pooled: client dùng chung trong process (resources.get_openai_client, keep-alive)
+- pooled_stream: client dùng chung + stream ở thread nền (như trang Streamlit hiện tại),
+  "first" là lúc đoạn text đầu tiên hiện ra trang
+
+In p50/p95 thời gian tới khi có nội dung đầu tiên và tới khi xong, số kết nối mới phía server.
+Bản SDK openai mới đóng response ngay sau "data: [DONE]" (không đọc hết body) nên kết nối của
+lời gọi stream không được trả về pool; khi đó new_connections của pooled_stream gần bằng số câu hỏi.
+Mặc định tự chạy mock_llm_server trong process với --connect-latency giả lập TCP + TLS handshake;
+thêm --base-url để đo trên API thật (OpenAI-compatible, key lấy từ OPENAI_API_KEY):
+
+    python app/client_load_test.py --requests 200 --concurrency 4
+    python app/client_load_test.py --latency lognormal:800,0.5 --ms-per-token 10 --connect-latency 150
+"""
+import argparse
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from openai import OpenAI
+
+from llm_cache import LLMCache
+from llm_calls import openai_chat, openai_chat_stream, stream_in_background
+from mock_llm_server import MockHTTPServer, MockLLM, make_handler
+from prompts import CRITIQUE_PROMPT
+from resources import get_executor, get_openai_client
+from runner import ConcurrentRunner
+
+MODES = ("per_request", "pooled", "pooled_stream")
+DEFAULT_OUT = Path("results") / "client_load_test.json"
+
+
+def start_mock(args):
+    mock = MockLLM(latency=args.latency, ms_per_token=args.ms_per_token, connect_latency_ms=args.connect_latency)
+    server = MockHTTPServer(("127.0.0.1", 0), make_handler(mock))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return mock, server, f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+
+def run_mode(mode, base_url, api_key, model, n_requests, concurrency, timeout):
+    """
+    Gửi n_requests câu hỏi với concurrency "người dùng" song song.
+    Returns: list (giây tới nội dung đầu tiên, giây tới khi xong, lỗi hoặc None)
+    """
+    cache = LLMCache(mode="off")
+    shared = get_openai_client(api_key, base_url, timeout=timeout, max_retries=0)
+
+    def one(i):
+        messages = [{"role": "user", "content": CRITIQUE_PROMPT.format(
+            question=f"Câu hỏi thử số {i}?", candidate=f"Đáp án {i}")}]
+        start = time.perf_counter()
+        try:
+            if mode == "per_request":
+                # Như gpt.py trước đây: client mới cho mỗi câu hỏi
+                client = OpenAI(api_key=api_key, base_url=base_url, timeout=timeout, max_retries=0)
+                try:
+                    openai_chat(client, cache=cache, model=model, messages=messages, temperature=0)
+                finally:
+                    client.close()
+                first = time.perf_counter() - start
+            elif mode == "pooled":
+                openai_chat(shared, cache=cache, model=model, messages=messages, temperature=0)
+                first = time.perf_counter() - start
+            else:
+                first = None
+                chunks = stream_in_background(
+                    lambda **stream: openai_chat_stream(
+                        shared, cache=cache, model=model, messages=messages, temperature=0, **stream),
+                    timeout=timeout,
+                    executor=get_executor(max_workers=concurrency),
+                )
+                for _ in chunks:
+                    if first is None:
+                        first = time.perf_counter() - start
+            return first, time.perf_counter() - start, None
+        except Exception as e:
+            return None, time.perf_counter() - start, e
+
+    runner = ConcurrentRunner(max_workers=concurrency)
+    return list(runner.map(one, range(n_requests)))
+
+
+def percentiles(values):
+    values = [v for v in values if v is not None]
+    if not values:
+        return None, None
+    return float(np.percentile(values, 50)), float(np.percentile(values, 95))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test client OpenAI: mỗi câu 1 client vs client dùng chung")
+    parser.add_argument("--requests", type=int, default=200, help="Số câu hỏi mỗi chế độ")
+    parser.add_argument("--concurrency", type=int, default=4, help="Số người dùng đồng thời")
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=list(MODES))
+    parser.add_argument("--model", default="gpt-4o-mini")
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--base-url", default=None, help="API OpenAI-compatible (mặc định: mock trong process)")
+    parser.add_argument("--latency", default="lognormal:300,0.3", help="Mock: độ trễ tới token đầu tiên")
+    parser.add_argument("--ms-per-token", type=float, default=20.0, help="Mock: độ trễ theo token output")
+    parser.add_argument("--connect-latency", type=float, default=100.0, help="Mock: ms mỗi kết nối mới")
+    parser.add_argument("--out", default=str(DEFAULT_OUT))
+    args = parser.parse_args()
+
+    mock = server = None
+    base_url = args.base_url
+    if base_url is None:
+        mock, server, base_url = start_mock(args)
+        print(f"🧪 Mock LLM trong process tại {base_url} (độ trễ {args.latency}, "
+              f"kết nối mới +{args.connect_latency:g}ms)")
+    api_key = os.getenv("OPENAI_API_KEY") or "mock"
+
+    results = []
+    try:
+        for mode in args.modes:
+            connections = mock.connections.value() if mock else None
+            start = time.perf_counter()
+            calls = run_mode(mode, base_url, api_key, args.model, args.requests, args.concurrency, args.timeout)
+            seconds = time.perf_counter() - start
+            first_p50, first_p95 = percentiles([first for first, _, err in calls if err is None])
+            total_p50, total_p95 = percentiles([total for _, total, err in calls if err is None])
+            row = {
+                "mode": mode,
+                "requests": len(calls),
+                "errors": sum(err is not None for _, _, err in calls),
+                "req_per_sec": len(calls) / max(seconds, 1e-9),
+                "first_p50": first_p50,
+                "first_p95": first_p95,
+                "total_p50": total_p50,
+                "total_p95": total_p95,
+                "new_connections": mock.connections.value() - connections if mock else None,
+            }
+            results.append(row)
+            print(f"  {mode:<14} nội dung đầu p50={first_p50 or 0:.3f}s p95={first_p95 or 0:.3f}s, "
+                  f"xong p50={total_p50 or 0:.3f}s p95={total_p95 or 0:.3f}s, {row['errors']} lỗi")
+    finally:
+        if server is not None:
+            server.shutdown()
+
+    print(f"\n📊 {args.requests} câu hỏi/chế độ, {args.concurrency} người dùng đồng thời")
+    print(pd.DataFrame(results).to_string(index=False, float_format=lambda x: f"{x:.3f}"))
+
+    out_path = Path(args.out)
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    out_path.write_text(json.dumps({
+        "base_url": args.base_url or "mock",
+        "model": args.model,
+        "concurrency": args.concurrency,
+        "results": results,
+    }, ensure_ascii=False, indent=2), encoding="utf-8")
+    print(f"\n💾 Đã lưu {out_path}")
+
+
+if __name__ == "__main__":
+    main()
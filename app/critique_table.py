@@ -0,0 +1,167 @@
+"""
+Bảng Self-Critique tính trước cho mọi câu hỏi trong index (data/critiques.parquet).
+
+Prompt critique của app chỉ phụ thuộc câu hỏi người dùng, câu hỏi/đáp án khớp nhất và score,
+nên với câu hỏi gần như trùng một câu trong index (score cao) có thể dùng luôn critique đã
+tính trước bằng chính câu hỏi đó (score = 1.0), thay vì gọi model lại mỗi lần.
+
+Mỗi dòng khoá theo (index_id, prompt_version), kèm hash câu hỏi để phát hiện index đã build lại
+(vị trí đổi thì critique cũ không được dùng). prompt_version lấy từ prompts.critique_prompt_version.
+
+Batch job (chạy lại sẽ tiếp tục từ log data/critiques_<version>.jsonl, chỉ gọi các câu còn thiếu):
+
+    python app/critique_table.py --concurrency 8 --rpm 500
+    python app/critique_table.py --limit 1000          # chỉ 1000 câu đầu
+"""
+import argparse
+import hashlib
+import os
+import time
+from pathlib import Path
+
+import pandas as pd
+from dotenv import load_dotenv
+from tqdm import tqdm
+
+from checkpoint import ResultLog
+from embedding_store import current_dir
+from llm_calls import openai_chat
+from prompts import build_critique_prompt, critique_prompt_version
+from runner import ConcurrentRunner, estimate_tokens, get_retry_policy
+from storage import read_corpus, read_table, resolve_table, table_path, write_table
+
+CRITIQUE_MODEL = os.getenv("CRITIQUE_MODEL", "gpt-4o-mini")
+CRITIQUE_TABLE = "critiques"
+COLUMNS = ["index_id", "prompt_version", "question_sha", "model", "critique"]
+
+
+def question_sha(question):
+    return hashlib.sha1(str(question).encode("utf-8")).hexdigest()[:16]
+
+
+def critique_table_path(data_dir):
+    """data/critiques.parquet (hoặc .csv nếu đã có / không có pyarrow)"""
+    try:
+        return resolve_table(Path(data_dir) / CRITIQUE_TABLE)
+    except FileNotFoundError:
+        return table_path(Path(data_dir) / CRITIQUE_TABLE)
+
+
+class CritiqueTable:
+    """Tra critique tính trước theo index_id cho 1 prompt_version (chỉ giữ các dòng của version đó)"""
+
+    def __init__(self, rows, prompt_version):
+        self.prompt_version = prompt_version
+        self._rows = rows  # index_id -> (question_sha, critique)
+
+    @classmethod
+    def load(cls, data_dir, prompt_version):
+        path = critique_table_path(data_dir)
+        if not path.exists():
+            return cls({}, prompt_version)
+        df = read_table(path, columns=COLUMNS)
+        df = df[df["prompt_version"] == prompt_version]
+        rows = dict(zip(df["index_id"].astype(int), zip(df["question_sha"], df["critique"])))
+        return cls(rows, prompt_version)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def get(self, index_id, question):
+        """Critique của câu index_id, None nếu chưa có hoặc câu hỏi ở vị trí đó đã đổi"""
+        row = self._rows.get(int(index_id))
+        if row is None or row[0] != question_sha(question):
+            return None
+        return row[1]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Tính trước Self-Critique cho mọi câu hỏi trong index")
+    parser.add_argument("--data-dir", default="data")
+    parser.add_argument("--model", default=CRITIQUE_MODEL)
+    parser.add_argument("--limit", type=int, default=None, help="Chỉ tính N câu đầu của corpus")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--rpm", type=int, default=0, help="Giới hạn request/phút (0 = không)")
+    parser.add_argument("--tpm", type=int, default=0, help="Giới hạn token/phút (0 = không)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    load_dotenv()
+    api_key = os.getenv("OPENAI_API_KEY", "").strip()
+    if not api_key:
+        print("Không tìm thấy OPENAI_API_KEY trong file .env")
+        return
+
+    data_dir = Path(args.data_dir)
+    questions, answers = read_corpus(current_dir(data_dir))
+    n = min(args.limit or len(questions), len(questions))
+    version = critique_prompt_version(args.model)
+    shas = [question_sha(q) for q in questions]
+
+    out_path = critique_table_path(data_dir)
+    existing = read_table(out_path, columns=COLUMNS) if out_path.exists() else pd.DataFrame(columns=COLUMNS)
+    log = ResultLog(data_dir / f"critiques_{version}.jsonl", key_col="index_id")
+
+    # Câu đã có (trong bảng hoặc log của lần chạy trước) và câu hỏi ở vị trí đó không đổi
+    done = {}
+    current = existing[existing["prompt_version"] == version]
+    for record in current.to_dict("records") + list(log.iter_records()):
+        i = int(record["index_id"])
+        if i < len(shas) and record["question_sha"] == shas[i]:
+            done[i] = record
+    todo = [i for i in range(n) if i not in done]
+    print(f"🧾 Prompt version {version} ({args.model}): {n - len(todo)}/{n} câu đã có, cần gọi {len(todo)} câu")
+
+    # openai chỉ cần cho batch job (app chỉ tra bảng); max_retries=0: retry do RetryPolicy lo
+    from openai import OpenAI
+    client = OpenAI(api_key=api_key, base_url=os.getenv("OPENAI_BASE_URL") or None, max_retries=0)
+    prompts = {i: build_critique_prompt(questions[i], questions[i], answers[i], 1.0) for i in todo}
+
+    def critique(i, attempt):
+        return openai_chat(
+            client,
+            attempt=attempt,
+            model=args.model,
+            messages=[{"role": "user", "content": prompts[i]}],
+            temperature=0,
+        )
+
+    runner = ConcurrentRunner(
+        max_workers=args.concurrency,
+        rpm=args.rpm,
+        tpm=args.tpm,
+        retry=get_retry_policy(f"openai/{args.model}", args.concurrency),
+    )
+    start = time.perf_counter()
+    failed = 0
+    with log:
+        outputs = runner.map(critique, todo, cost=lambda i: estimate_tokens(prompts[i]))
+        for i, (text, err) in tqdm(zip(todo, outputs), total=len(todo), desc="Self-Critique"):
+            if err is not None:
+                failed += 1
+                continue
+            record = {"index_id": i, "prompt_version": version, "question_sha": shas[i],
+                      "model": args.model, "critique": text.strip()}
+            log.append(record)
+            done[i] = record
+    seconds = time.perf_counter() - start
+    if todo:
+        print(f"⏱️  {len(todo) - failed} câu trong {seconds:.1f}s"
+              + (f", {failed} câu lỗi (chạy lại để thử tiếp)" if failed else ""))
+
+    # Giữ các version khác, thay toàn bộ dòng của version này
+    df = pd.concat([
+        existing[existing["prompt_version"] != version],
+        pd.DataFrame([done[i] for i in sorted(done)], columns=COLUMNS),
+    ], ignore_index=True)
+    df["index_id"] = df["index_id"].astype("int64")
+    write_table(df, out_path)
+    if not failed:
+        log.path.unlink(missing_ok=True)
+    print(f"💾 {len(done)} critique (version {version}) -> {out_path} ({len(df)} dòng tất cả các version)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+"""
+Phát hiện câu hỏi gần trùng (near-duplicate) bằng MinHash + LSH trên shingle âm tiết tiếng Việt.
+
+- Shingle: k âm tiết liên tiếp sau khi chuẩn hoá (NFC, casefold, bỏ dấu câu).
+- MinHash: num_perm hàm băm a*x+b mod p, chữ ký tính theo lô bằng numpy.
+- LSH: chia chữ ký thành các band, chỉ so Jaccard thật cho các cặp rơi cùng bucket
+  (gần tuyến tính theo số câu thay vì so mọi cặp).
+- Các cặp có Jaccard >= threshold được gộp cụm (union-find). Câu xuất hiện đầu tiên
+  (theo thứ tự file rồi thứ tự dòng) là câu đại diện (canonical) của cụm.
+
+    python app/dedup.py data/benchmark_*.parquet --threshold 0.9 --out data/dedup_map.parquet
+"""
+import argparse
+import os
+import re
+import unicodedata
+import zlib
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from storage import read_table, table_path, write_table
+
+SHINGLE_SIZE = 2
+NUM_PERM = 128
+# Ngưỡng thấp (~0.8) đã gộp cả các câu chỉ khác 1 con số/tên riêng (đáp án khác nhau),
+# nên mặc định chỉ gộp câu gần như giống hệt
+DEFAULT_THRESHOLD = float(os.getenv("DEDUP_THRESHOLD", "0.9"))
+
+# Hàm băm a*x + b mod p với p = 2^31 - 1: a*x < 2^62 nên không tràn uint64
+_PRIME = np.uint64((1 << 31) - 1)
+# Bucket nhỏ hơn ngưỡng này thì so mọi cặp, lớn hơn thì chỉ so với phần tử đầu bucket
+_MAX_BUCKET_PAIRS = 64
+_CHUNK_DOCS = 2048
+
+_WORD = re.compile(r"\w+")
+
+
+def syllables(text):
+    """Tách âm tiết: tiếng Việt viết cách nhau bằng khoảng trắng, bỏ dấu câu và hoa/thường"""
+    return _WORD.findall(unicodedata.normalize("NFC", str(text)).casefold())
+
+
+def shingles(text, k=SHINGLE_SIZE):
+    """Tập các cụm k âm tiết liên tiếp (câu ngắn hơn k thì là cả câu)"""
+    tokens = syllables(text)
+    if len(tokens) <= k:
+        return {" ".join(tokens)}
+    return {" ".join(tokens[i:i + k]) for i in range(len(tokens) - k + 1)}
+
+
+def jaccard(a, b):
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+
+def choose_bands(num_perm, threshold):
+    """Chọn số band sao cho ngưỡng LSH (1/b)^(1/r) thấp hơn threshold một chút (ưu tiên recall)"""
+    target = threshold * 0.9
+    options = [b for b in range(1, num_perm + 1) if num_perm % b == 0]
+    return min(options, key=lambda b: abs((1.0 / b) ** (b / num_perm) - target))
+
+
+class MinHasher:
+    def __init__(self, num_perm=NUM_PERM, seed=1):
+        rng = np.random.default_rng(seed)
+        self.num_perm = num_perm
+        self.a = rng.integers(1, int(_PRIME), size=num_perm, dtype=np.uint64)[:, None]
+        self.b = rng.integers(0, int(_PRIME), size=num_perm, dtype=np.uint64)[:, None]
+
+    def signatures(self, shingle_sets):
+        """Returns: ma trận (n, num_perm) uint32, mỗi dòng là chữ ký MinHash của 1 tập shingle"""
+        out = np.empty((len(shingle_sets), self.num_perm), dtype=np.uint32)
+        for start in range(0, len(shingle_sets), _CHUNK_DOCS):
+            chunk = shingle_sets[start:start + _CHUNK_DOCS]
+            hashes = [np.fromiter((zlib.crc32(s.encode("utf-8")) for s in sh), np.uint64, len(sh)) for sh in chunk]
+            offsets = np.cumsum([0] + [len(h) for h in hashes[:-1]])
+            values = (self.a * (np.concatenate(hashes) % _PRIME) + self.b) % _PRIME
+            out[start:start + len(chunk)] = np.minimum.reduceat(values, offsets, axis=1).T
+        return out
+
+
+def lsh_candidates(signatures, bands):
+    """Các cặp (i, j), i < j, có ít nhất 1 band trùng hoàn toàn"""
+    n, num_perm = signatures.shape
+    rows = num_perm // bands
+    pairs = set()
+    for band in range(bands):
+        block = np.ascontiguousarray(signatures[:, band * rows:(band + 1) * rows])
+        keys = block.view(np.dtype((np.void, block.dtype.itemsize * rows))).ravel()
+        _, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+        if counts.max(initial=0) < 2:
+            continue
+        order = np.argsort(inverse, kind="stable")
+        bounds = np.cumsum(counts)[:-1]
+        for members in np.split(order, bounds):
+            if len(members) < 2:
+                continue
+            members = members.tolist()
+            if len(members) <= _MAX_BUCKET_PAIRS:
+                pairs.update((members[i], m) for i in range(len(members)) for m in members[i + 1:])
+            else:
+                pairs.update((members[0], m) for m in members[1:])
+    return pairs
+
+
+def cluster_near_duplicates(texts, threshold=DEFAULT_THRESHOLD, num_perm=NUM_PERM, bands=None, k=SHINGLE_SIZE):
+    """
+    Returns: mảng canonical (n,) với canonical[i] = chỉ số câu đại diện (nhỏ nhất) trong cụm của câu i.
+    threshold <= 0: tắt gộp cụm gần trùng, chỉ gộp các câu giống hệt nhau sau chuẩn hoá.
+    """
+    texts = list(texts)
+    parent = list(range(len(texts)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union(i, j):
+        ri, rj = find(i), find(j)
+        if ri != rj:
+            parent[max(ri, rj)] = min(ri, rj)
+
+    # Câu giống hệt nhau sau chuẩn hoá: gộp luôn, không cần MinHash
+    first_seen = {}
+    for i, text in enumerate(texts):
+        union(i, first_seen.setdefault(" ".join(syllables(text)), i))
+
+    if threshold > 0 and len(texts) > 1:
+        reps = sorted(set(first_seen.values()))
+        sets = [shingles(texts[i], k) for i in reps]
+        sig = MinHasher(num_perm).signatures(sets)
+        for a, b in lsh_candidates(sig, bands or choose_bands(num_perm, threshold)):
+            if jaccard(sets[a], sets[b]) >= threshold:
+                union(reps[a], reps[b])
+
+    return np.array([find(i) for i in range(len(texts))], dtype=np.int64)
+
+
+def canonical_texts(texts, threshold=DEFAULT_THRESHOLD):
+    """Thay mỗi câu bằng câu đại diện của cụm (dùng để gọi LLM 1 lần mỗi cụm)"""
+    texts = list(texts)
+    return [texts[c] for c in cluster_near_duplicates(texts, threshold)]
+
+
+def dedup_tables(paths, threshold=DEFAULT_THRESHOLD, column="question"):
+    """
+    Gộp cụm câu hỏi trong và giữa nhiều bảng benchmark.
+    Returns: DataFrame ánh xạ (source, row_id) -> canonical_id, kèm canonical_source/canonical_row,
+    is_canonical và cluster_size. canonical_id là số thứ tự toàn cục của câu đại diện.
+    """
+    frames = []
+    for path in paths:
+        df = read_table(path, columns=[column])
+        frames.append(pd.DataFrame({
+            "source": Path(path).with_suffix("").name,
+            "row_id": np.arange(len(df)),
+            column: df[column].astype(str).to_numpy(),
+        }))
+    if not frames:
+        return pd.DataFrame(columns=["source", "row_id", column, "canonical_id",
+                                     "canonical_source", "canonical_row", "is_canonical", "cluster_size"])
+    mapping = pd.concat(frames, ignore_index=True)
+    canonical = cluster_near_duplicates(mapping[column], threshold)
+    mapping["canonical_id"] = canonical
+    mapping["canonical_source"] = mapping["source"].to_numpy()[canonical]
+    mapping["canonical_row"] = mapping["row_id"].to_numpy()[canonical]
+    mapping["is_canonical"] = canonical == np.arange(len(mapping))
+    mapping["cluster_size"] = mapping.groupby("canonical_id")["canonical_id"].transform("size")
+    return mapping
+
+
+def canonical_question_map(mapping, source, column="question"):
+    """dict row_id -> câu hỏi đại diện, cho các dòng của 1 bảng (source = tên file không đuôi)"""
+    canonical_text = mapping[column].to_numpy()[mapping["canonical_id"].to_numpy()]
+    rows = (mapping["source"] == source).to_numpy()
+    return dict(zip(mapping["row_id"].to_numpy()[rows].tolist(), canonical_text[rows].tolist()))
+
+
+def summarize(mapping):
+    total = len(mapping)
+    clusters = int(mapping["is_canonical"].sum()) if total else 0
+    return {
+        "rows": total,
+        "clusters": clusters,
+        "duplicates": total - clusters,
+        "saved_pct": (total - clusters) / total * 100 if total else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tìm câu hỏi gần trùng (MinHash/LSH) trong các bảng benchmark")
+    parser.add_argument("files", nargs="+")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="Jaccard tối thiểu trên shingle âm tiết (0 = chỉ gộp câu giống hệt)")
+    parser.add_argument("--out", default=None, help="Ghi bảng ánh xạ canonical ID (mặc định data/dedup_map)")
+    parser.add_argument("--show", type=int, default=5, help="In vài cụm gần trùng làm ví dụ")
+    args = parser.parse_args()
+
+    mapping = dedup_tables(args.files, args.threshold)
+    stats = summarize(mapping)
+    print(f"🔎 {stats['rows']} câu -> {stats['clusters']} cụm "
+          f"({stats['duplicates']} câu trùng/gần trùng, tiết kiệm {stats['saved_pct']:.1f}% lời gọi)")
+
+    per_source = mapping.groupby("source").agg(rows=("row_id", "size"), canonical=("is_canonical", "sum"))
+    print(per_source.to_string())
+
+    # Ví dụ các cụm có câu khác nhau (không tính cụm chỉ gồm câu giống hệt)
+    shown = 0
+    for cid, group in mapping[mapping["cluster_size"] > 1].groupby("canonical_id"):
+        texts = group["question"].unique()
+        if len(texts) < 2:
+            continue
+        print(f"\n  cụm {cid} ({len(group)} dòng):")
+        for text in texts[:4]:
+            print(f"    - {text}")
+        shown += 1
+        if shown >= args.show:
+            break
+
+    out_path = table_path(args.out or Path("data") / "dedup_map")
+    write_table(mapping, out_path)
+    print(f"\n💾 Đã lưu ánh xạ canonical ID vào {out_path}")
+
+
+if __name__ == "__main__":
+    main()
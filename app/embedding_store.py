@@ -0,0 +1,237 @@
+"""
+Kho embedding tăng dần cho build_index.py.
+
+Mỗi dòng được khoá bằng hash của (text đã chuẩn hoá, tên model). Khi build lại,
+chỉ các câu mới/đã sửa mới phải encode, câu bị xoá khỏi dataset thì bị bỏ.
+Mỗi phiên bản index nằm trong thư mục riêng data/index_v<N>/ (ghi vào thư mục tạm rồi đổi tên),
+data/index_manifest.json là con trỏ tới phiên bản hiện tại và được thay bằng os.replace sau cùng.
+Người đọc chỉ đọc manifest 1 lần rồi đọc mọi file trong thư mục nó trỏ tới (current_dir), nên
+không bao giờ thấy corpus của phiên bản mới cùng embeddings/index của phiên bản cũ.
+Thư mục của phiên bản ngay trước được giữ lại cho người đọc đang nạp dở, các phiên bản cũ hơn bị xoá.
+File của bản build cũ ghi thẳng vào data/ (embeddings.npy, questions.json, answers.json có trong git)
+không bị xoá, chỉ không còn được đọc khi đã có manifest trỏ tới thư mục phiên bản.
+"""
+import hashlib
+import json
+import os
+import shutil
+import time
+import unicodedata
+from pathlib import Path
+
+import numpy as np
+
+from storage import write_corpus
+
+MANIFEST_FILE = "index_manifest.json"
+KEYS_FILE = "embedding_keys.json"
+VERSION_DIR_PREFIX = "index_v"
+
+
+def normalize_text(text):
+    """Chuẩn hoá Unicode NFC và gộp khoảng trắng (không đổi hoa/thường vì model phân biệt)"""
+    return " ".join(unicodedata.normalize("NFC", str(text)).split())
+
+
+def content_key(text, model_name):
+    return hashlib.sha256(f"{model_name}\n{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+
+def file_sha256(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_manifest(data_dir="data"):
+    path = Path(data_dir) / MANIFEST_FILE
+    if not path.exists():
+        return None
+    return json.loads(path.read_text(encoding="utf-8"))
+
+
+def current_dir(data_dir="data", manifest=None):
+    """
+    Thư mục chứa file của phiên bản index trong manifest (đọc manifest nếu không truyền vào).
+    Bản build cũ (không có "dir" trong manifest) ghi thẳng vào data_dir.
+    """
+    data_dir = Path(data_dir)
+    manifest = manifest if manifest is not None else read_manifest(data_dir)
+    return data_dir / manifest["dir"] if manifest and manifest.get("dir") else data_dir
+
+
+def _version_dirs(data_dir):
+    """(version, path) của các thư mục index_v<N> trong data_dir"""
+    out = []
+    for path in Path(data_dir).glob(f"{VERSION_DIR_PREFIX}*"):
+        suffix = path.name[len(VERSION_DIR_PREFIX):]
+        if path.is_dir() and suffix.isdigit():
+            out.append((int(suffix), path))
+    return sorted(out)
+
+
+def staging_dir(data_dir="data", clean=False):
+    """
+    Thư mục tạm của phiên bản đang build (đổi tên thành index_v<N> khi xong).
+    Người build có thể ghi trước file lớn vào đây (vd embeddings.npy memory-mapped) để khỏi phải chuyển file.
+    clean: xoá file còn sót của lần build bị dừng giữa chừng.
+    """
+    path = Path(data_dir) / f".staging-{os.getpid()}"
+    if clean:
+        shutil.rmtree(path, ignore_errors=True)
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def _npy_shape(path):
+    """Shape của file .npy đọc từ header (không map file)"""
+    with open(path, "rb") as f:
+        version = np.lib.format.read_magic(f)
+        read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+        return read_header(f)[0]
+
+
+def _fsync_dir(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class EmbeddingStore:
+    """Tra cứu vector của phiên bản index hiện tại theo content key"""
+
+    def __init__(self, data_dir="data"):
+        self.data_dir = Path(data_dir)
+
+    def load_previous(self, model_name):
+        """
+        Returns: (dict key -> số dòng, embeddings mmap) của phiên bản trước,
+        rỗng nếu chưa có hoặc phiên bản trước dùng model khác.
+        """
+        manifest = read_manifest(self.data_dir)
+        version_dir = current_dir(self.data_dir, manifest)
+        keys_path = version_dir / KEYS_FILE
+        emb_path = version_dir / "embeddings.npy"
+        if not manifest or manifest.get("model") != model_name or not keys_path.exists() or not emb_path.exists():
+            return {}, None
+        keys = json.loads(keys_path.read_text(encoding="utf-8"))
+        emb = np.load(emb_path, mmap_mode="r")
+        if len(keys) != emb.shape[0]:
+            return {}, None
+        return {k: i for i, k in enumerate(keys)}, emb
+
+    def embed(self, texts, model_name, encode_fn, out_path=None):
+        """
+        Trả về (keys, embeddings float32, stats) cho `texts`.
+        encode_fn(list_text) chỉ được gọi cho các câu chưa có trong phiên bản trước
+        (mỗi câu trùng nhau chỉ encode 1 lần).
+        out_path: nếu có, embeddings được ghi vào file .npy memory-mapped thay vì giữ trong RAM.
+        """
+        keys = [content_key(t, model_name) for t in texts]
+        previous, prev_emb = self.load_previous(model_name)
+
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in previous and key not in missing:
+                missing[key] = normalize_text(text)
+
+        encoded = None
+        if missing:
+            encoded = encode_fn(list(missing.values()))
+            missing_pos = {key: j for j, key in enumerate(missing)}
+
+        if prev_emb is not None:
+            dim = prev_emb.shape[1]
+        else:
+            dim = encoded.shape[1] if encoded is not None else 0
+        shape = (len(keys), dim)
+        if out_path is not None:
+            emb = np.lib.format.open_memmap(out_path, mode="w+", dtype=np.float32, shape=shape)
+        else:
+            emb = np.empty(shape, dtype=np.float32)
+        for row, key in enumerate(keys):
+            emb[row] = prev_emb[previous[key]] if key in previous else encoded[missing_pos[key]]
+
+        stats = {
+            "rows": len(keys),
+            "reused": sum(1 for k in keys if k in previous),
+            "encoded": len(missing),
+            "dropped": len(set(previous) - set(keys)),
+        }
+        return keys, emb, stats
+
+
+def write_index_version(data_dir, questions, answers, emb, keys, manifest, extra_writers=()):
+    """
+    Ghi 1 phiên bản index mới vào data_dir/index_v<N>/: corpus (corpus.parquet, hoặc
+    questions.json + answers.json nếu không có pyarrow), embeddings.npy, embedding_keys.json,
+    index_manifest.json (+ các file từ extra_writers: list (tên file, hàm ghi(path)), và các file
+    đã ghi sẵn trong staging_dir(data_dir)).
+    emb: mảng, hoặc đường dẫn file .npy (vd file memory-mapped trong staging_dir). Thư mục tạm chỉ
+    đổi tên được khi không còn ai map file bên trong (Windows), nên người gọi phải bỏ memmap trước.
+    Ghi vào thư mục tạm, đổi tên thành index_v<N>, rồi os.replace data_dir/index_manifest.json
+    để chuyển sang phiên bản mới trong 1 bước.
+    """
+    data_dir = Path(data_dir)
+    staging = staging_dir(data_dir)
+    try:
+        write_corpus(staging, questions, answers)
+        (staging / KEYS_FILE).write_text(json.dumps(keys), encoding="utf-8")
+        emb_path = staging / "embeddings.npy"
+        if isinstance(emb, (str, Path)):
+            if Path(emb).resolve() != emb_path.resolve():
+                shutil.move(str(emb), emb_path)
+            dim = _npy_shape(emb_path)[1]
+        else:
+            np.save(emb_path, emb)
+            dim = emb.shape[1]
+        for name, writer in extra_writers:
+            writer(staging / name)
+
+        previous = read_manifest(data_dir) or {}
+        version = max([previous.get("version", 0)] + [v for v, _ in _version_dirs(data_dir)]) + 1
+        files = sorted(p.name for p in staging.iterdir())
+        manifest = {
+            **manifest,
+            "version": version,
+            "dir": f"{VERSION_DIR_PREFIX}{version}",
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "rows": len(keys),
+            "dim": int(dim),
+            "files": {name: file_sha256(staging / name) for name in files},
+        }
+        manifest_text = json.dumps(manifest, ensure_ascii=False, indent=2)
+        (staging / MANIFEST_FILE).write_text(manifest_text, encoding="utf-8")
+        for name in files + [MANIFEST_FILE]:
+            with open(staging / name, "rb") as f:
+                os.fsync(f.fileno())
+        _fsync_dir(staging)
+
+        # Thư mục mới chưa được manifest nào trỏ tới: đổi tên rồi mới chuyển con trỏ
+        version_dir = data_dir / manifest["dir"]
+        os.replace(staging, version_dir)
+        _fsync_dir(data_dir)
+        tmp_manifest = data_dir / f".{MANIFEST_FILE}.tmp"
+        tmp_manifest.write_text(manifest_text, encoding="utf-8")
+        with open(tmp_manifest, "rb") as f:
+            os.fsync(f.fileno())
+        os.replace(tmp_manifest, data_dir / MANIFEST_FILE)
+        _fsync_dir(data_dir)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+    # Dọn phiên bản cũ: giữ phiên bản ngay trước (người đọc có thể đang nạp dở), xoá các bản cũ hơn
+    keep = {manifest["dir"], previous.get("dir")}
+    for _, path in _version_dirs(data_dir):
+        if path.name not in keep:
+            shutil.rmtree(path, ignore_errors=True)
+    return manifest
@@ -0,0 +1,204 @@
+"""
+Backend encoder cho câu hỏi: PyTorch (SentenceTransformer) hoặc ONNX int8.
+
+Backend ONNX: export model 1 lần ra ONNX, lượng tử hoá động int8 rồi chạy bằng
+onnxruntime + tokenizers, không cần import torch khi chạy (khởi động nhanh hơn).
+Chọn backend bằng biến môi trường ENCODER_BACKEND=torch|onnx.
+
+    python app/encoders.py export   # export + quantize vào models/<tên model>-onnx/
+    python app/encoders.py parity   # so cosine giữa embedding ONNX và PyTorch
+"""
+import argparse
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+
+DEFAULT_MODEL_NAME = "sentence-transformers/paraphrase-multilingual-mpnet-base-v2"
+ENCODER_BACKENDS = ("torch", "onnx")
+
+PARITY_SENTENCES = [
+    "Thủ đô CHXHCN Việt Nam là gì?",
+    "Phạm Văn Đồng giữ chức vụ gì trong bộ máy Nhà nước?",
+    "Sông nào dài nhất Việt Nam?",
+    "Ai là người viết Truyện Kiều?",
+    "Năm 1945 có sự kiện gì quan trọng?",
+    "Hà Nội nằm ở miền nào của Việt Nam?",
+    "Dân số Thành phố Hồ Chí Minh khoảng bao nhiêu người?",
+    "What is the capital of Vietnam?",
+]
+
+
+def default_backend():
+    return os.getenv("ENCODER_BACKEND", "torch").strip().lower()
+
+
+def default_onnx_dir(model_name=DEFAULT_MODEL_NAME):
+    return Path(os.getenv("ONNX_MODEL_DIR", Path("models") / f"{model_name.split('/')[-1]}-onnx"))
+
+
+def encoder_id(model_name, backend):
+    """
+    Tên dùng làm khoá cho kho embedding: vector ONNX int8/float32 khác đôi chút so với PyTorch
+    và khác nhau, nên hậu tố lấy theo model đã export (encoder_config.json).
+    """
+    if backend == "torch":
+        return model_name
+    config_path = default_onnx_dir(model_name) / "encoder_config.json"
+    config = json.loads(config_path.read_text(encoding="utf-8")) if config_path.exists() else {}
+    # Bản export cũ chưa ghi "quantized": suy ra từ file model
+    quantized = config.get("quantized", config.get("model_file", "model_int8.onnx") != "model.onnx")
+    return f"{model_name}@onnx-{'int8' if quantized else 'fp32'}"
+
+
+class OnnxEncoder:
+    """Encoder ONNX có cùng giao diện encode(...) với SentenceTransformer"""
+
+    def __init__(self, model_dir, threads=None):
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+
+        model_dir = Path(model_dir)
+        config = json.loads((model_dir / "encoder_config.json").read_text(encoding="utf-8"))
+        self.max_seq_length = config["max_seq_length"]
+        self.tokenizer = Tokenizer.from_file(str(model_dir / "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=self.max_seq_length)
+        self.tokenizer.enable_padding(pad_id=config["pad_token_id"], pad_token=config["pad_token"])
+
+        options = ort.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(
+            str(model_dir / config["model_file"]), options, providers=["CPUExecutionProvider"]
+        )
+        self.input_names = {i.name for i in self.session.get_inputs()}
+
+    def encode(self, sentences, batch_size=32, normalize_embeddings=True, convert_to_numpy=True, **_):
+        single = isinstance(sentences, str)
+        if single:
+            sentences = [sentences]
+        outputs = []
+        for i in range(0, len(sentences), batch_size):
+            encodings = self.tokenizer.encode_batch(list(sentences[i:i + batch_size]))
+            input_ids = np.array([e.ids for e in encodings], dtype=np.int64)
+            attention_mask = np.array([e.attention_mask for e in encodings], dtype=np.int64)
+            feed = {"input_ids": input_ids, "attention_mask": attention_mask}
+            if "token_type_ids" in self.input_names:
+                feed["token_type_ids"] = np.zeros_like(input_ids)
+            hidden = self.session.run(None, feed)[0]
+            # Mean pooling theo attention mask (giống cấu hình pooling của model gốc)
+            mask = attention_mask[:, :, None].astype(np.float32)
+            pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            if normalize_embeddings:
+                pooled = pooled / np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+            outputs.append(pooled.astype(np.float32))
+        emb = np.concatenate(outputs) if outputs else np.empty((0, 0), dtype=np.float32)
+        return emb[0] if single else emb
+
+
+def load_encoder(model_name=DEFAULT_MODEL_NAME, backend=None, threads=None):
+    """Tạo encoder theo backend ('torch' hoặc 'onnx')"""
+    backend = backend or default_backend()
+    if backend not in ENCODER_BACKENDS:
+        raise ValueError(f"Encoder backend không hợp lệ: {backend} (chọn {ENCODER_BACKENDS})")
+    if backend == "onnx":
+        model_dir = default_onnx_dir(model_name)
+        if not (model_dir / "encoder_config.json").exists():
+            raise FileNotFoundError(
+                f"Chưa có model ONNX tại {model_dir}. Hãy chạy: python app/encoders.py export"
+            )
+        return OnnxEncoder(model_dir, threads=threads)
+
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    if threads:
+        torch.set_num_threads(threads)
+    return SentenceTransformer(model_name, device="cpu")
+
+
+def export_onnx(model_name=DEFAULT_MODEL_NAME, out_dir=None, quantize=True):
+    """Export transformer của SentenceTransformer ra ONNX (+ bản int8 lượng tử hoá động)"""
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    out_dir = Path(out_dir or default_onnx_dir(model_name))
+    out_dir.mkdir(parents=True, exist_ok=True)
+    st_model = SentenceTransformer(model_name, device="cpu")
+    pooling = st_model[1].get_config_dict()
+    if not pooling.get("pooling_mode_mean_tokens"):
+        raise ValueError("Chỉ hỗ trợ model dùng mean pooling")
+
+    transformer = st_model[0].auto_model.eval()
+    tokenizer = st_model.tokenizer
+    tokenizer.save_pretrained(str(out_dir))
+    dummy = tokenizer(["xin chào"], return_tensors="pt")
+
+    fp32_path = out_dir / "model.onnx"
+    with torch.no_grad():
+        torch.onnx.export(
+            transformer,
+            (dummy["input_ids"], dummy["attention_mask"]),
+            str(fp32_path),
+            input_names=["input_ids", "attention_mask"],
+            output_names=["last_hidden_state"],
+            dynamic_axes={
+                "input_ids": {0: "batch", 1: "seq"},
+                "attention_mask": {0: "batch", 1: "seq"},
+                "last_hidden_state": {0: "batch", 1: "seq"},
+            },
+            opset_version=14,
+        )
+
+    model_file = fp32_path.name
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        int8_path = out_dir / "model_int8.onnx"
+        quantize_dynamic(str(fp32_path), str(int8_path), weight_type=QuantType.QInt8)
+        model_file = int8_path.name
+
+    config = {
+        "model_name": model_name,
+        "model_file": model_file,
+        "quantized": quantize,
+        "max_seq_length": st_model.max_seq_length,
+        "pad_token": tokenizer.pad_token,
+        "pad_token_id": tokenizer.pad_token_id,
+    }
+    (out_dir / "encoder_config.json").write_text(json.dumps(config, indent=2), encoding="utf-8")
+    return out_dir
+
+
+def parity_check(model_name=DEFAULT_MODEL_NAME, sentences=PARITY_SENTENCES):
+    """Cosine giữa embedding ONNX và PyTorch trên cùng các câu (đã chuẩn hoá)"""
+    reference = load_encoder(model_name, "torch").encode(sentences, normalize_embeddings=True)
+    candidate = load_encoder(model_name, "onnx").encode(sentences, normalize_embeddings=True)
+    cosine = np.sum(np.asarray(reference) * candidate, axis=1)
+    return {"min": float(cosine.min()), "mean": float(cosine.mean()), "n": len(sentences)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export / kiểm tra encoder ONNX int8")
+    parser.add_argument("command", choices=["export", "parity"])
+    parser.add_argument("--model", default=DEFAULT_MODEL_NAME)
+    parser.add_argument("--no-quantize", action="store_true", help="Chỉ export ONNX float32")
+    parser.add_argument("--min-cosine", type=float, default=0.99, help="[parity] Ngưỡng cosine tối thiểu")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        out_dir = export_onnx(args.model, quantize=not args.no_quantize)
+        print(f"✅ Đã export ONNX vào {out_dir}")
+        args.command = "parity"
+
+    result = parity_check(args.model)
+    print(f"📐 Cosine ONNX vs PyTorch trên {result['n']} câu: min={result['min']:.4f}, mean={result['mean']:.4f}")
+    if result["min"] < args.min_cosine:
+        print(f"❌ Thấp hơn ngưỡng {args.min_cosine}")
+        raise SystemExit(1)
+    print("✅ Đạt ngưỡng parity")
+
+
+if __name__ == "__main__":
+    main()
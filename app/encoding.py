@@ -0,0 +1,97 @@
+"""
+Encode corpus lớn trên CPU bằng nhiều process.
+
+- Câu được sắp theo độ dài rồi chia batch, nên mỗi batch gồm các câu dài gần
+  bằng nhau và padding ít nhất.
+- Mỗi worker nạp model 1 lần và dùng cpu_count/workers thread (torch hoặc onnxruntime).
+- Kết quả được ghi ngay vào file .npy memory-mapped theo đúng vị trí ban đầu,
+  flush theo từng chunk, nên bộ nhớ không tăng theo kích thước corpus.
+"""
+import multiprocessing as mp
+import os
+import time
+
+import numpy as np
+from tqdm import tqdm
+
+from encoders import load_encoder
+
+_worker_model = None
+
+
+def length_sorted_batches(texts, batch_size):
+    """Chia chỉ số câu thành các batch theo thứ tự độ dài giảm dần"""
+    order = np.argsort([-len(t) for t in texts], kind="stable")
+    return [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+
+
+def default_workers():
+    return max(1, min(4, (os.cpu_count() or 1) // 2))
+
+
+def _init_worker(model_name, backend, threads):
+    global _worker_model
+    _worker_model = load_encoder(model_name, backend, threads=threads)
+
+
+def _encode_batch(task):
+    idx, texts = task
+    vectors = _worker_model.encode(
+        texts, batch_size=len(texts), normalize_embeddings=True, convert_to_numpy=True
+    )
+    return idx, np.asarray(vectors, dtype=np.float32)
+
+
+def encode_corpus(texts, model_name, batch_size=64, workers=None, out_path=None, chunk_rows=8192, backend="torch"):
+    """
+    Encode `texts` (embedding đã chuẩn hoá, float32) bằng backend 'torch' hoặc 'onnx'.
+    out_path: nếu có, kết quả được ghi thẳng vào file .npy memory-mapped và trả về memmap.
+    Returns: (embeddings, stats) với stats gồm rows, seconds, rows_per_sec.
+    """
+    workers = workers or default_workers()
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    batches = length_sorted_batches(texts, batch_size)
+    tasks = ((idx, [texts[i] for i in idx]) for idx in batches)
+
+    start = time.perf_counter()
+    if workers == 1:
+        _init_worker(model_name, backend, threads)
+        results = map(_encode_batch, tasks)
+        pool = None
+    else:
+        pool = mp.get_context("spawn").Pool(workers, initializer=_init_worker, initargs=(model_name, backend, threads))
+        results = pool.imap_unordered(_encode_batch, tasks)
+
+    out = None
+    since_flush = 0
+    try:
+        for idx, vectors in tqdm(results, total=len(batches), desc="   -> Encode", unit="batch"):
+            if out is None:
+                shape = (len(texts), vectors.shape[1])
+                if out_path is not None:
+                    out = np.lib.format.open_memmap(out_path, mode="w+", dtype=np.float32, shape=shape)
+                else:
+                    out = np.empty(shape, dtype=np.float32)
+            out[idx] = vectors
+            since_flush += len(idx)
+            if isinstance(out, np.memmap) and since_flush >= chunk_rows:
+                out.flush()
+                since_flush = 0
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    if out is None:
+        out = np.empty((0, 0), dtype=np.float32)
+    elif isinstance(out, np.memmap):
+        out.flush()
+    seconds = time.perf_counter() - start
+    stats = {
+        "rows": len(texts),
+        "workers": workers,
+        "batch_size": batch_size,
+        "seconds": seconds,
+        "rows_per_sec": len(texts) / seconds if seconds > 0 else 0.0,
+    }
+    return out, stats
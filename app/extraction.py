@@ -0,0 +1,114 @@
+"""
+Trích câu trả lời cuối cùng (Bước 3) từ output self-critique.
+Tách khỏi gemini.py để dùng chung (benchmark, chấm lại) mà không phải khởi tạo model.
+"""
+import re
+
+
+def extract_final_answer(critique_text):
+    """
+    Trích xuất câu trả lời cuối cùng từ Bước 3 trong self-critique output
+    """
+    # Regex tìm "Bước 3" (hoặc biến thể) và lấy nội dung sau nó
+    patterns = [
+        # Match 'Bước 3: [nội dung]'
+        r'\*\*Bước 3[:\s]+.*?\*\*[:\s]*(.*?)(?=\n\n|\n\*\*\s*Bước|\Z)', 
+        # Match 'Câu trả lời cuối cùng: [nội dung]'
+        r'Câu trả lời cuối cùng[:\s]*\*\*[:\s]*(.*?)(?=\n\n|\n\*\*\s*Bước|\Z)',
+        # Match 'Bước 3' không có **
+        r'Bước 3[:\s]+(.*?)(?=\n\n|\nBước|\Z)'
+    ]
+    
+    for pattern in patterns:
+        match = re.search(pattern, critique_text, re.DOTALL | re.IGNORECASE)
+        if match:
+            answer = match.group(1).strip()
+            # Loại bỏ các ký tự đặc biệt đầu/cuối
+            answer = answer.strip('*[](){}_- ')
+            if answer: # Đảm bảo không phải string rỗng
+                return answer
+    
+    # Fallback: Nếu không tìm thấy, cố gắng lấy dòng cuối cùng
+    last_line = critique_text.split('\n')[-1].strip().strip('*[](){}_- ')
+    if last_line:
+        return last_line
+        
+    return critique_text.strip() # Fallback cuối cùng
+
+
+_STEP3 = re.compile(r"Bước 3", re.IGNORECASE)
+_STEP3_END = re.compile(r"\n\n|\n\*\*\s*Bước|\nBước", re.IGNORECASE)
+_ANSWER_STRIP = '*[](){}_- '
+
+
+class Step3Parser:
+    """
+    Trích câu trả lời Bước 3 trong lúc output đang được stream, quét mỗi ký tự đúng 1 lần
+    (extract_final_answer thì chờ đủ output rồi chạy lại từ đầu cho từng regex).
+
+        parser = Step3Parser()
+        for chunk in stream:
+            if parser.feed(chunk):   # True ngay khi Bước 3 đã kết thúc
+                break                # có thể huỷ phần generation còn lại
+        answer = parser.close()
+
+    Cùng quy tắc với extract_final_answer: nội dung Bước 3 bắt đầu sau tiêu đề ("**Bước 3: ...**"
+    hoặc "Bước 3:") và kết thúc ở dòng trống, ở bước tiếp theo hoặc ở cuối output.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.final_answer = None
+        self.done = False
+        self._scan = 0           # vị trí đã quét tới (không quét lại phần trước đó)
+        self._header = None      # match "Bước 3"
+        self._content = None     # vị trí bắt đầu nội dung Bước 3
+
+    def feed(self, chunk):
+        """Thêm 1 đoạn output. Returns: True khi đã có câu trả lời cuối cùng"""
+        self.text += chunk
+        if self.done:
+            return True
+        text = self.text
+        if self._header is None:
+            # Lùi lại vài ký tự để không bỏ sót "Bước 3" bị cắt giữa 2 chunk
+            self._header = _STEP3.search(text, max(0, self._scan - 6))
+            if self._header is None:
+                self._scan = len(text)
+                return False
+            self._scan = self._header.end()
+        if self._content is None:
+            start = self._header.end()
+            if text[max(0, self._header.start() - 2):self._header.start()] == "**":
+                # Tiêu đề in đậm: nội dung bắt đầu sau dấu ** đóng
+                close = text.find("**", start)
+                if close < 0:
+                    return False
+                start = close + 2
+            while start < len(text) and (text[start] == ":" or text[start].isspace()):
+                start += 1
+            if start >= len(text):
+                return False
+            self._content = self._scan = start
+        end = _STEP3_END.search(text, max(self._content, self._scan - 6))
+        if end is None:
+            self._scan = len(text)
+            return False
+        answer = text[self._content:end.start()].strip().strip(_ANSWER_STRIP)
+        if not answer:
+            self._scan = end.end()
+            return False
+        self.final_answer = answer
+        self.done = True
+        return True
+
+    def close(self):
+        """Kết thúc stream. Returns: câu trả lời cuối cùng (không tìm được Bước 3 thì dùng extract_final_answer)"""
+        if not self.done:
+            if self._content is not None:
+                answer = self.text[self._content:].strip().strip(_ANSWER_STRIP)
+                self.final_answer = answer or extract_final_answer(self.text)
+            else:
+                self.final_answer = extract_final_answer(self.text)
+            self.done = True
+        return self.final_answer
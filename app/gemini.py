@@ -1,12 +1,23 @@
 import google.generativeai as genai
-import os, json, re
-import pandas as pd
+import os, json, time
 import numpy as np
 from dotenv import load_dotenv
 from pathlib import Path
 from tqdm import tqdm
-from difflib import SequenceMatcher # Để đánh giá độ tương đồng
 import glob # Để tìm file benchmark
+from runner import ConcurrentRunner, RateLimiter, estimate_tokens, get_retry_policy
+from llm_cache import get_default_cache
+from llm_calls import gemini_generate, gemini_generate_stream, stream_answer
+from llm_tracing import format_stream_times, get_tracer, write_run_report
+from checkpoint import ResultLog
+from storage import find_tables, read_table, table_path, write_table
+from dedup import DEFAULT_THRESHOLD as DEDUP_THRESHOLD, canonical_question_map, dedup_tables, summarize
+import scoring
+from scoring import failed_rows, sequence_ratio
+from extraction import extract_final_answer
+from prompts import get_baseline_prompt, get_critique_prompt
+from sequential import SequentialComparison
+from packing import PackStats, answer_pack, response_schema
 
 # --- 1. CẤU HÌNH ---
 load_dotenv()
@@ -16,14 +27,44 @@ if not GEMINI_API_KEY:
     print("Không tìm thấy GEMINI_API_KEY trong file .env")
     exit()
 
+# Trỏ sang server khác (vd mock_llm_server.py để đo throughput offline): dùng REST transport
+GEMINI_BASE_URL = os.getenv("GEMINI_BASE_URL", "").strip()
+GEMINI_CLIENT_OPTIONS = (
+    {"transport": "rest", "client_options": {"api_endpoint": GEMINI_BASE_URL}} if GEMINI_BASE_URL else {}
+)
+
 try:
-    genai.configure(api_key=GEMINI_API_KEY)
+    genai.configure(api_key=GEMINI_API_KEY, **GEMINI_CLIENT_OPTIONS)
 except Exception as e:
     print(f"Lỗi cấu hình Gemini: {e}")
     exit()
 
+# Giới hạn chạy song song (0 = không giới hạn RPM/TPM)
+MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "8"))
+REQUESTS_PER_MINUTE = int(os.getenv("GEMINI_RPM", "0"))
+TOKENS_PER_MINUTE = int(os.getenv("GEMINI_TPM", "0"))
+
+# Gộp K câu hỏi vào 1 request với output JSON theo schema (xem packing.py). 1 = mỗi câu 1 request như cũ
+PACK_SIZE = int(os.getenv("GEMINI_PACK_SIZE", "1"))
+
+# Stream output: đo thời gian tới token đầu tiên (TTFT) và lấy câu trả lời Bước 3 ngay khi nó kết thúc.
+# GEMINI_STREAM_CANCEL=1: dừng generation của Self-Critique sau Bước 3 (critique_answer_full chỉ tới đó).
+# Bỏ qua khi GEMINI_PACK_SIZE > 1 (output JSON chỉ dùng được khi đã nhận đủ)
+STREAM = os.getenv("GEMINI_STREAM", "0") == "1" and PACK_SIZE <= 1
+STREAM_CANCEL = STREAM and os.getenv("GEMINI_STREAM_CANCEL", "0") == "1"
+
+# Chế độ dừng sớm (xem sequential.py): xáo trộn dòng, kiểm định tuần tự Baseline vs Self-Critique
+# và dừng khi đã có kết luận. SEQUENTIAL_ALPHA=0 (mặc định) = chạy hết mọi dòng như cũ
+SEQUENTIAL_ALPHA = float(os.getenv("SEQUENTIAL_ALPHA", "0"))
+SEQUENTIAL_PRECISION = float(os.getenv("SEQUENTIAL_PRECISION", "0"))  # dừng khi CI chênh lệch < ±precision
+SEQUENTIAL_MIN_ROWS = int(os.getenv("SEQUENTIAL_MIN_ROWS", "100"))
+SEQUENTIAL_CHECK_EVERY = int(os.getenv("SEQUENTIAL_CHECK_EVERY", "50"))
+SEQUENTIAL_SEED = int(os.getenv("SEQUENTIAL_SEED", "0"))
+
 # Cấu hình model (dùng cho cả 2 prompt)
-config = genai.types.GenerationConfig(temperature=0.0)
+MODEL_NAME = 'gemini-1.5-pro-latest'
+GENERATION_CONFIG = {"temperature": 0.0}
+config = genai.types.GenerationConfig(**GENERATION_CONFIG)
 
 # Safety settings - (Giữ nguyên format đúng của bạn)
 safety = [
@@ -33,184 +74,322 @@ safety = [
     {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"}
 ]
 
-print("Đang khởi tạo model 'gemini-1.5-pro-latest'...")
+print(f"Đang khởi tạo model '{MODEL_NAME}'...")
 model = genai.GenerativeModel(
-    'gemini-1.5-pro-latest', # THAY ĐỔI: Dùng 1.5 Pro cho mạnh mẽ hơn
+    MODEL_NAME, # THAY ĐỔI: Dùng 1.5 Pro cho mạnh mẽ hơn
     generation_config=config,
     safety_settings=safety
 )
 print("Model đã sẵn sàng.")
 
-# --- 2. CÁC HÀM HELPERS (Giữ nguyên logic của bạn) ---
-
-def get_baseline_prompt(question):
-    """Trả về prompt đơn giản"""
-    return f"Hãy trả lời câu hỏi sau một cách ngắn gọn và chính xác: {question}"
-
-def get_critique_prompt(question):
-    """Trả về prompt tự phản biện 3 bước"""
-    return f"""
-Bạn là một trợ lý AI cẩn trọng, luôn kiểm tra lại thông tin.
-Nhiệm vụ của bạn là trả lời câu hỏi sau bằng quy trình 3 bước.
-
-Câu hỏi: {question}
-
----
-[BẮT ĐẦU QUY TRÌNH]
+# Mô tả đầy đủ request để làm khoá cho LLM cache
+MODEL_REQUEST = {
+    "model": MODEL_NAME,
+    "generation_config": GENERATION_CONFIG,
+    "safety_settings": safety,
+}
 
-**Bước 1: Câu trả lời ban đầu:**
-[Hãy tạo câu trả lời ban đầu của bạn ở đây]
+# Retry 429/5xx/timeout có backoff, số request đồng thời tự điều chỉnh (AIMD) trong [1, MAX_CONCURRENCY].
+# Dùng chung cho mọi lời gọi tới model này trong process (xem runner.get_retry_policy)
+RETRY_POLICY = get_retry_policy(f"gemini/{MODEL_NAME}", MAX_CONCURRENCY)
 
-**Bước 2: Tự phản biện:**
-[Hãy xem xét lại câu trả lời ở Bước 1. Nó có chính xác không? Có "hallucinate" điểm nào không? Có thể cải thiện ở đâu?]
-
-**Bước 3: Câu trả lời cuối cùng (đã xác minh):**
-[Dựa trên phản biện ở Bước 2, hãy đưa ra câu trả lời cuối cùng, chính xác nhất.]
-"""
-
-def extract_final_answer(critique_text):
-    """
-    Trích xuất câu trả lời cuối cùng từ Bước 3 trong self-critique output
-    """
-    # Regex tìm "Bước 3" (hoặc biến thể) và lấy nội dung sau nó
-    patterns = [
-        # Match 'Bước 3: [nội dung]'
-        r'\*\*Bước 3[:\s]+.*?\*\*[:\s]*(.*?)(?=\n\n|\n\*\*\s*Bước|\Z)', 
-        # Match 'Câu trả lời cuối cùng: [nội dung]'
-        r'Câu trả lời cuối cùng[:\s]*\*\*[:\s]*(.*?)(?=\n\n|\n\*\*\s*Bước|\Z)',
-        # Match 'Bước 3' không có **
-        r'Bước 3[:\s]+(.*?)(?=\n\n|\nBước|\Z)'
-    ]
-    
-    for pattern in patterns:
-        match = re.search(pattern, critique_text, re.DOTALL | re.IGNORECASE)
-        if match:
-            answer = match.group(1).strip()
-            # Loại bỏ các ký tự đặc biệt đầu/cuối
-            answer = answer.strip('*[](){}_- ')
-            if answer: # Đảm bảo không phải string rỗng
-                return answer
-    
-    # Fallback: Nếu không tìm thấy, cố gắng lấy dòng cuối cùng
-    last_line = critique_text.split('\n')[-1].strip().strip('*[](){}_- ')
-    if last_line:
-        return last_line
-        
-    return critique_text.strip() # Fallback cuối cùng
+# --- 2. CÁC HÀM HELPERS (Giữ nguyên logic của bạn) ---
+# Prompt Baseline / Self-Critique: get_baseline_prompt, get_critique_prompt trong prompts.py
 
 def calculate_similarity(text1, text2):
     """
     Tính độ tương đồng giữa 2 string (0-1)
     """
-    return SequenceMatcher(None, str(text1).lower(), str(text2).lower()).ratio()
+    return sequence_ratio((str(text1).lower(), str(text2).lower()))
 
 def evaluate_answer(predicted, ground_truth, threshold=0.6):
     """
     Đánh giá câu trả lời dự đoán so với ground truth
     Returns: (is_correct, similarity_score)
+    Chấm lại cả file với nhiều ngưỡng: xem score_batch trong scoring.py
     """
-    # Xử lý trường hợp predicted hoặc ground_truth là None
-    predicted_str = str(predicted).lower().strip()
-    ground_truth_str = str(ground_truth).lower().strip()
+    return scoring.evaluate_answer(predicted, ground_truth, threshold)
 
-    if not predicted_str or not ground_truth_str:
-        return False, 0.0
+def generate(prompt, attempt=1, generation_config=None):
+    """
+    Gọi model 1 lần (raise nếu lỗi). attempt: lần thử thứ mấy, do RetryPolicy truyền vào.
+    Chạy qua ConcurrentRunner(retry=RETRY_POLICY) thì nhận về (text, error) - một trong hai là None.
+    """
+    return gemini_generate(model, prompt, MODEL_REQUEST, attempt=attempt, generation_config=generation_config).strip()
 
-    # Exact match (case-insensitive)
-    if predicted_str == ground_truth_str:
-        return True, 1.0
-    
-    # Partial match với similarity
-    sim = calculate_similarity(predicted_str, ground_truth_str)
-    is_correct = sim >= threshold
-    
-    return is_correct, sim
+def generate_streamed(task, attempt=1):
+    """
+    task = (kind, prompt), kind là "baseline" hoặc "critique". Gọi model ở chế độ stream;
+    với Self-Critique thì câu trả lời Bước 3 được trích trong lúc stream (xem stream_answer).
+    Returns: (text, dict ttft_seconds [+ final_answer, final_seconds với critique])
+    """
+    kind, prompt = task
+    return stream_answer(
+        lambda **stream: gemini_generate_stream(model, prompt, MODEL_REQUEST, attempt=attempt, **stream),
+        critique=kind == "critique",
+        cancel=STREAM_CANCEL,
+    )
+
+PACK_STATS = PackStats()
+
+def generate_pack(task, rate_limiter):
+    """
+    task = (kind, list câu hỏi): 1 request gộp (JSON mode + schema khoá theo ID câu hỏi),
+    câu thiếu/hỏng thì gọi lại riêng. Mỗi lời gọi đều qua RETRY_POLICY và rate_limiter.
+    Returns: list (text, error) theo thứ tự câu hỏi.
+    """
+    kind, questions = task
+
+    def call(prompt, generation_config=None):
+        return RETRY_POLICY.call(
+            lambda attempt: generate(prompt, attempt, generation_config),
+            lambda: rate_limiter.acquire(estimate_tokens(prompt)),
+        )
+
+    single_prompt = get_baseline_prompt if kind == "baseline" else get_critique_prompt
+    return answer_pack(
+        kind,
+        questions,
+        call_packed=lambda prompt, ids: call(prompt, {
+            "response_mime_type": "application/json",
+            "response_schema": response_schema(kind, ids),
+        }),
+        call_single=lambda question: call(single_prompt(question)),
+        stats=PACK_STATS,
+    )
 
 # --- 3. HÀM CHẠY THÍ NGHIỆM CHÍNH ---
 
-def run_and_evaluate_dataset(benchmark_path, similarity_threshold=0.6):
+def run_and_evaluate_dataset(benchmark_path, similarity_threshold=0.6, canonical=None):
     """
     Hàm chính: Đọc 1 file benchmark, chạy, đánh giá, và in báo cáo.
+    canonical: dict row_id -> câu hỏi đại diện của cụm (xem dedup.py). Các câu trong cùng cụm
+    chỉ gọi API 1 lần, kết quả được dùng lại cho từng dòng (mỗi dòng vẫn chấm với ground truth riêng).
     """
     
-    dataset_name = benchmark_path.stem.replace("benchmark_", "")
+    dataset_name = benchmark_path.with_suffix("").name.replace("benchmark_", "")
     print("\n" + "="*70)
     print(f"📊 BẮT ĐẦU THÍ NGHIỆM VỚI DATASET: {dataset_name.upper()}")
     print("="*70)
 
-    # Đọc benchmark CSV
+    # Đọc bảng benchmark (Parquet hoặc CSV), chỉ 2 cột cần dùng
     try:
-        benchmark_df = pd.read_csv(benchmark_path)
+        benchmark_df = read_table(benchmark_path, columns=["question", "ground_truth"])
     except Exception as e:
         print(f"❌ Lỗi khi đọc file {benchmark_path}: {e}")
         return
 
-    results = [] # Nơi lưu trữ tất cả kết quả
-    
+    # Log JSONL: mỗi dòng được ghi ngay khi chạy xong, chạy lại sẽ bỏ qua các dòng đã có.
+    # Dòng bị lỗi (hết lần retry) được chạy lại, bản ghi mới sẽ thay bản ghi lỗi
+    output_log_file = Path("results") / f"results_{dataset_name}.jsonl"
+    result_log = ResultLog(output_log_file)
+    completed = {
+        record["row_id"]: record for record in result_log.iter_records()
+        if not record.get("baseline_failed") and not record.get("critique_failed")
+    }
+    done = set(completed)
+
+    # Chế độ dừng sớm: chạy theo thứ tự ngẫu nhiên (cố định theo seed để chạy tiếp vẫn đúng thứ tự),
+    # các dòng đã có trong log được đưa vào kiểm định trước
+    sequential = None
+    if SEQUENTIAL_ALPHA > 0:
+        sequential = SequentialComparison(
+            alpha=SEQUENTIAL_ALPHA,
+            precision=SEQUENTIAL_PRECISION or None,
+            min_rows=SEQUENTIAL_MIN_ROWS,
+            check_every=SEQUENTIAL_CHECK_EVERY,
+        )
+        benchmark_df = benchmark_df.sample(frac=1, random_state=SEQUENTIAL_SEED)
+        for row_id in benchmark_df.index:
+            if row_id in completed:
+                sequential.update(completed[row_id]["baseline_correct"], completed[row_id]["critique_correct"])
+        if done:
+            sequential.check()
+
+    todo_df = benchmark_df[~benchmark_df.index.isin(done)]
+    if done:
+        print(f"↩️  Tiếp tục từ log: đã có {len(done)} dòng, còn {len(todo_df)} dòng cần chạy.")
+
+    # Mỗi cụm câu hỏi (theo thứ tự xuất hiện đầu tiên) sinh 2 prompt (Baseline, Self-Critique)
+    # xếp xen kẽ nhau. Tất cả được gửi song song qua runner, kết quả trả về đúng thứ tự.
+    # Cụm đã chạy ở dataset trước sẽ trúng LLM cache (cùng prompt).
+    if canonical is None:
+        canonical = dict(zip(benchmark_df.index, benchmark_df["question"]))
+    todo_questions = [canonical.get(row_id, q) for row_id, q in zip(todo_df.index, todo_df["question"])]
+    unique_questions = list(dict.fromkeys(todo_questions))
+    if len(unique_questions) < len(todo_questions):
+        print(f"🧬 {len(todo_questions)} dòng thuộc {len(unique_questions)} cụm câu hỏi, chỉ gọi API 1 lần mỗi cụm.")
+    if PACK_SIZE > 1:
+        # Mỗi task là 1 request gộp PACK_SIZE câu: (Baseline, nhóm 1), (Self-Critique, nhóm 1), (Baseline, nhóm 2)...
+        tasks = []
+        for start in range(0, len(unique_questions), PACK_SIZE):
+            pack = unique_questions[start:start + PACK_SIZE]
+            tasks += [("baseline", pack), ("critique", pack)]
+        rate_limiter = RateLimiter(rpm=REQUESTS_PER_MINUTE, tpm=TOKENS_PER_MINUTE)
+        runner = ConcurrentRunner(max_workers=MAX_CONCURRENCY)
+        outputs = runner.map(lambda task: generate_pack(task, rate_limiter), tasks)
+        # Tách lại thành từng cặp (Baseline, Self-Critique) theo thứ tự unique_questions
+        output_pairs = (pair for out_bl, out_sc in zip(outputs, outputs) for pair in zip(out_bl, out_sc))
+    elif STREAM:
+        tasks = []
+        for q in unique_questions:
+            tasks.append(("baseline", get_baseline_prompt(q)))
+            tasks.append(("critique", get_critique_prompt(q)))
+        runner = ConcurrentRunner(
+            max_workers=MAX_CONCURRENCY,
+            rpm=REQUESTS_PER_MINUTE,
+            tpm=TOKENS_PER_MINUTE,
+            retry=RETRY_POLICY,
+        )
+        outputs = runner.map(generate_streamed, tasks, cost=lambda task: estimate_tokens(task[1]))
+        output_pairs = zip(outputs, outputs)
+    else:
+        tasks = []
+        for q in unique_questions:
+            tasks.append(get_baseline_prompt(q))
+            tasks.append(get_critique_prompt(q))
+        runner = ConcurrentRunner(
+            max_workers=MAX_CONCURRENCY,
+            rpm=REQUESTS_PER_MINUTE,
+            tpm=TOKENS_PER_MINUTE,
+            retry=RETRY_POLICY,
+        )
+        outputs = runner.map(generate, tasks, cost=estimate_tokens)
+        # zip(outputs, outputs) lấy lần lượt từng cặp Baseline/Self-Critique từ cùng 1 generator
+        output_pairs = zip(outputs, outputs)
+    answered = {}
+    rows_run = 0
+    stream_rows = []
+
     # Chạy qua từng hàng trong file benchmark
-    for _, item in tqdm(benchmark_df.iterrows(), total=len(benchmark_df), desc=f"   -> Đang chạy {dataset_name}"):
-        q = item["question"]
-        gt = item["ground_truth"]
-        
-        # 1. Chạy Baseline
-        try:
-            prompt_bl = get_baseline_prompt(q)
-            response_bl = model.generate_content(prompt_bl)
-            answer_bl = response_bl.text.strip()
-        except Exception as e:
-            answer_bl = f"[LỖI: {e}]"
-
-        # 2. Chạy Self-Critique
-        try:
-            prompt_sc = get_critique_prompt(q)
-            response_sc = model.generate_content(prompt_sc)
-            answer_sc_full = response_sc.text.strip() # Toàn bộ output
-            answer_sc_final = extract_final_answer(answer_sc_full) # Chỉ lấy câu trả lời cuối
-        except Exception as e:
-            answer_sc_full = f"[LỖI: {e}]"
-            answer_sc_final = f"[LỖI: {e}]"
-
-        # 3. Đánh giá cả 2 phương pháp
-        bl_correct, bl_sim = evaluate_answer(answer_bl, gt, similarity_threshold)
-        sc_correct, sc_sim = evaluate_answer(answer_sc_final, gt, similarity_threshold)
-
-        # 4. Lưu kết quả
-        results.append({
-            "question": q,
-            "ground_truth": gt,
-            "baseline_answer": answer_bl,
-            "baseline_correct": bl_correct,
-            "baseline_similarity": bl_sim,
-            "critique_answer_full": answer_sc_full,
-            "critique_answer_final": answer_sc_final,
-            "critique_correct": sc_correct,
-            "critique_similarity": sc_sim
-        })
+    run_start = time.perf_counter()
+    with result_log:
+        for (row_id, item), canonical_q in tqdm(
+            zip(todo_df.iterrows(), todo_questions),
+            total=len(todo_df),
+            desc=f"   -> Đang chạy {dataset_name}",
+        ):
+            # Đã đủ kết luận từ các dòng trong log: không gửi thêm prompt nào
+            if sequential is not None and sequential.decision:
+                break
+            # Cụm gặp lần đầu thì lấy cặp kết quả tiếp theo (đúng thứ tự unique_questions)
+            if canonical_q not in answered:
+                answered[canonical_q] = next(output_pairs)
+            out_bl, out_sc = answered[canonical_q]
+            q = item["question"]
+            gt = item["ground_truth"]
+
+            # 1. Kết quả Baseline
+            answer_bl, err_bl = out_bl
+            stream_bl, stream_sc = {}, {}
+            if err_bl is not None:
+                answer_bl = f"[LỖI: {err_bl}]"
+            elif STREAM:
+                answer_bl, stream_bl = answer_bl
+
+            # 2. Kết quả Self-Critique
+            answer_sc_full, err_sc = out_sc
+            if err_sc is not None:
+                answer_sc_full = f"[LỖI: {err_sc}]"
+                answer_sc_final = f"[LỖI: {err_sc}]"
+            elif STREAM:
+                # Câu trả lời Bước 3 đã được trích trong lúc stream
+                answer_sc_full, stream_sc = answer_sc_full
+                answer_sc_final = stream_sc["final_answer"]
+            else:
+                answer_sc_final = extract_final_answer(answer_sc_full) # Chỉ lấy câu trả lời cuối
+
+            # 3. Đánh giá cả 2 phương pháp
+            bl_correct, bl_sim = evaluate_answer(answer_bl, gt, similarity_threshold)
+            sc_correct, sc_sim = evaluate_answer(answer_sc_final, gt, similarity_threshold)
+
+            # 4. Ghi kết quả xuống log ngay
+            stream_times = {}
+            if STREAM:
+                stream_times = {
+                    "baseline_ttft_seconds": stream_bl.get("ttft_seconds"),
+                    "critique_ttft_seconds": stream_sc.get("ttft_seconds"),
+                    "critique_final_seconds": stream_sc.get("final_seconds"),
+                }
+                stream_rows.append(stream_times)
+            result_log.append({
+                "row_id": int(row_id),
+                "question": q,
+                "ground_truth": gt,
+                "baseline_answer": answer_bl,
+                "baseline_correct": bl_correct,
+                "baseline_similarity": bl_sim,
+                "critique_answer_full": answer_sc_full,
+                "critique_answer_final": answer_sc_final,
+                "critique_correct": sc_correct,
+                "critique_similarity": sc_sim,
+                "baseline_failed": err_bl is not None,
+                "critique_failed": err_sc is not None,
+                **stream_times,
+            })
+            rows_run += 1
+
+            # 5. Kiểm định tuần tự: đủ kết luận thì dừng, các prompt chưa gửi sẽ bị huỷ
+            if sequential is not None and err_bl is None and err_sc is None:
+                sequential.update(bl_correct, sc_correct)
+                if sequential.due() and sequential.check():
+                    break
+
+    # Đóng generator để huỷ các task chưa chạy (khi dừng sớm) và chờ các task đang chạy
+    outputs.close()
+
+    run_seconds = time.perf_counter() - run_start
+    if rows_run:
+        print(f"⏱️  {rows_run} dòng trong {run_seconds:.1f}s ({rows_run / max(run_seconds, 1e-9):.2f} dòng/giây)")
+        print(f"🔁 {RETRY_POLICY.format_stats()}")
+        if PACK_SIZE > 1:
+            print(f"📦 {PACK_STATS.format()}")
+        if stream_rows:
+            print(f"⚡ {format_stream_times(stream_rows)}")
+    sequential_report = ""
+    if sequential is not None:
+        # Số request chưa gửi (khi gộp câu: số request gộp, chưa tính các lời gọi fallback)
+        calls_saved = len(tasks) - runner.started
+        sequential_report = sequential.format_summary(total_rows=len(benchmark_df), calls_saved=calls_saved)
+        print(f"🛑 {sequential_report}")
 
     # --- 5. PHÂN TÍCH KẾT QUẢ (CHO DATASET NÀY) ---
-    df_results = pd.DataFrame(results)
+    # Đọc lại toàn bộ log 1 lượt để tạo CSV và báo cáo
+    df_results = result_log.to_dataframe().drop(columns=["row_id"])
+    if df_results.empty:
+        print(f"⚠️ Không có kết quả nào cho {dataset_name}.")
+        return
+
+    # Tính toán các metrics trên các dòng chạy thành công (dòng lỗi không phải câu trả lời sai)
+    failed = failed_rows(df_results)
+    num_failed = int(failed.sum())
+    df_scored = df_results[~failed]
+    if df_scored.empty:
+        print(f"⚠️ Cả {num_failed} dòng của {dataset_name} đều lỗi, chạy lại để thử tiếp.")
+        write_table(df_results, table_path(Path("results") / f"results_{dataset_name}"))
+        return
 
-    # Tính toán các metrics
-    baseline_accuracy = df_results['baseline_correct'].sum() / len(df_results) * 100
-    critique_accuracy = df_results['critique_correct'].sum() / len(df_results) * 100
+    baseline_accuracy = df_scored['baseline_correct'].sum() / len(df_scored) * 100
+    critique_accuracy = df_scored['critique_correct'].sum() / len(df_scored) * 100
 
-    baseline_avg_similarity = df_results['baseline_similarity'].mean()
-    critique_avg_similarity = df_results['critique_similarity'].mean()
+    baseline_avg_similarity = df_scored['baseline_similarity'].mean()
+    critique_avg_similarity = df_scored['critique_similarity'].mean()
 
     # Cải thiện
     accuracy_improvement = critique_accuracy - baseline_accuracy
     relative_improvement = (accuracy_improvement / baseline_accuracy * 100) if baseline_accuracy > 0 else (100.0 if accuracy_improvement > 0 else 0.0)
 
     # Đếm số câu
-    sc_better = (df_results['critique_similarity'] > df_results['baseline_similarity']).sum()
-    bl_better = (df_results['baseline_similarity'] > df_results['critique_similarity']).sum()
-    equal = (df_results['baseline_similarity'] == df_results['critique_similarity']).sum()
+    sc_better = (df_scored['critique_similarity'] > df_scored['baseline_similarity']).sum()
+    bl_better = (df_scored['baseline_similarity'] > df_scored['critique_similarity']).sum()
+    equal = (df_scored['baseline_similarity'] == df_scored['critique_similarity']).sum()
 
     # --- 6. LƯU KẾT QUẢ RA FILE (CHO DATASET NÀY) ---
-    output_csv_file = Path("results") / f"results_{dataset_name}.csv"
+    # Parquet (nén zstd) nếu có pyarrow, xuất CSV bằng: python app/storage.py export <file>
+    output_table_file = table_path(Path("results") / f"results_{dataset_name}")
     output_txt_file = Path("results") / f"summary_{dataset_name}.txt"
     
-    df_results.to_csv(output_csv_file, index=False, encoding="utf-8-sig")
+    write_table(df_results, output_table_file)
 
     # --- 7. TẠO VÀ IN BÁO CÁO (CHO DATASET NÀY) ---
     summary_report = f"""
@@ -221,7 +400,7 @@ Liệu kỹ thuật Self-Critique prompting có giảm hallucination và cải t
 factual accuracy so với direct prompting không?
 
 ** 2. METHODOLOGY **
-- Dataset: {dataset_name.upper()} ({len(df_results)} câu hỏi)
+- Dataset: {dataset_name.upper()} ({len(df_scored)} câu hỏi, {num_failed} câu lỗi API không tính)
 - Model: Gemini 1.5 Pro
 - Baseline: Direct prompt đơn giản
 - Treatment: Self-Critique 3-step prompt (Initial Answer → Critique → Final Answer)
@@ -240,6 +419,11 @@ Average Similarity:
   - Difference:      {critique_avg_similarity - baseline_avg_similarity:+.4f}
 
 ** 4. CONCLUSION **
+"""
+
+    if sequential_report:
+        summary_report += f"""
+{sequential_report}
 """
 
     if accuracy_improvement > 0:
@@ -262,9 +446,9 @@ Có thể prompt design chưa tối ưu hoặc model gặp khó khăn trong vi
     summary_report += f"""
 
 ** 5. DETAILED BREAKDOWN **
-Self-Critique performs better: {sc_better} cases ({sc_better/len(df_results)*100:.1f}%)
-Baseline performs better:      {bl_better} cases ({bl_better/len(df_results)*100:.1f}%)
-Equal performance:           {equal} cases ({equal/len(df_results)*100:.1f}%)
+Self-Critique performs better: {sc_better} cases ({sc_better/len(df_scored)*100:.1f}%)
+Baseline performs better:      {bl_better} cases ({bl_better/len(df_scored)*100:.1f}%)
+Equal performance:           {equal} cases ({equal/len(df_scored)*100:.1f}%)
 
 ===================================================
 """
@@ -275,8 +459,9 @@ Equal performance:           {equal} cases ({equal/len(df_results)*100:.1f}%)
 
     # In báo cáo ra console
     print(summary_report)
-    print(f"💾 Chi tiết đầy đủ đã được lưu vào: {output_csv_file}")
+    print(f"💾 Chi tiết đầy đủ đã được lưu vào: {output_table_file}")
     print(f"📄 Báo cáo tóm tắt đã được lưu vào: {output_txt_file}")
+    print(f"🗄️ {get_default_cache().format_stats()}")
 
 
 # --- 4. HÀM MAIN ĐỂ CHẠY TẤT CẢ DATASET ---
@@ -287,7 +472,7 @@ if __name__ == "__main__":
     Path("results").mkdir(exist_ok=True)
 
     # Tìm tất cả các file benchmark đã được chuẩn bị
-    benchmark_files = list(Path("data").glob("benchmark_*.csv"))
+    benchmark_files = find_tables(Path("data"), "benchmark_*")
     
     if not benchmark_files:
         print("⚠️ Không tìm thấy file benchmark nào trong thư mục 'data/'.")
@@ -298,9 +483,26 @@ if __name__ == "__main__":
     for f in benchmark_files:
         print(f"  - {f.name}")
 
+    # Gộp cụm câu hỏi trùng/gần trùng trong và giữa các file (MinHash/LSH, xem dedup.py)
+    dedup_map = dedup_tables(benchmark_files, DEDUP_THRESHOLD)
+    dedup_stats = summarize(dedup_map)
+    print(f"🧬 {dedup_stats['rows']} câu hỏi -> {dedup_stats['clusters']} cụm (ngưỡng {DEDUP_THRESHOLD}), "
+          f"tiết kiệm {dedup_stats['saved_pct']:.1f}% lời gọi API")
+    write_table(dedup_map, table_path(Path("results") / "dedup_map"))
+
     # Lặp qua từng file benchmark và chạy thí nghiệm
     for benchmark_path in benchmark_files:
-        run_and_evaluate_dataset(benchmark_path, similarity_threshold=0.6)
+        source = benchmark_path.with_suffix("").name
+        run_and_evaluate_dataset(
+            benchmark_path,
+            similarity_threshold=0.6,
+            canonical=canonical_question_map(dedup_map, source),
+        )
+
+    # Đo lường mọi lời gọi LLM của lần chạy: thời gian, token, cache, lần thử, loại lỗi
+    print(f"\n📈 {get_tracer().format_summary()}")
+    report_path, prom_path = write_run_report("results", "gemini")
+    print(f"📈 Báo cáo lời gọi LLM: {report_path} (Prometheus: {prom_path})")
 
     print("\n🎉🎉🎉 Tất cả 5 thí nghiệm đã hoàn tất! 🎉🎉🎉")
     print("Kiểm tra thư mục 'results/' để xem 5 file CSV và 5 file TXT báo cáo.")
@@ -1,18 +1,22 @@
-import json, os, numpy as np, pandas as pd
+import os, pandas as pd
 from pathlib import Path
 import streamlit as st
-from sentence_transformers import SentenceTransformer
 from dotenv import load_dotenv
-from prompts import ANSWER_PROMPT, CRITIQUE_PROMPT
-
-# OpenAI là optional – chỉ import khi thật sự cần
-try:
-    from openai import OpenAI
-except Exception:
-    OpenAI = None
+from prompts import ANSWER_PROMPT, build_critique_prompt, critique_prompt_version
+from critique_table import CRITIQUE_MODEL
+from embedding_store import current_dir
+from llm_calls import openai_chat_stream, stream_in_background
+from llm_tracing import get_tracer
+from resources import DEFAULT_MODEL_NAME, OpenAI, get_corpus, get_critique_table, get_executor, get_openai_client, get_searcher
 
 load_dotenv()
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "").strip()
+# Self-Critique quá chừng này giây thì bỏ, dùng đáp án Baseline
+CRITIQUE_TIMEOUT = float(os.getenv("CRITIQUE_TIMEOUT", "30"))
+# Score >= ngưỡng này thì dùng critique tính trước (critique_table.py) của câu khớp nhất, không gọi model
+PRECOMPUTED_THRESHOLD = float(os.getenv("PRECOMPUTED_CRITIQUE_THRESHOLD", "0.9"))
+# Loại index đã build bằng build_index.py --index (exact | ivf | graph)
+VECTOR_INDEX = os.getenv("VECTOR_INDEX", "exact").strip().lower()
 
 st.set_page_config(page_title="VN Semantic QA (ViQuAD)", page_icon="🇻🇳", layout="centered")
 st.title("🇻🇳 VN Semantic QA – Demo map câu hỏi đồng nghĩa")
@@ -21,30 +25,50 @@ st.caption("Nguồn dữ liệu: ViQuAD. Tìm câu tương tự nhất bằng em
 
 
 DATA_DIR = Path("data")
-if not (DATA_DIR / "embeddings.npy").exists():
+if not (current_dir(DATA_DIR) / "embeddings.npy").exists():
     st.error(
         "Chưa có index. Hãy chạy: python prepare_data.py rồi python build_index.py"
     )
     st.stop()
 
 
-# Load index
-questions = json.loads((DATA_DIR / "questions.json").read_text(encoding="utf-8"))
-answers = json.loads((DATA_DIR / "answers.json").read_text(encoding="utf-8"))
-emb = np.load(DATA_DIR / "embeddings.npy")
+# Load index (nạp 1 lần/process, dùng chung giữa các session, tự nạp lại khi file đổi)
+corpus = get_corpus(DATA_DIR, VECTOR_INDEX)
+questions, answers, index = corpus.questions, corpus.answers, corpus.index
+# Critique tính trước cho prompt/model hiện tại (rỗng nếu chưa chạy critique_table.py)
+critique_table = get_critique_table(DATA_DIR, critique_prompt_version(CRITIQUE_MODEL))
 
 
-# Embedder cho truy vấn (cùng model)
-embedder = SentenceTransformer(
-    "sentence-transformers/paraphrase-multilingual-mpnet-base-v2"
-)
+# Tra cứu truy vấn (cùng model, dùng chung trong process): câu hỏi trùng câu trong index hoặc
+# đã hỏi gần đây thì không chạy encoder (query_cache.py)
+searcher = get_searcher(DATA_DIR, VECTOR_INDEX, DEFAULT_MODEL_NAME)
 
 
 with st.sidebar:
     st.subheader("⚙️ Tuỳ chọn")
     topk = st.slider("Số câu tương tự xem xét (k)", 1, 10, 5)
     threshold = st.slider("Ngưỡng chấp nhận (cosine sim)", 0.50, 0.95, 0.70)
-    want_crit = st.checkbox("Bật Self-Critique (OpenAI)", value=bool(OPENAI_API_KEY))
+    want_crit = st.checkbox("Bật Self-Critique (OpenAI)", value=bool(OPENAI_API_KEY) or len(critique_table) > 0)
+    precomputed_threshold = st.slider(
+        "Ngưỡng dùng phản biện tính trước", 0.50, 1.00, PRECOMPUTED_THRESHOLD,
+        help=f"Có sẵn {len(critique_table)} phản biện tính trước; score thấp hơn ngưỡng thì gọi model trực tiếp",
+    )
+    knob_value = None
+    if index.knob:
+        # Đánh đổi recall/độ trễ của index xấp xỉ
+        default_knob = int(index.params[index.knob])
+        # rescore=0: chỉ dùng score int8, không chấm lại bằng float32
+        min_knob = 0 if index.knob == "rescore" else 1
+        knob_value = st.slider(f"Index {index.kind}: {index.knob}", min_knob, max(4 * default_knob, 16), default_knob)
+    sources = None
+    if len(index.sources) > 1:
+        # Mỗi nguồn là 1 shard riêng: bỏ chọn nguồn nào thì shard đó không bị quét
+        chosen = st.multiselect("Nguồn dữ liệu", index.sources, default=index.sources)
+        sources = chosen if len(chosen) < len(index.sources) else None
+    with st.expander("📈 Lời gọi LLM (từ khi khởi động)"):
+        st.text(get_tracer().format_summary())
+    with st.expander("⚡ Tra cứu truy vấn (từ khi khởi động)"):
+        st.text(searcher.format_stats())
 
 
 q = st.text_input("Nhập câu hỏi bằng tiếng Việt", value="Thủ đô CHXHCN Việt Nam là gì?")
@@ -53,15 +77,18 @@ btn = st.button("Hỏi")
 
 if btn and q.strip():
     with st.spinner("Đang tìm câu hỏi tương đồng..."):
-        q_vec = embedder.encode([q], normalize_embeddings=True)
-        # cosine scores shape (1, N)
-        scores = np.matmul(q_vec, emb.T).reshape(-1)
-        idx_sorted = np.argsort(-scores)[:topk]
-        candidates = [(int(i), float(scores[i])) for i in idx_sorted]
+        # Chỉ lấy top-k từ index, không sort toàn bộ N score
+        results, tiers = searcher.lookup([q], topk, knob_value, sources)
+        candidates = results[0]
+    if tiers[0] != "encoder":
+        st.caption(f"⚡ Không chạy encoder (tầng {tiers[0]})")
+    if not candidates:
+        st.warning("⚠️ Chưa chọn nguồn dữ liệu nào để tìm.")
+        st.stop()
 
     st.markdown("### 🔎 Kết quả tìm gần nhất")
     for rank, (i, sc) in enumerate(candidates, start=1):
-        st.write(f"**#{rank}** · score = {sc:.3f}")
+        st.write(f"**#{rank}** · score = {sc:.3f} · nguồn: {index.source_of(i)}")
         with st.expander(questions[i]):
             st.markdown(f"**Đáp án gold:** {answers[i]}")
 
@@ -74,40 +101,65 @@ if btn and q.strip():
 
     candidate_answer = answers[best_i]
 
+    # Câu hỏi gần như trùng câu trong index: dùng critique tính trước, trả về ngay
+    precomputed = None
+    if want_crit and best_score >= precomputed_threshold:
+        precomputed = critique_table.get(best_i, questions[best_i])
+
+    # Còn lại: Self-Critique (OpenAI, chỉ dựa vào dataset ViQuAD) được gửi ngay ở thread nền và
+    # stream về, trong lúc trang hiển thị Baseline
+    critique_chunks, critique_error = None, None
+    if precomputed is None and want_crit and OPENAI_API_KEY and OpenAI:
+        try:
+            # Client dùng chung trong process (keep-alive); OPENAI_BASE_URL để trỏ sang server khác (vd mock_llm_server.py)
+            client = get_openai_client(OPENAI_API_KEY, os.getenv("OPENAI_BASE_URL") or None, timeout=CRITIQUE_TIMEOUT)
+            full_prompt = build_critique_prompt(q, questions[best_i], candidate_answer, best_score)
+
+            critique_chunks = stream_in_background(
+                lambda **stream: openai_chat_stream(
+                    client,
+                    model=CRITIQUE_MODEL,  # CRITIQUE_MODEL=gpt-4-turbo / gpt-3.5-turbo nếu tài khoản không có 4o
+                    messages=[{"role": "user", "content": full_prompt}],
+                    temperature=0,
+                    **stream,
+                ),
+                timeout=CRITIQUE_TIMEOUT,
+                executor=get_executor(),
+            )
+        except Exception as e:
+            critique_error = e
+
     # Baseline: trả thẳng gold gần nhất
     st.markdown("---")
     st.subheader("🟦 Baseline (không phản biện)")
     st.markdown(f"**Câu trả lời (đề xuất):** {candidate_answer}")
     st.caption(f"Nguồn: câu hỏi gần nhất · score={best_score:.3f}")
 
-    # Optional self-critique via OpenAI (chỉ dựa vào dataset ViQuAD)
     st.markdown("---")
     st.subheader("🟪 Self-Critique (tự phản biện)")
     st.caption("⚠️ Chỉ sử dụng dữ liệu từ dataset ViQuAD, không dùng kiến thức bên ngoài")
-    critique_text = None
-    if want_crit and OPENAI_API_KEY and OpenAI:
+    critique_text = ""
+    if precomputed is not None:
+        st.text_area("Phản biện & Đáp án cuối (chỉ dựa vào ViQuAD)", value=precomputed, height=200)
+        st.caption(f"⚡ Phản biện tính trước cho câu hỏi gốc #{best_i} (score {best_score:.3f} ≥ {precomputed_threshold:.2f})")
+    elif critique_chunks is not None:
+        placeholder = st.empty()
         try:
-            client = OpenAI(api_key=OPENAI_API_KEY)  # khởi tạo TRONG try/catch
-            
-            # Cung cấp thêm context từ dataset để AI hiểu rõ hơn về nguồn dữ liệu
-            context_info = f"Nguồn dữ liệu: Dataset ViQuAD (Vietnamese Question Answering Dataset)\n"
-            context_info += f"Câu hỏi gốc trong dataset: {questions[best_i]}\n"
-            context_info += f"Độ tin cậy semantic: {best_score:.3f}\n\n"
-            
-            prompt = CRITIQUE_PROMPT.format(question=q, candidate=candidate_answer)
-            full_prompt = context_info + prompt
-            
-            resp = client.chat.completions.create(
-                model="gpt-4o-mini",  # hoặc gpt-4-turbo / gpt-3.5-turbo nếu tài khoản không có 4o
-                messages=[{"role": "user", "content": full_prompt}],
-                temperature=0,
-            )
-            critique_text = resp.choices[0].message.content
-            st.text_area("Phản biện & Đáp án cuối (chỉ dựa vào ViQuAD)", value=critique_text, height=200)
+            # Hiển thị dần từng đoạn; quá CRITIQUE_TIMEOUT thì StreamTimeout
+            for chunk in critique_chunks:
+                critique_text += chunk
+                placeholder.markdown(critique_text + " ▌")
+            placeholder.text_area("Phản biện & Đáp án cuối (chỉ dựa vào ViQuAD)", value=critique_text, height=200)
         except Exception as e:
-            st.error(f"Không bật được Self-Critique (sẽ dùng Baseline). Lý do: {e}")
-            st.text_area("Phản biện & Đáp án cuối", value=f"(Baseline) Đáp án cuối: {candidate_answer}", height=120)
-    else:
+            critique_error = e
+            if critique_text:
+                placeholder.text_area("Phản biện (chưa xong)", value=critique_text, height=200)
+            else:
+                placeholder.empty()
+    if critique_error is not None:
+        st.error(f"Không bật được Self-Critique (sẽ dùng Baseline). Lý do: {critique_error}")
+        st.text_area("Phản biện & Đáp án cuối", value=f"(Baseline) Đáp án cuối: {candidate_answer}", height=120)
+    elif precomputed is None and critique_chunks is None:
         st.info("Chưa bật Self-Critique. Đang hiển thị đáp án Baseline.")
         st.text_area("Phản biện & Đáp án cuối", value=f"(Baseline) Đáp án cuối: {candidate_answer}", height=120)
 
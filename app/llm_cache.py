@@ -0,0 +1,159 @@
+"""
+Cache kết quả gọi LLM trên đĩa (SQLite), khoá bằng hash của toàn bộ request.
+Với temperature=0, cùng (model, prompt, config, safety) thì không cần gọi lại API.
+
+Chế độ (LLM_CACHE_MODE):
+- readwrite: đọc cache, miss thì gọi API rồi ghi lại (mặc định)
+- replay:    chỉ đọc cache, miss thì raise CacheMiss (đảm bảo 0 lời gọi API)
+- off:       bỏ qua cache hoàn toàn
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+CACHE_MODES = ("readwrite", "replay", "off")
+
+
+class CacheMiss(KeyError):
+    """Request chưa có trong cache khi đang ở chế độ replay"""
+
+
+def request_key(request):
+    """Hash sha256 của request (dict) sau khi chuẩn hoá JSON"""
+    canonical = json.dumps(request, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class LLMCache:
+    """
+    Cache key -> text trong 1 file SQLite, giới hạn dung lượng bằng LRU
+    (xoá các entry lâu nhất chưa được đọc khi vượt max_bytes).
+    """
+
+    def __init__(self, path="data/llm_cache.sqlite", max_bytes=512 * 1024 * 1024, mode="readwrite"):
+        if mode not in CACHE_MODES:
+            raise ValueError(f"LLM cache mode không hợp lệ: {mode} (chọn {CACHE_MODES})")
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.mode = mode
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._conn = None
+        if mode != "off":
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                " key TEXT PRIMARY KEY,"
+                " value TEXT NOT NULL,"
+                " size INTEGER NOT NULL,"
+                " created REAL NOT NULL,"
+                " last_access REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_last_access ON responses(last_access)")
+            self._conn.commit()
+            row = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()
+            self._total_bytes = row[0]
+
+    def get(self, key):
+        """Trả về text đã cache hoặc None"""
+        if self._conn is None:
+            return None
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if self.mode == "readwrite":
+                self._conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+                self._conn.commit()
+            return row[0]
+
+    def put(self, key, value):
+        if self._conn is None or self.mode != "readwrite":
+            return
+        size = len(value.encode("utf-8"))
+        now = time.time()
+        with self._lock:
+            old = self._conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, created, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, value, size, now, now),
+            )
+            self._total_bytes += size - (old[0] if old else 0)
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        """Xoá entry ít dùng gần đây nhất cho tới khi còn ~90% max_bytes"""
+        target = int(self.max_bytes * 0.9)
+        cursor = self._conn.execute("SELECT key, size FROM responses ORDER BY last_access ASC")
+        to_delete = []
+        for key, size in cursor:
+            if self._total_bytes <= target:
+                break
+            to_delete.append((key,))
+            self._total_bytes -= size
+        self._conn.executemany("DELETE FROM responses WHERE key = ?", to_delete)
+        self.evictions += len(to_delete)
+
+    def get_or_call(self, request, call):
+        """
+        Trả về (text, cache_status) cho request.
+        call() chỉ được gọi khi cache miss ở chế độ readwrite hoặc khi cache tắt.
+        """
+        if self.mode == "off":
+            return call(), "off"
+        key = request_key(request)
+        cached = self.get(key)
+        if cached is not None:
+            return cached, "hit"
+        if self.mode == "replay":
+            raise CacheMiss(f"Không có trong LLM cache (replay mode): {key[:12]}")
+        text = call()
+        self.put(key, text)
+        return text, "miss"
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "mode": self.mode,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "evictions": self.evictions,
+            "size_mb": (self._total_bytes if self._conn else 0) / 1024 / 1024,
+        }
+
+    def format_stats(self):
+        s = self.stats()
+        return (
+            f"LLM cache ({s['mode']}): {s['hits']} hit / {s['misses']} miss "
+            f"({s['hit_rate'] * 100:.1f}%), {s['evictions']} evicted, {s['size_mb']:.1f} MB"
+        )
+
+
+_default_cache = None
+_default_lock = threading.Lock()
+
+
+def get_default_cache():
+    """Cache dùng chung trong process, cấu hình bằng biến môi trường LLM_CACHE_*"""
+    global _default_cache
+    with _default_lock:
+        if _default_cache is None:
+            _default_cache = LLMCache(
+                path=os.getenv("LLM_CACHE_PATH", "data/llm_cache.sqlite"),
+                max_bytes=int(float(os.getenv("LLM_CACHE_MAX_MB", "512")) * 1024 * 1024),
+                mode=os.getenv("LLM_CACHE_MODE", "readwrite").strip().lower(),
+            )
+        return _default_cache
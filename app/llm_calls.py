@@ -0,0 +1,267 @@
+"""
+Điểm gọi LLM dùng chung cho gemini.py, openai_experiment.py và gpt.py.
+Mọi lời gọi model.generate_content / client.chat.completions.create đi qua đây
+để được cache (xem llm_cache.py) và đo thời gian/token/lỗi (xem llm_tracing.py).
+
+Bản stream (gemini_generate_stream, openai_chat_stream) đưa từng đoạn text cho on_chunk ngay khi
+nhận được, đo thời gian tới token đầu tiên (TTFT) và có thể dừng generation giữa chừng.
+stream_in_background chạy lời gọi stream ở thread nền để bên gọi (vd trang Streamlit) vừa
+hiển thị dần vừa có thời hạn.
+"""
+import queue
+import threading
+import time
+
+from extraction import Step3Parser
+from llm_cache import get_default_cache
+from llm_tracing import get_tracer
+
+
+def _traced_call(provider, model, payload, call, cache=None, attempt=1, tracer=None, timing=None):
+    """
+    Gọi qua cache và ghi lại 1 bản ghi tracing. call(usage) trả về text và điền
+    usage["prompt"] / usage["completion"] nếu response có thông tin token.
+    timing: dict, lời gọi stream điền timing["ttft"] (giây từ lúc bắt đầu tới đoạn text đầu tiên).
+    """
+    cache = cache or get_default_cache()
+    tracer = tracer or get_tracer()
+    usage = {}
+    timing = timing if timing is not None else {}
+    start = time.perf_counter()
+    timing["start"] = start
+    try:
+        text, status = cache.get_or_call(payload, lambda: call(usage))
+    except Exception as e:
+        status = "off" if cache.mode == "off" else "miss"
+        tracer.record(provider, model, time.perf_counter() - start, status, attempt,
+                      usage.get("prompt", 0), usage.get("completion", 0), error=e, ttft=timing.get("ttft"))
+        raise
+    tracer.record(provider, model, time.perf_counter() - start, status, attempt,
+                  usage.get("prompt", 0), usage.get("completion", 0), ttft=timing.get("ttft"))
+    return text
+
+
+def _consume_stream(chunks, on_chunk, cancel, timing):
+    """
+    Ghép các đoạn text của stream. on_chunk(text) được gọi cho từng đoạn; nếu cancel=True
+    và on_chunk trả về True thì dừng nhận (phần còn lại của generation bị bỏ).
+    """
+    parts = []
+    for text in chunks:
+        if not text:
+            continue
+        if "ttft" not in timing:
+            timing["ttft"] = time.perf_counter() - timing["start"]
+        parts.append(text)
+        if on_chunk is not None and on_chunk(text) and cancel:
+            timing["cancelled"] = True
+            break
+    return "".join(parts)
+
+
+def _stream_from_cache(text, on_chunk, timing):
+    """Cache hit: không có stream, đưa cả text cho on_chunk 1 lần"""
+    timing.setdefault("ttft", time.perf_counter() - timing["start"])
+    if on_chunk is not None:
+        on_chunk(text)
+    return text
+
+
+def gemini_generate(model, prompt, request, cache=None, attempt=1, generation_config=None):
+    """
+    Gọi Gemini model.generate_content(prompt), trả về text.
+    request: dict mô tả đầy đủ cấu hình model (tên model, generation_config, safety_settings)
+    để làm khoá cache.
+    attempt: lần thử thứ mấy (khi gọi lại sau lỗi), chỉ dùng cho tracing.
+    generation_config: dict ghi đè cấu hình của model cho riêng lời gọi này
+    (vd response_mime_type/response_schema cho output JSON), cũng được đưa vào khoá cache.
+    """
+    payload = {"provider": "gemini", **request, "prompt": prompt}
+    if generation_config:
+        payload["generation_config"] = {**request.get("generation_config", {}), **generation_config}
+
+    def call(usage):
+        if generation_config:
+            response = model.generate_content(prompt, generation_config=payload["generation_config"])
+        else:
+            response = model.generate_content(prompt)
+        meta = getattr(response, "usage_metadata", None)
+        if meta is not None:
+            usage["prompt"] = getattr(meta, "prompt_token_count", 0) or 0
+            usage["completion"] = getattr(meta, "candidates_token_count", 0) or 0
+        return response.text
+
+    return _traced_call("gemini", request.get("model", "gemini"), payload, call, cache, attempt)
+
+
+def _cancel_gemini_stream(response):
+    """
+    Dừng stream Gemini giữa chừng để server ngừng generate. REST: đóng generator đọc body trước
+    rồi đóng kết nối (để generator bị thu gom sau không flush lên socket đã đóng); gRPC: cancel call.
+    """
+    iterator = getattr(response, "_iterator", None)
+    reader = getattr(iterator, "_response_itr", None)
+    if reader is not None:
+        reader.close()
+    if hasattr(iterator, "cancel"):
+        iterator.cancel()
+
+
+def gemini_generate_stream(model, prompt, request, on_chunk=None, cancel=False, timing=None,
+                           cache=None, attempt=1):
+    """
+    Như gemini_generate nhưng stream: on_chunk(text) nhận từng đoạn ngay khi tới.
+    cancel=True: dừng khi on_chunk trả về True (text trả về và lưu cache chỉ tới đó,
+    nên khoá cache có thêm "stream_cancel" để không lẫn với output đầy đủ).
+    timing: dict nhận "ttft" và "cancelled".
+    """
+    payload = {"provider": "gemini", **request, "prompt": prompt}
+    if cancel:
+        payload["stream_cancel"] = True
+    timing = timing if timing is not None else {}
+
+    def call(usage):
+        timing["streamed"] = True
+        response = model.generate_content(prompt, stream=True)
+
+        def chunks():
+            for chunk in response:
+                meta = getattr(chunk, "usage_metadata", None)
+                if meta is not None:
+                    usage["prompt"] = getattr(meta, "prompt_token_count", 0) or 0
+                    usage["completion"] = getattr(meta, "candidates_token_count", 0) or 0
+                # Chunk cuối có thể chỉ có finish_reason/usage, không có text
+                if chunk.candidates and chunk.candidates[0].content.parts:
+                    yield chunk.text
+
+        try:
+            return _consume_stream(chunks(), on_chunk, cancel, timing)
+        finally:
+            if timing.get("cancelled"):
+                _cancel_gemini_stream(response)
+
+    text = _traced_call("gemini", request.get("model", "gemini"), payload, call, cache, attempt, timing=timing)
+    return text if timing.get("streamed") else _stream_from_cache(text, on_chunk, timing)
+
+
+def openai_chat(client, cache=None, attempt=1, **kwargs):
+    """
+    Gọi client.chat.completions.create(**kwargs), trả về nội dung message đầu tiên.
+    """
+    payload = {"provider": "openai", **kwargs}
+
+    def call(usage):
+        response = client.chat.completions.create(**kwargs)
+        if getattr(response, "usage", None) is not None:
+            usage["prompt"] = response.usage.prompt_tokens or 0
+            usage["completion"] = response.usage.completion_tokens or 0
+        return response.choices[0].message.content or ""
+
+    return _traced_call("openai", kwargs.get("model", "openai"), payload, call, cache, attempt)
+
+
+def openai_chat_stream(client, on_chunk=None, cancel=False, timing=None, cache=None, attempt=1, **kwargs):
+    """
+    Như openai_chat nhưng stream=True (xem gemini_generate_stream cho on_chunk/cancel/timing).
+    Token lấy từ chunk usage cuối (stream_options include_usage), nên stream bị dừng giữa chừng
+    không có số token trong tracing.
+    """
+    payload = {"provider": "openai", **kwargs}
+    if cancel:
+        payload["stream_cancel"] = True
+    timing = timing if timing is not None else {}
+
+    def call(usage):
+        timing["streamed"] = True
+        stream = client.chat.completions.create(stream=True, stream_options={"include_usage": True}, **kwargs)
+
+        def chunks():
+            for chunk in stream:
+                if getattr(chunk, "usage", None) is not None:
+                    usage["prompt"] = chunk.usage.prompt_tokens or 0
+                    usage["completion"] = chunk.usage.completion_tokens or 0
+                if chunk.choices:
+                    yield chunk.choices[0].delta.content or ""
+
+        try:
+            return _consume_stream(chunks(), on_chunk, cancel, timing)
+        finally:
+            # Đóng kết nối khi dừng sớm để server ngừng generate
+            stream.close()
+
+    text = _traced_call("openai", kwargs.get("model", "openai"), payload, call, cache, attempt, timing=timing)
+    return text if timing.get("streamed") else _stream_from_cache(text, on_chunk, timing)
+
+
+def stream_answer(stream_call, critique=False, cancel=False):
+    """
+    Chạy 1 lời gọi stream: stream_call(on_chunk=..., cancel=..., timing=...) là gemini_generate_stream
+    hoặc openai_chat_stream đã điền sẵn các tham số khác. critique=True: Step3Parser đọc output trong
+    lúc stream, cancel=True thì dừng generation ngay khi Bước 3 kết thúc.
+    Returns: (text, dict ttft_seconds [+ final_answer, final_seconds khi critique=True])
+    """
+    parser = Step3Parser() if critique else None
+    timing, final = {}, {}
+
+    def on_chunk(text):
+        if parser is None or not parser.feed(text):
+            return False
+        final.setdefault("seconds", time.perf_counter() - timing["start"])
+        return True
+
+    text = stream_call(on_chunk=on_chunk, cancel=cancel and critique, timing=timing).strip()
+    info = {"ttft_seconds": timing.get("ttft")}
+    if parser is not None:
+        info["final_answer"] = parser.close()
+        info["final_seconds"] = final.get("seconds", time.perf_counter() - timing["start"])
+    return text, info
+
+
+class StreamTimeout(TimeoutError):
+    """Stream chạy nền không xong trong thời hạn (stream_in_background)"""
+
+
+def stream_in_background(stream_call, timeout, executor):
+    """
+    Bắt đầu stream_call(on_chunk=...) (vd openai_chat_stream đã điền sẵn tham số) trên executor
+    ngay lập tức, trả về generator yield từng đoạn text khi tới.
+    Quá timeout giây kể từ lúc bắt đầu thì generator raise StreamTimeout và lời gọi nền dừng ở
+    đoạn kế tiếp (raise trong on_chunk nên output dở dang không bị lưu cache); lỗi của lời gọi
+    được raise lại ở bên đọc.
+    """
+    chunks = queue.Queue()
+    expired = threading.Event()
+    deadline = time.monotonic() + timeout
+
+    def on_chunk(text):
+        if expired.is_set():
+            raise StreamTimeout(f"bên đọc đã dừng sau {timeout:g}s")
+        chunks.put(text)
+        return False
+
+    def worker():
+        try:
+            stream_call(on_chunk=on_chunk)
+        finally:
+            chunks.put(None)
+
+    future = executor.submit(worker)
+
+    def read():
+        try:
+            while True:
+                try:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise queue.Empty
+                    chunk = chunks.get(timeout=remaining)
+                except queue.Empty:
+                    raise StreamTimeout(f"không xong trong {timeout:g}s") from None
+                if chunk is None:
+                    break
+                yield chunk
+            future.result()
+        finally:
+            expired.set()
+
+    return read()
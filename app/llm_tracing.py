@@ -0,0 +1,197 @@
+"""
+Đo từng lời gọi LLM (đi qua llm_calls.py): thời gian, token prompt/completion,
+trạng thái cache, lần thử thứ mấy, loại lỗi và thời gian tới token đầu tiên (khi stream).
+
+Xuất ra Prometheus text (llm_calls_total, llm_tokens_total, llm_errors_total,
+llm_call_seconds, llm_ttft_seconds) và báo cáo JSON cho mỗi lần chạy (tổng hợp + từng lời gọi).
+"""
+import json
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+
+from metrics import Registry
+
+ERROR_TYPES = ("rate_limit", "server", "timeout", "auth", "bad_request", "cache_miss", "other")
+
+
+def classify_error(exc):
+    """Phân loại exception của SDK OpenAI / Gemini (google.api_core) theo status code hoặc tên lớp"""
+    name = type(exc).__name__
+    status = getattr(exc, "status_code", None) or getattr(exc, "code", None)
+    status = status if isinstance(status, int) else None
+    if name == "CacheMiss":
+        return "cache_miss"
+    if status == 429 or name in ("RateLimitError", "ResourceExhausted", "TooManyRequests"):
+        return "rate_limit"
+    if "Timeout" in name or name in ("DeadlineExceeded", "APITimeoutError"):
+        return "timeout"
+    if status in (401, 403) or name in ("AuthenticationError", "PermissionDenied", "PermissionDeniedError", "Unauthenticated"):
+        return "auth"
+    if (status and status >= 500) or name in (
+        "InternalServerError", "ServiceUnavailable", "APIConnectionError", "BadGateway",
+    ):
+        return "server"
+    if status in (400, 404, 422) or name in ("BadRequestError", "InvalidArgument", "NotFoundError", "NotFound"):
+        return "bad_request"
+    return "other"
+
+
+class LLMTracer:
+    def __init__(self, keep_records=True):
+        self.registry = Registry()
+        self.calls = self.registry.counter("llm_calls_total", "Số lời gọi LLM theo provider/model/cache/kết quả")
+        self.tokens = self.registry.counter("llm_tokens_total", "Token prompt/completion đã tiêu (chỉ tính cache miss)")
+        self.errors = self.registry.counter("llm_errors_total", "Số lỗi LLM theo loại")
+        self.seconds = self.registry.histogram("llm_call_seconds", "Thời gian 1 lời gọi LLM (gồm cả tra cache)")
+        self.ttft = self.registry.histogram("llm_ttft_seconds", "Thời gian tới token đầu tiên (lời gọi stream)")
+        self.keep_records = keep_records
+        self.records = []
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def record(self, provider, model, seconds, cache_status, attempt=1,
+               prompt_tokens=0, completion_tokens=0, error=None, ttft=None):
+        error_type = classify_error(error) if error is not None else None
+        outcome = "error" if error is not None else "ok"
+        self.calls.inc(provider=provider, model=model, cache=cache_status, outcome=outcome)
+        self.seconds.observe(seconds, provider=provider, cache=cache_status)
+        if prompt_tokens:
+            self.tokens.inc(prompt_tokens, provider=provider, model=model, kind="prompt")
+        if completion_tokens:
+            self.tokens.inc(completion_tokens, provider=provider, model=model, kind="completion")
+        if error_type:
+            self.errors.inc(provider=provider, error_type=error_type)
+        if ttft is not None:
+            self.ttft.observe(ttft, provider=provider, cache=cache_status)
+        if self.keep_records:
+            with self._lock:
+                self.records.append({
+                    "ts": time.time(),
+                    "provider": provider,
+                    "model": model,
+                    "seconds": round(seconds, 6),
+                    "cache": cache_status,
+                    "attempt": attempt,
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "ttft": round(ttft, 6) if ttft is not None else None,
+                    "error_type": error_type,
+                    "error": f"{type(error).__name__}: {error}"[:300] if error is not None else None,
+                })
+
+    def summary(self):
+        """Tổng hợp theo (provider, model): số lời gọi, cache, lỗi, token, thời gian"""
+        with self._lock:
+            records = list(self.records)
+        groups = {}
+        for r in records:
+            groups.setdefault((r["provider"], r["model"]), []).append(r)
+        out = []
+        for (provider, model), rows in sorted(groups.items()):
+            seconds = np.array([r["seconds"] for r in rows])
+            api_seconds = np.array([r["seconds"] for r in rows if r["cache"] != "hit"] or [0.0])
+            ttfts = [r["ttft"] for r in rows if r.get("ttft") is not None and r["cache"] != "hit"]
+            errors = {}
+            for r in rows:
+                if r["error_type"]:
+                    errors[r["error_type"]] = errors.get(r["error_type"], 0) + 1
+            out.append({
+                "provider": provider,
+                "model": model,
+                "calls": len(rows),
+                "ok": sum(1 for r in rows if not r["error_type"]),
+                "cache_hits": sum(1 for r in rows if r["cache"] == "hit"),
+                "api_calls": sum(1 for r in rows if r["cache"] != "hit"),
+                "retries": sum(1 for r in rows if r["attempt"] > 1),
+                "errors": errors,
+                "prompt_tokens": sum(r["prompt_tokens"] for r in rows),
+                "completion_tokens": sum(r["completion_tokens"] for r in rows),
+                "wall_seconds_total": float(seconds.sum()),
+                "api_p50_seconds": float(np.percentile(api_seconds, 50)),
+                "api_p95_seconds": float(np.percentile(api_seconds, 95)),
+                "ttft_p50_seconds": float(np.percentile(ttfts, 50)) if ttfts else None,
+                "ttft_p95_seconds": float(np.percentile(ttfts, 95)) if ttfts else None,
+            })
+        return out
+
+    def report(self, include_calls=True):
+        report = {
+            "run": {
+                "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)),
+                "finished": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "elapsed_seconds": time.time() - self.started,
+            },
+            "summary": self.summary(),
+            "metrics": self.registry.snapshot(),
+        }
+        if include_calls:
+            with self._lock:
+                report["calls"] = list(self.records)
+        return report
+
+    def write_report(self, path, include_calls=True):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(self.report(include_calls), ensure_ascii=False, indent=2), encoding="utf-8")
+        return path
+
+    def write_prometheus(self, path):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(self.registry.render_prometheus(), encoding="utf-8")
+        return path
+
+    def format_summary(self):
+        lines = []
+        for s in self.summary():
+            errors = ", ".join(f"{k}={v}" for k, v in sorted(s["errors"].items())) or "0"
+            ttft = (f", TTFT p50={s['ttft_p50_seconds']:.2f}s p95={s['ttft_p95_seconds']:.2f}s"
+                    if s["ttft_p50_seconds"] is not None else "")
+            lines.append(
+                f"LLM {s['provider']}/{s['model']}: {s['calls']} lời gọi ({s['cache_hits']} cache hit, "
+                f"{s['retries']} retry), lỗi: {errors}, token {s['prompt_tokens']}+{s['completion_tokens']}, "
+                f"API p50={s['api_p50_seconds']:.2f}s p95={s['api_p95_seconds']:.2f}s{ttft}"
+            )
+        return "\n".join(lines) or "LLM: chưa có lời gọi nào"
+
+
+STREAM_TIME_COLUMNS = {
+    "baseline_ttft_seconds": "TTFT Baseline",
+    "critique_ttft_seconds": "TTFT Self-Critique",
+    "critique_final_seconds": "tới câu trả lời Bước 3",
+}
+
+
+def format_stream_times(rows):
+    """rows: list dict theo từng dòng kết quả (các cột STREAM_TIME_COLUMNS). In p50/p95 mỗi cột"""
+    parts = []
+    for col, label in STREAM_TIME_COLUMNS.items():
+        values = [r[col] for r in rows if r.get(col) is not None]
+        if values:
+            parts.append(f"{label} p50={np.percentile(values, 50):.2f}s p95={np.percentile(values, 95):.2f}s")
+    return "Stream: " + (", ".join(parts) or "không có dữ liệu")
+
+
+_default_tracer = None
+_default_lock = threading.Lock()
+
+
+def get_tracer():
+    """Tracer dùng chung trong process (mọi lời gọi qua llm_calls.py)"""
+    global _default_tracer
+    with _default_lock:
+        if _default_tracer is None:
+            _default_tracer = LLMTracer()
+        return _default_tracer
+
+
+def write_run_report(out_dir="results", name="llm"):
+    """Ghi <name>_report_<thời điểm>.json và <name>_metrics.prom cho lần chạy hiện tại"""
+    tracer = get_tracer()
+    stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(tracer.started))
+    report_path = tracer.write_report(Path(out_dir) / f"{name}_report_{stamp}.json")
+    prom_path = tracer.write_prometheus(Path(out_dir) / f"{name}_metrics.prom")
+    return report_path, prom_path
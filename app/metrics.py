@@ -0,0 +1,133 @@
+"""
+Counter / Histogram đơn giản, thread-safe, xuất ra Prometheus text format hoặc dict (JSON).
+"""
+import bisect
+import threading
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _label_str(labels):
+    if not labels:
+        return ""
+    inner = ",".join(f'{k}="{str(v)}"' for k, v in sorted(labels.items()))
+    return "{" + inner + "}"
+
+
+class Counter:
+    def __init__(self, name, help_text=""):
+        self.name = name
+        self.help = help_text
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(sorted(labels.items())), 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_label_str(dict(key))} {value}")
+        return lines
+
+    def snapshot(self):
+        with self._lock:
+            return [{"labels": dict(k), "value": v} for k, v in sorted(self._values.items())]
+
+
+class Histogram:
+    def __init__(self, name, help_text="", buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {
+                    "counts": [0] * (len(self.buckets) + 1),
+                    "sum": 0.0,
+                    "count": 0,
+                }
+            series["counts"][bisect.bisect_left(self.buckets, value)] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    @staticmethod
+    def _quantile(buckets, counts, total, q):
+        """Ước lượng quantile từ bucket (lấy cận trên của bucket chứa quantile)"""
+        if total == 0:
+            return 0.0
+        rank = q * total
+        cumulative = 0
+        for bound, count in zip(list(buckets) + [float("inf")], counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound if bound != float("inf") else buckets[-1]
+        return buckets[-1]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                labels = dict(key)
+                cumulative = 0
+                for bound, count in zip(self.buckets, series["counts"]):
+                    cumulative += count
+                    lines.append(f"{self.name}_bucket{_label_str({**labels, 'le': bound})} {cumulative}")
+                lines.append(f"{self.name}_bucket{_label_str({**labels, 'le': '+Inf'})} {series['count']}")
+                lines.append(f"{self.name}_sum{_label_str(labels)} {series['sum']}")
+                lines.append(f"{self.name}_count{_label_str(labels)} {series['count']}")
+        return lines
+
+    def snapshot(self):
+        out = []
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                total = series["count"]
+                out.append({
+                    "labels": dict(key),
+                    "count": total,
+                    "sum": series["sum"],
+                    "mean": series["sum"] / total if total else 0.0,
+                    "p50": self._quantile(self.buckets, series["counts"], total, 0.5),
+                    "p95": self._quantile(self.buckets, series["counts"], total, 0.95),
+                    "p99": self._quantile(self.buckets, series["counts"], total, 0.99),
+                    "buckets": dict(zip([str(b) for b in self.buckets] + ["+Inf"], series["counts"])),
+                })
+        return out
+
+
+class Registry:
+    """Tập các metric của 1 thành phần, xuất chung 1 lần"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name, help_text=""):
+        with self._lock:
+            return self._metrics.setdefault(name, Counter(name, help_text))
+
+    def histogram(self, name, help_text="", buckets=LATENCY_BUCKETS):
+        with self._lock:
+            return self._metrics.setdefault(name, Histogram(name, help_text, buckets))
+
+    def render_prometheus(self):
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        return {name: metric.snapshot() for name, metric in list(self._metrics.items())}
@@ -0,0 +1,527 @@
+"""
+Server LLM giả lập (chạy local, không cần API key/mạng) để đo throughput của gemini.py,
+openai_experiment.py và gpt.py.
+
+Nói đúng wire format của:
+    POST /v1/chat/completions                       (OpenAI chat completions)
+    POST /v1beta/models/<model>:generateContent     (Gemini REST)
+và có thể cấu hình độ trễ (const / uniform / lognormal + ms mỗi token output), tỉ lệ lỗi
+429/500 chèn ngẫu nhiên, giới hạn RPM/TPM phía server (vượt thì trả 429) và câu trả lời
+theo mẫu "Bước 1/2/3". Kết quả tất định theo --seed: cùng request (và cùng lần thử thứ n)
+luôn cho cùng câu trả lời, cùng độ trễ, cùng lỗi.
+
+JSON mode (OpenAI response_format json_object/json_schema, Gemini responseMimeType
+application/json): trả lời prompt gộp nhiều câu "[q1] ..." của packing.py bằng JSON khoá theo ID,
+--json-drop là tỉ lệ mỗi câu bị bỏ sót hoặc sai kiểu (để thử fallback từng câu).
+
+Stream: OpenAI "stream": true (SSE, kèm chunk usage nếu stream_options.include_usage) và Gemini
+:streamGenerateContent (SSE với ?alt=sse, mảng JSON stream như REST transport của SDK nếu không).
+Token đầu tiên tới sau độ trễ --latency, mỗi đoạn sau đó cách nhau theo --ms-per-token.
+Client ngắt kết nối giữa chừng (huỷ generation) được đếm ở mock_llm_cancelled_total.
+--connect-latency thêm độ trễ cho mỗi kết nối mới (như TCP + TLS handshake), số kết nối đã mở
+ở mock_llm_connections_total: client dùng chung (keep-alive) chỉ trả chi phí này 1 lần mỗi kết nối.
+
+    python app/mock_llm_server.py --port 8766 --latency lognormal:800,0.5 --error-429 0.05 \
+        --answers data/benchmark_viquad_v2.parquet --baseline-accuracy 0.5 --critique-accuracy 0.6
+
+rồi trỏ các script vào server (nên tắt LLM cache để đo đúng):
+    OPENAI_BASE_URL=http://127.0.0.1:8766/v1 GEMINI_BASE_URL=http://127.0.0.1:8766 LLM_CACHE_MODE=off
+
+    GET /stats     số request theo API/status, token, độ trễ, request thành công/giây (JSON)
+    GET /metrics   như trên, Prometheus text
+"""
+import argparse
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from metrics import Registry
+from storage import read_table
+
+_GEMINI_PATH = re.compile(r"^/v1(?:beta)?/models/([^/:]+):(generateContent|streamGenerateContent)")
+_STREAM_PIECE = re.compile(r"\S+\s*|\s+")
+STREAM_WORDS_PER_CHUNK = 3
+_PACKED_QUESTION = re.compile(r"^\[(q\d+)\]\s*(.+?)\s*$", re.MULTILINE)
+_QUESTION_PATTERNS = [
+    re.compile(r"Câu hỏi:\s*(.+?)\s*\n"),
+    re.compile(r"ngắn gọn và chính xác:\s*(.+)$", re.DOTALL),
+]
+
+
+def normalize_question(text):
+    return " ".join(str(text).split())
+
+
+def estimate_tokens(text):
+    # Cùng cách ước lượng với runner.estimate_tokens (~3 ký tự/token tiếng Việt)
+    return max(1, len(text) // 3)
+
+
+def parse_latency(spec):
+    """
+    'const:200' | 'uniform:100,400' | 'lognormal:800,0.5' (trung vị ms, sigma)
+    Returns: hàm rng -> giây
+    """
+    kind, _, args = spec.partition(":")
+    values = [float(v) for v in args.split(",") if v]
+    if kind == "const":
+        return lambda rng: values[0] / 1000.0
+    if kind == "uniform":
+        return lambda rng: rng.uniform(values[0], values[1]) / 1000.0
+    if kind == "lognormal":
+        median, sigma = values[0], values[1] if len(values) > 1 else 0.5
+        return lambda rng: rng.lognormvariate(math.log(median), sigma) / 1000.0
+    raise ValueError(f"Phân phối độ trễ không hợp lệ: {spec}")
+
+
+class WindowLimiter:
+    """Giới hạn RPM/TPM kiểu cửa sổ trượt 60s, không chặn: vượt quota thì trả về False"""
+
+    def __init__(self, rpm=0, tpm=0, window=60.0):
+        self.rpm, self.tpm, self.window = rpm, tpm, window
+        self._events = deque()
+        self._tokens = 0
+        self._lock = threading.Lock()
+
+    def try_acquire(self, tokens):
+        if not self.rpm and not self.tpm:
+            return True, 0.0
+        with self._lock:
+            now = time.monotonic()
+            while self._events and now - self._events[0][0] >= self.window:
+                self._tokens -= self._events.popleft()[1]
+            over_rpm = self.rpm and len(self._events) >= self.rpm
+            over_tpm = self.tpm and self._tokens + tokens > self.tpm
+            if over_rpm or over_tpm:
+                retry_after = self.window - (now - self._events[0][0]) if self._events else 1.0
+                return False, retry_after
+            self._events.append((now, tokens))
+            self._tokens += tokens
+            return True, 0.0
+
+
+class MockLLM:
+    def __init__(self, latency="lognormal:800,0.5", ms_per_token=0.0, error_429=0.0, error_500=0.0,
+                 rpm=0, tpm=0, seed=0, answers=None, baseline_accuracy=0.5, critique_accuracy=0.6,
+                 json_drop=0.0, connect_latency_ms=0.0):
+        self.latency = parse_latency(latency)
+        self.ms_per_token = ms_per_token
+        self.error_429 = error_429
+        self.error_500 = error_500
+        self.limiter = WindowLimiter(rpm, tpm)
+        self.seed = seed
+        self.answers = answers or {}
+        self.accuracy = {"baseline": baseline_accuracy, "critique": critique_accuracy}
+        self.json_drop = json_drop
+        self.connect_latency_ms = connect_latency_ms
+        self._attempts = {}
+        self._lock = threading.Lock()
+        self.started = time.monotonic()
+
+        self.registry = Registry()
+        self.requests = self.registry.counter("mock_llm_requests_total", "Số request theo API và status")
+        self.tokens = self.registry.counter("mock_llm_tokens_total", "Token prompt/completion đã trả về")
+        self.latency_hist = self.registry.histogram("mock_llm_latency_seconds", "Độ trễ giả lập mỗi request")
+        self.cancelled = self.registry.counter("mock_llm_cancelled_total", "Stream bị client ngắt giữa chừng")
+        self.connections = self.registry.counter("mock_llm_connections_total", "Số kết nối TCP client đã mở")
+
+    def _rng(self, body):
+        """RNG tất định theo (seed, nội dung request, lần thử thứ n của cùng request)"""
+        digest = hashlib.sha256(body).hexdigest()
+        with self._lock:
+            attempt = self._attempts.get(digest, 0)
+            self._attempts[digest] = attempt + 1
+        return random.Random(f"{self.seed}:{digest}:{attempt}"), digest
+
+    def _pick(self, question, style):
+        """Đúng ground truth với xác suất accuracy, nếu không thì câu sai tất định theo câu hỏi"""
+        truth = self.answers.get(question)
+        # Đúng/sai quyết định theo nội dung câu hỏi (không theo lần thử, không theo cách gộp câu)
+        # để retry hay packing không đổi kết quả
+        coin = random.Random(f"{self.seed}:{style}:{question}").random()
+        if truth is not None and coin < self.accuracy[style]:
+            return truth
+        digest = hashlib.sha256(f"{style}:{question}".encode("utf-8")).hexdigest()
+        return f"Câu trả lời mô phỏng {digest[:8]}"
+
+    def _answer(self, prompt, rng, digest):
+        """Câu trả lời theo mẫu cho prompt 1 câu hỏi"""
+        style = "critique" if "Bước 3" in prompt else "baseline"
+        question = None
+        for pattern in _QUESTION_PATTERNS:
+            match = pattern.search(prompt)
+            if match:
+                question = normalize_question(match.group(1))
+                break
+        answer = self._pick(question, style)
+        if style == "baseline":
+            return answer
+        return (
+            f"**Bước 1: Câu trả lời ban đầu:**\n{answer}\n\n"
+            f"**Bước 2: Tự phản biện:**\nCâu trả lời ở Bước 1 khớp với thông tin đã biết, "
+            f"không thấy điểm nào cần sửa.\n\n"
+            f"**Bước 3: Câu trả lời cuối cùng (đã xác minh):**\n{answer}\n\n"
+            # Model thật hay viết thêm sau Bước 3: phần này bị bỏ khi client huỷ stream sau Bước 3
+            f"**Ghi chú:** Câu trả lời dựa trên thông tin phổ biến về chủ đề này. Nếu cần độ chính xác "
+            f"tuyệt đối, nên đối chiếu thêm với tài liệu gốc hoặc nguồn chính thức."
+        )
+
+    def _answer_json(self, prompt, rng):
+        """JSON khoá theo ID cho prompt gộp; mỗi câu có xác suất json_drop bị bỏ sót hoặc sai kiểu"""
+        style = "critique" if "Bước 3" in prompt else "baseline"
+        out = {}
+        for qid, question in _PACKED_QUESTION.findall(prompt):
+            answer = self._pick(normalize_question(question), style)
+            roll = rng.random()
+            if roll < self.json_drop / 2:
+                continue
+            if roll < self.json_drop:
+                out[qid] = None
+            elif style == "baseline":
+                out[qid] = answer
+            else:
+                out[qid] = {
+                    "buoc_1": answer,
+                    "buoc_2": "Câu trả lời ở Bước 1 khớp với thông tin đã biết, không thấy điểm nào cần sửa.",
+                    "buoc_3": answer,
+                }
+        return json.dumps(out, ensure_ascii=False)
+
+    def complete(self, api, prompt, body, json_mode=False, stream=False):
+        """
+        Returns: (status, text hoặc None, usage dict, retry_after) sau khi đã chờ độ trễ giả lập.
+        stream=True: chỉ chờ tới token đầu tiên, phần còn lại do stream_pieces giãn theo ms_per_token
+        (token completion được đếm theo từng đoạn đã gửi).
+        """
+        rng, digest = self._rng(body)
+        prompt_tokens = estimate_tokens(prompt)
+        text = self._answer_json(prompt, rng) if json_mode else self._answer(prompt, rng, digest)
+        completion_tokens = estimate_tokens(text)
+        usage = {"prompt": prompt_tokens, "completion": completion_tokens}
+
+        ok, retry_after = self.limiter.try_acquire(prompt_tokens + completion_tokens)
+        roll = rng.random()
+        if not ok or roll < self.error_429:
+            status = 429
+            delay = 0.005
+        elif roll < self.error_429 + self.error_500:
+            status = 500
+            delay = self.latency(rng)
+        else:
+            status = 200
+            delay = self.latency(rng)
+            if not stream:
+                delay += completion_tokens * self.ms_per_token / 1000.0
+        time.sleep(delay)
+
+        self.latency_hist.observe(delay, api=api)
+        self.requests.inc(api=api, status=str(status))
+        if status == 200:
+            self.tokens.inc(prompt_tokens, api=api, kind="prompt")
+            if not stream:
+                self.tokens.inc(completion_tokens, api=api, kind="completion")
+            return status, text, usage, 0.0
+        return status, None, usage, retry_after or 1.0
+
+    def stream_pieces(self, api, text):
+        """Chia text thành các đoạn vài từ, chờ theo ms_per_token trước khi trả mỗi đoạn"""
+        words = _STREAM_PIECE.findall(text)
+        for i in range(0, len(words), STREAM_WORDS_PER_CHUNK):
+            piece = "".join(words[i:i + STREAM_WORDS_PER_CHUNK])
+            tokens = estimate_tokens(piece)
+            if i:
+                time.sleep(tokens * self.ms_per_token / 1000.0)
+            self.tokens.inc(tokens, api=api, kind="completion")
+            yield piece
+
+    def stats(self):
+        elapsed = time.monotonic() - self.started
+        ok = sum(v["value"] for v in self.requests.snapshot() if v["labels"].get("status") == "200")
+        return {
+            "uptime_seconds": elapsed,
+            "ok_per_sec": ok / elapsed if elapsed > 0 else 0.0,
+            **self.registry.snapshot(),
+        }
+
+
+class MockHTTPServer(ThreadingHTTPServer):
+    request_queue_size = 512
+    daemon_threads = True
+
+
+def _openai_prompt(payload):
+    messages = payload.get("messages") or []
+    for message in reversed(messages):
+        if message.get("role") == "user":
+            content = message.get("content")
+            if isinstance(content, list):
+                return "".join(part.get("text", "") for part in content if isinstance(part, dict))
+            return str(content or "")
+    return ""
+
+
+def _gemini_prompt(payload):
+    texts = []
+    for content in payload.get("contents") or []:
+        for part in content.get("parts") or []:
+            texts.append(part.get("text", ""))
+    return "".join(texts)
+
+
+def _json_mode(api, payload):
+    if api == "openai":
+        return (payload.get("response_format") or {}).get("type") in ("json_object", "json_schema")
+    config = payload.get("generationConfig") or payload.get("generation_config") or {}
+    mime = config.get("responseMimeType") or config.get("response_mime_type")
+    return mime == "application/json"
+
+
+def _error_body(api, status):
+    if api == "openai":
+        kind = "rate_limit_error" if status == 429 else "server_error"
+        return {"error": {"message": f"Mock {status}", "type": kind, "code": kind}}
+    name = "RESOURCE_EXHAUSTED" if status == 429 else "INTERNAL"
+    return {"error": {"code": status, "message": f"Mock {status}", "status": name}}
+
+
+def make_handler(mock):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive cho client dùng connection pool
+
+        def setup(self):
+            super().setup()
+            mock.connections.inc()
+            # Giả lập chi phí mở kết nối mới (TCP + TLS handshake tới API thật)
+            if mock.connect_latency_ms:
+                time.sleep(mock.connect_latency_ms / 1000)
+
+        def _json(self, status, obj, headers=None):
+            data = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _stream(self, api, content_type, frames):
+            """Gửi từng frame bằng chunked transfer encoding; client ngắt giữa chừng thì dừng"""
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            try:
+                for frame in frames:
+                    data = frame.encode("utf-8")
+                    self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+                    self.wfile.flush()
+                self.wfile.write(b"0\r\n\r\n")
+            except (BrokenPipeError, ConnectionResetError):
+                mock.cancelled.inc(api=api)
+                self.close_connection = True
+
+        def _openai_frames(self, payload, body, text, usage):
+            base = {
+                "id": f"chatcmpl-mock-{hashlib.sha1(body).hexdigest()[:12]}",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": payload.get("model", "mock"),
+            }
+            sse = lambda obj: f"data: {json.dumps(obj, ensure_ascii=False)}\n\n"
+            yield sse({**base, "choices": [{"index": 0, "delta": {"role": "assistant", "content": ""},
+                                            "finish_reason": None}]})
+            for piece in mock.stream_pieces("openai", text):
+                yield sse({**base, "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]})
+            yield sse({**base, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+            if (payload.get("stream_options") or {}).get("include_usage"):
+                yield sse({**base, "choices": [], "usage": {
+                    "prompt_tokens": usage["prompt"],
+                    "completion_tokens": usage["completion"],
+                    "total_tokens": usage["prompt"] + usage["completion"],
+                }})
+            yield "data: [DONE]\n\n"
+
+        def _gemini_frames(self, model_name, text, usage, sse):
+            first = True
+            for piece in mock.stream_pieces("gemini", text):
+                obj = {
+                    "candidates": [{"content": {"parts": [{"text": piece}], "role": "model"}, "index": 0}],
+                    "modelVersion": model_name,
+                }
+                if sse:
+                    yield f"data: {json.dumps(obj, ensure_ascii=False)}\r\n\r\n"
+                else:
+                    yield ("[" if first else ",\r\n") + json.dumps(obj, ensure_ascii=False)
+                first = False
+            last = {
+                "candidates": [{"content": {"parts": [{"text": ""}], "role": "model"},
+                                "finishReason": "STOP", "index": 0}],
+                "usageMetadata": {
+                    "promptTokenCount": usage["prompt"],
+                    "candidatesTokenCount": usage["completion"],
+                    "totalTokenCount": usage["prompt"] + usage["completion"],
+                },
+                "modelVersion": model_name,
+            }
+            if sse:
+                yield f"data: {json.dumps(last, ensure_ascii=False)}\r\n\r\n"
+            else:
+                yield ("[" if first else ",\r\n") + json.dumps(last, ensure_ascii=False) + "]"
+
+        def do_GET(self):
+            if self.path == "/stats":
+                self._json(200, mock.stats())
+            elif self.path == "/metrics":
+                data = mock.registry.render_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+            elif self.path == "/health":
+                self._json(200, {"status": "ok"})
+            else:
+                self._json(404, {"error": "not found"})
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            body = self.rfile.read(length)
+            path = self.path.split("?", 1)[0]
+            gemini_match = _GEMINI_PATH.match(path)
+            if path.endswith("/chat/completions"):
+                api = "openai"
+            elif gemini_match:
+                api = "gemini"
+            else:
+                self._json(404, {"error": {"message": f"not found: {path}"}})
+                return
+            try:
+                payload = json.loads(body or b"{}")
+            except ValueError as e:
+                self._json(400, {"error": {"message": f"JSON không hợp lệ: {e}"}})
+                return
+
+            prompt = _openai_prompt(payload) if api == "openai" else _gemini_prompt(payload)
+            if api == "openai":
+                stream = bool(payload.get("stream"))
+            else:
+                stream = gemini_match.group(2) == "streamGenerateContent"
+            status, text, usage, retry_after = mock.complete(api, prompt, body, _json_mode(api, payload), stream)
+            if status != 200:
+                self._json(status, _error_body(api, status), {"Retry-After": f"{retry_after:.0f}"})
+                return
+
+            if stream and api == "openai":
+                self._stream(api, "text/event-stream", self._openai_frames(payload, body, text, usage))
+                return
+            if stream:
+                sse = "alt=sse" in self.path
+                self._stream(api, "text/event-stream" if sse else "application/json; charset=utf-8",
+                             self._gemini_frames(gemini_match.group(1), text, usage, sse))
+                return
+
+            if api == "openai":
+                self._json(200, {
+                    "id": f"chatcmpl-mock-{hashlib.sha1(body).hexdigest()[:12]}",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": payload.get("model", "mock"),
+                    "choices": [{
+                        "index": 0,
+                        "message": {"role": "assistant", "content": text},
+                        "finish_reason": "stop",
+                    }],
+                    "usage": {
+                        "prompt_tokens": usage["prompt"],
+                        "completion_tokens": usage["completion"],
+                        "total_tokens": usage["prompt"] + usage["completion"],
+                    },
+                })
+            else:
+                self._json(200, {
+                    "candidates": [{
+                        "content": {"parts": [{"text": text}], "role": "model"},
+                        "finishReason": "STOP",
+                        "index": 0,
+                        "safetyRatings": [],
+                    }],
+                    "usageMetadata": {
+                        "promptTokenCount": usage["prompt"],
+                        "candidatesTokenCount": usage["completion"],
+                        "totalTokenCount": usage["prompt"] + usage["completion"],
+                    },
+                    "modelVersion": gemini_match.group(1),
+                })
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def load_answers(paths):
+    """dict câu hỏi -> ground truth từ các bảng benchmark (để trả lời đúng theo xác suất)"""
+    answers = {}
+    for path in paths:
+        df = read_table(path, columns=["question", "ground_truth"])
+        answers.update(zip(df["question"].map(normalize_question), df["ground_truth"].astype(str)))
+    return answers
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Server LLM giả lập (OpenAI + Gemini) để benchmark offline")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--latency", default="lognormal:800,0.5",
+                        help="const:MS | uniform:LO,HI | lognormal:TRUNG_VỊ_MS,SIGMA")
+    parser.add_argument("--ms-per-token", type=float, default=0.0, help="Thêm độ trễ theo số token output")
+    parser.add_argument("--error-429", type=float, default=0.0, help="Tỉ lệ trả 429 ngẫu nhiên")
+    parser.add_argument("--error-500", type=float, default=0.0, help="Tỉ lệ trả 500 ngẫu nhiên")
+    parser.add_argument("--rpm", type=int, default=0, help="Giới hạn request/phút phía server (0 = không)")
+    parser.add_argument("--tpm", type=int, default=0, help="Giới hạn token/phút phía server (0 = không)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--answers", nargs="*", default=[], help="Bảng benchmark để lấy đáp án đúng")
+    parser.add_argument("--baseline-accuracy", type=float, default=0.5)
+    parser.add_argument("--critique-accuracy", type=float, default=0.6)
+    parser.add_argument("--json-drop", type=float, default=0.0,
+                        help="JSON mode: tỉ lệ mỗi câu trong request gộp bị bỏ sót/sai kiểu")
+    parser.add_argument("--connect-latency", type=float, default=0.0,
+                        help="ms thêm vào mỗi kết nối mới (giả lập TCP + TLS handshake)")
+    args = parser.parse_args()
+
+    mock = MockLLM(
+        latency=args.latency,
+        ms_per_token=args.ms_per_token,
+        error_429=args.error_429,
+        error_500=args.error_500,
+        rpm=args.rpm,
+        tpm=args.tpm,
+        seed=args.seed,
+        answers=load_answers(args.answers),
+        baseline_accuracy=args.baseline_accuracy,
+        critique_accuracy=args.critique_accuracy,
+        json_drop=args.json_drop,
+        connect_latency_ms=args.connect_latency,
+    )
+    server = MockHTTPServer((args.host, args.port), make_handler(mock))
+    print(f"🧪 Mock LLM tại http://{args.host}:{args.port} (độ trễ {args.latency}, "
+          f"429={args.error_429}, 500={args.error_500}, {len(mock.answers)} đáp án)")
+    print(f"   OPENAI_BASE_URL=http://{args.host}:{args.port}/v1  GEMINI_BASE_URL=http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(mock.stats(), ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,14 +2,24 @@
 Thí nghiệm Reducing Hallucinations với OpenAI GPT
 Thay thế cho Gemini nếu không có API access
 """
-import os, json, re
-import pandas as pd
+import os, time
 import numpy as np
 from dotenv import load_dotenv
 from pathlib import Path
 from tqdm import tqdm
 from difflib import SequenceMatcher
 from openai import OpenAI
+from llm_cache import get_default_cache
+from llm_calls import openai_chat, openai_chat_stream, stream_answer
+from llm_tracing import format_stream_times, get_tracer, write_run_report
+from runner import get_retry_policy
+from scoring import failed_rows
+from prompts import get_baseline_prompt, get_critique_prompt
+from checkpoint import ResultLog
+from storage import read_corpus, table_path, write_table
+from dedup import canonical_texts
+from embedding_store import current_dir
+from extraction import extract_final_answer
 
 # --- 1. CẤU HÌNH ---
 load_dotenv()
@@ -19,51 +29,49 @@ if not OPENAI_API_KEY:
     print("Không tìm thấy OPENAI_API_KEY trong file .env")
     exit()
 
-client = OpenAI(api_key=OPENAI_API_KEY)
+MODEL_NAME = "gpt-4o-mini"
+
+# OPENAI_BASE_URL: trỏ sang server khác (vd mock_llm_server.py để đo throughput offline)
+# max_retries=0: retry do RETRY_POLICY lo (backoff + retry budget, và mọi lần thử đều được tracing)
+client = OpenAI(api_key=OPENAI_API_KEY, base_url=os.getenv("OPENAI_BASE_URL") or None, max_retries=0)
+RETRY_POLICY = get_retry_policy(f"openai/{MODEL_NAME}", max_concurrency=1)
+
+# Stream output: đo TTFT và thời gian tới câu trả lời Bước 3 cho từng câu (như GEMINI_STREAM trong gemini.py).
+# OPENAI_STREAM_CANCEL=1: dừng generation của Self-Critique ngay sau Bước 3
+STREAM = os.getenv("OPENAI_STREAM", "0") == "1"
+STREAM_CANCEL = STREAM and os.getenv("OPENAI_STREAM_CANCEL", "0") == "1"
+
+
+def chat(prompt):
+    """1 lời gọi chat (có retry lỗi tạm thời), raise nếu vẫn lỗi sau mọi lần thử"""
+    return RETRY_POLICY.call(lambda attempt: openai_chat(
+        client,
+        attempt=attempt,
+        model=MODEL_NAME,
+        messages=[{"role": "user", "content": prompt}],
+        temperature=0
+    ))
+
+def chat_streamed(prompt, critique=False):
+    """
+    Như chat() nhưng stream. Returns: (text, dict ttft_seconds [+ final_answer, final_seconds
+    khi critique=True: câu trả lời Bước 3 được trích trong lúc stream])
+    """
+    return RETRY_POLICY.call(lambda attempt: stream_answer(
+        lambda **stream: openai_chat_stream(
+            client,
+            attempt=attempt,
+            model=MODEL_NAME,
+            messages=[{"role": "user", "content": prompt}],
+            temperature=0,
+            **stream,
+        ),
+        critique=critique,
+        cancel=STREAM_CANCEL,
+    ))
 
 # --- 2. ĐỊNH NGHĨA PROMPT ---
-
-def get_baseline_prompt(question):
-    """Trả về prompt đơn giản"""
-    return f"Hãy trả lời câu hỏi sau một cách ngắn gọn và chính xác: {question}"
-
-def get_critique_prompt(question):
-    """Trả về prompt tự phản biện 3 bước"""
-    return f"""
-Bạn là một trợ lý AI cẩn trọng, luôn kiểm tra lại thông tin.
-Nhiệm vụ của bạn là trả lời câu hỏi sau bằng quy trình 3 bước.
-
-Câu hỏi: {question}
-
----
-[BẮT ĐẦU QUY TRÌNH]
-
-**Bước 1: Câu trả lời ban đầu:**
-[Hãy tạo câu trả lời ban đầu của bạn ở đây]
-
-**Bước 2: Tự phản biện:**
-[Hãy xem xét lại câu trả lời ở Bước 1. Nó có chính xác không? Có "hallucinate" điểm nào không? Có thể cải thiện ở đâu?]
-
-**Bước 3: Câu trả lời cuối cùng (đã xác minh):**
-[Dựa trên phản biện ở Bước 2, hãy đưa ra câu trả lời cuối cùng, chính xác nhất.]
-"""
-
-def extract_final_answer(critique_text):
-    """Trích xuất câu trả lời cuối cùng từ Bước 3"""
-    patterns = [
-        r'\*\*Bước 3[:\s]+.*?\*\*[:\s]*(.*?)(?=\n\n|\Z)',
-        r'Câu trả lời cuối cùng[:\s]*\*\*[:\s]*(.*?)(?=\n\n|\Z)',
-        r'Bước 3[:\s]+(.*?)(?=\n\n|\Z)',
-    ]
-    
-    for pattern in patterns:
-        match = re.search(pattern, critique_text, re.DOTALL | re.IGNORECASE)
-        if match:
-            answer = match.group(1).strip()
-            answer = answer.strip('*[](){}')
-            return answer
-    
-    return critique_text.strip()
+# get_baseline_prompt, get_critique_prompt: dùng chung với gemini.py (prompts.py)
 
 def calculate_similarity(text1, text2):
     """Tính độ tương đồng giữa 2 string (0-1)"""
@@ -82,13 +90,12 @@ def evaluate_answer(predicted, ground_truth, threshold=0.6):
 # --- 3. TẢI DATASET ---
 
 DATA_DIR = Path("data")
-if not (DATA_DIR / "questions.json").exists():
-    print("Không tìm thấy file questions.json hoặc answers.json trong thư mục data/")
+try:
+    all_questions, all_answers_ground_truth = read_corpus(current_dir(DATA_DIR))
+except FileNotFoundError:
+    print("Không tìm thấy corpus (corpus.parquet hoặc questions.json/answers.json) trong thư mục data/")
     exit()
 
-all_questions = json.loads((DATA_DIR / "questions.json").read_text(encoding="utf-8"))
-all_answers_ground_truth = json.loads((DATA_DIR / "answers.json").read_text(encoding="utf-8"))
-
 NUM_SAMPLES = 10  # Bắt đầu với 10 mẫu
 
 benchmark_data = []
@@ -99,49 +106,76 @@ for i in range(min(NUM_SAMPLES, len(all_questions))):
         "ground_truth": all_answers_ground_truth[i]
     })
 
+# Câu trùng/gần trùng dùng chung câu hỏi đại diện của cụm (dedup.py) làm prompt:
+# cùng prompt nên chỉ lần đầu gọi API, các lần sau trúng LLM cache
+for item, canonical_q in zip(benchmark_data, canonical_texts([item["question"] for item in benchmark_data])):
+    item["prompt_question"] = canonical_q
+
 print(f"Đã tải {len(benchmark_data)} câu hỏi từ ViQuAD để làm benchmark.")
 print(f"Bắt đầu chạy thí nghiệm so sánh Baseline vs Self-Critique...\n")
 
 # --- 4. CHẠY THÍ NGHIỆM ---
 
-results = []
-
-for item in tqdm(benchmark_data, desc="Đang chạy thí nghiệm"):
+# Log JSONL: mỗi câu được ghi ngay khi chạy xong, chạy lại sẽ bỏ qua các câu đã có
+# (trừ câu bị lỗi sau mọi lần retry: được chạy lại)
+output_log_file = "experiment_results_openai.jsonl"
+result_log = ResultLog(output_log_file, key_col="id")
+done = {
+    record["id"] for record in result_log.iter_records()
+    if not record.get("baseline_failed") and not record.get("critique_failed")
+}
+todo_data = [item for item in benchmark_data if item["id"] not in done]
+if done:
+    print(f"↩️  Tiếp tục từ log: đã có {len(done)} câu, còn {len(todo_data)} câu cần chạy.")
+
+run_start = time.perf_counter()
+stream_rows = []
+for item in tqdm(todo_data, desc="Đang chạy thí nghiệm"):
     q = item["question"]
     gt = item["ground_truth"]
+    prompt_q = item["prompt_question"]
     
     # 1. Chạy Baseline
+    bl_failed = sc_failed = False
+    stream_bl, stream_sc = {}, {}
     try:
-        response_bl = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "user", "content": get_baseline_prompt(q)}],
-            temperature=0
-        )
-        answer_bl = response_bl.choices[0].message.content.strip()
+        if STREAM:
+            answer_bl, stream_bl = chat_streamed(get_baseline_prompt(prompt_q))
+        else:
+            answer_bl = chat(get_baseline_prompt(prompt_q)).strip()
     except Exception as e:
         print(f"\nLỗi khi chạy Baseline câu {item['id']}: {e}")
         answer_bl = f"[LỖI: {e}]"
+        bl_failed = True
 
     # 2. Chạy Self-Critique
     try:
-        response_sc = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "user", "content": get_critique_prompt(q)}],
-            temperature=0
-        )
-        answer_sc_full = response_sc.choices[0].message.content.strip()
-        answer_sc_final = extract_final_answer(answer_sc_full)
+        if STREAM:
+            answer_sc_full, stream_sc = chat_streamed(get_critique_prompt(prompt_q), critique=True)
+            answer_sc_final = stream_sc["final_answer"]
+        else:
+            answer_sc_full = chat(get_critique_prompt(prompt_q)).strip()
+            answer_sc_final = extract_final_answer(answer_sc_full)
     except Exception as e:
         print(f"\nLỗi khi chạy Self-Critique câu {item['id']}: {e}")
         answer_sc_full = f"[LỖI: {e}]"
         answer_sc_final = f"[LỖI: {e}]"
+        sc_failed = True
 
     # 3. Đánh giá
     bl_correct, bl_sim = evaluate_answer(answer_bl, gt)
     sc_correct, sc_sim = evaluate_answer(answer_sc_final, gt)
 
-    # 4. Lưu kết quả
-    results.append({
+    # 4. Ghi kết quả xuống log ngay
+    stream_times = {}
+    if STREAM:
+        stream_times = {
+            "baseline_ttft_seconds": stream_bl.get("ttft_seconds"),
+            "critique_ttft_seconds": stream_sc.get("ttft_seconds"),
+            "critique_final_seconds": stream_sc.get("final_seconds"),
+        }
+        stream_rows.append(stream_times)
+    result_log.append({
         "id": item["id"],
         "question": q,
         "ground_truth": gt,
@@ -151,35 +185,59 @@ for item in tqdm(benchmark_data, desc="Đang chạy thí nghiệm"):
         "critique_answer_full": answer_sc_full,
         "critique_answer_final": answer_sc_final,
         "critique_correct": sc_correct,
-        "critique_similarity": sc_sim
+        "critique_similarity": sc_sim,
+        "baseline_failed": bl_failed,
+        "critique_failed": sc_failed,
+        **stream_times,
     })
 
+result_log.close()
+run_seconds = time.perf_counter() - run_start
+if todo_data:
+    print(f"⏱️  {len(todo_data)} câu trong {run_seconds:.1f}s ({len(todo_data) / max(run_seconds, 1e-9):.2f} câu/giây)")
+    print(f"🔁 {RETRY_POLICY.format_stats()}")
+    if stream_rows:
+        print(f"⚡ {format_stream_times(stream_rows)}")
+
 # --- 5. PHÂN TÍCH KẾT QUẢ ---
-df_results = pd.DataFrame(results)
+# Đọc lại toàn bộ log 1 lượt để tạo CSV và báo cáo
+df_results = result_log.to_dataframe()
+df_results = df_results[df_results["id"] < len(benchmark_data)]
+if df_results.empty:
+    print("Không có kết quả nào để phân tích.")
+    exit()
+
+# Câu lỗi API (sau mọi lần retry) không tính vào accuracy
+failed = failed_rows(df_results)
+num_failed = int(failed.sum())
+df_scored = df_results[~failed]
+if df_scored.empty:
+    print(f"Cả {num_failed} câu đều lỗi API, chạy lại để thử tiếp.")
+    exit()
 
-baseline_accuracy = df_results['baseline_correct'].sum() / len(df_results) * 100
-critique_accuracy = df_results['critique_correct'].sum() / len(df_results) * 100
+baseline_accuracy = df_scored['baseline_correct'].sum() / len(df_scored) * 100
+critique_accuracy = df_scored['critique_correct'].sum() / len(df_scored) * 100
 
-baseline_avg_similarity = df_results['baseline_similarity'].mean()
-critique_avg_similarity = df_results['critique_similarity'].mean()
+baseline_avg_similarity = df_scored['baseline_similarity'].mean()
+critique_avg_similarity = df_scored['critique_similarity'].mean()
 
 accuracy_improvement = critique_accuracy - baseline_accuracy
 relative_improvement = (accuracy_improvement / baseline_accuracy * 100) if baseline_accuracy > 0 else 0
 
-sc_better = (df_results['critique_similarity'] > df_results['baseline_similarity']).sum()
-bl_better = (df_results['baseline_similarity'] > df_results['critique_similarity']).sum()
-equal = (df_results['baseline_similarity'] == df_results['critique_similarity']).sum()
+sc_better = (df_scored['critique_similarity'] > df_scored['baseline_similarity']).sum()
+bl_better = (df_scored['baseline_similarity'] > df_scored['critique_similarity']).sum()
+equal = (df_scored['baseline_similarity'] == df_scored['critique_similarity']).sum()
 
 # --- 6. LƯU KẾT QUẢ ---
-output_file = "experiment_results_openai.csv"
-df_results.to_csv(output_file, index=False, encoding="utf-8-sig")
+output_file = table_path("experiment_results_openai")
+write_table(df_results, output_file)
 
 # --- 7. IN BÁO CÁO ---
 print("\n" + "="*70)
 print("📊 KẾT QUẢ THÍ NGHIỆM: REDUCING HALLUCINATIONS VỚI SELF-CRITIQUE")
 print("="*70)
 print(f"\n📌 Thông tin thí nghiệm:")
-print(f"   • Số câu hỏi test: {len(df_results)}")
+print(f"   • Số câu hỏi test: {len(df_scored)} ({num_failed} câu lỗi API không tính)")
 print(f"   • Dataset: ViQuAD")
 print(f"   • Model: GPT-4o-mini (OpenAI)")
 print(f"   • Similarity threshold: 0.6 (60%)")
@@ -188,12 +246,12 @@ print(f"\n📈 KẾT QUẢ CHÍNH:")
 print(f"\n   1️⃣  BASELINE (Direct Prompt):")
 print(f"      • Accuracy: {baseline_accuracy:.2f}%")
 print(f"      • Average Similarity: {baseline_avg_similarity:.4f}")
-print(f"      • Số câu trả lời đúng: {df_results['baseline_correct'].sum()}/{len(df_results)}")
+print(f"      • Số câu trả lời đúng: {df_scored['baseline_correct'].sum()}/{len(df_scored)}")
 
 print(f"\n   2️⃣  SELF-CRITIQUE (3-Step Prompt):")
 print(f"      • Accuracy: {critique_accuracy:.2f}%")
 print(f"      • Average Similarity: {critique_avg_similarity:.4f}")
-print(f"      • Số câu trả lời đúng: {df_results['critique_correct'].sum()}/{len(df_results)}")
+print(f"      • Số câu trả lời đúng: {df_scored['critique_correct'].sum()}/{len(df_scored)}")
 
 print(f"\n   ✨ IMPROVEMENT:")
 print(f"      • Accuracy Improvement: {accuracy_improvement:+.2f}% (absolute)")
@@ -201,11 +259,15 @@ print(f"      • Relative Improvement: {relative_improvement:+.2f}%")
 print(f"      • Similarity Improvement: {critique_avg_similarity - baseline_avg_similarity:+.4f}")
 
 print(f"\n   📊 So sánh từng câu:")
-print(f"      • Self-Critique tốt hơn: {sc_better} câu ({sc_better/len(df_results)*100:.1f}%)")
-print(f"      • Baseline tốt hơn: {bl_better} câu ({bl_better/len(df_results)*100:.1f}%)")
-print(f"      • Bằng nhau: {equal} câu ({equal/len(df_results)*100:.1f}%)")
+print(f"      • Self-Critique tốt hơn: {sc_better} câu ({sc_better/len(df_scored)*100:.1f}%)")
+print(f"      • Baseline tốt hơn: {bl_better} câu ({bl_better/len(df_scored)*100:.1f}%)")
+print(f"      • Bằng nhau: {equal} câu ({equal/len(df_scored)*100:.1f}%)")
 
 print(f"\n💾 Chi tiết đầy đủ đã được lưu vào: {output_file}")
+print(f"🗄️ {get_default_cache().format_stats()}")
+print(f"📈 {get_tracer().format_summary()}")
+report_path, prom_path = write_run_report("results", "openai")
+print(f"📈 Báo cáo lời gọi LLM: {report_path} (Prometheus: {prom_path})")
 print("="*70)
 
 print("\n✅ HOÀN TẤT THÍ NGHIỆM!")
@@ -0,0 +1,181 @@
+"""
+Gộp K câu hỏi vào 1 request (packing) với output JSON có schema chặt, khoá theo ID câu hỏi.
+
+Câu hỏi factoid ngắn (ViQuAD) thì phần hướng dẫn trong prompt và chi phí mỗi round-trip
+lớn hơn nhiều so với bản thân câu hỏi, nên gộp K câu giảm số request đi ~K lần.
+
+- baseline: {"q1": "câu trả lời", "q2": "..."}
+- critique: {"q1": {"buoc_1": "...", "buoc_2": "...", "buoc_3": "..."}, ...}
+  (được ghép lại thành văn bản "**Bước 1/2/3**" như prompt 1 câu, để extract_final_answer
+  và cột critique_answer_full không đổi)
+
+Câu nào thiếu trong JSON, sai kiểu hoặc rỗng (hoặc cả response không parse được) thì
+được gọi lại riêng bằng prompt 1 câu (fallback từng câu).
+"""
+import json
+import re
+import threading
+
+from llm_tracing import classify_error
+
+PACK_KINDS = ("baseline", "critique")
+CRITIQUE_FIELDS = ("buoc_1", "buoc_2", "buoc_3")
+# Lỗi của cả request gộp mà gọi lại từng câu cũng sẽ gặp (quota, server): không fallback
+_NO_FALLBACK_ERRORS = ("rate_limit", "server", "timeout", "auth")
+
+_FENCE = re.compile(r"^```(?:json)?\s*|\s*```$")
+
+
+def question_ids(n):
+    return [f"q{i + 1}" for i in range(n)]
+
+
+def _one_line(text):
+    return " ".join(str(text).split())
+
+
+def packed_prompt(kind, items):
+    """items: list (id, câu hỏi). Mỗi câu 1 dòng "[q1] ..." (mock_llm_server cũng đọc theo dạng này)"""
+    questions = "\n".join(f"[{qid}] {_one_line(q)}" for qid, q in items)
+    if kind == "baseline":
+        return (
+            "Hãy trả lời từng câu hỏi sau một cách ngắn gọn và chính xác.\n"
+            "Chỉ trả về 1 JSON object: khoá là ID câu hỏi, giá trị là câu trả lời (chuỗi), "
+            'ví dụ {"q1": "...", "q2": "..."}. Không bỏ sót câu nào.\n\n'
+            f"Các câu hỏi:\n{questions}\n"
+        )
+    return f"""
+Bạn là một trợ lý AI cẩn trọng, luôn kiểm tra lại thông tin.
+Với TỪNG câu hỏi dưới đây, hãy trả lời bằng quy trình 3 bước:
+- Bước 1: Câu trả lời ban đầu
+- Bước 2: Tự phản biện (câu trả lời ở Bước 1 có chính xác không? Có "hallucinate" điểm nào không?)
+- Bước 3: Câu trả lời cuối cùng (đã xác minh), ngắn gọn
+
+Chỉ trả về 1 JSON object: khoá là ID câu hỏi, giá trị là object {{"buoc_1": "...", "buoc_2": "...", "buoc_3": "..."}}.
+Không bỏ sót câu nào.
+
+Các câu hỏi:
+{questions}
+"""
+
+
+def response_schema(kind, ids):
+    """JSON schema của response (SDK Gemini nhận trực tiếp qua generation_config.response_schema)"""
+    if kind == "baseline":
+        item = {"type": "string"}
+    else:
+        item = {
+            "type": "object",
+            "properties": {field: {"type": "string"} for field in CRITIQUE_FIELDS},
+            "required": list(CRITIQUE_FIELDS),
+        }
+    return {"type": "object", "properties": {qid: item for qid in ids}, "required": list(ids)}
+
+
+def openai_response_format(kind, ids):
+    """response_format structured output (strict) của OpenAI: mọi object phải có additionalProperties=false"""
+    def strict(schema):
+        if schema.get("type") == "object":
+            schema = {**schema, "additionalProperties": False,
+                      "properties": {k: strict(v) for k, v in schema["properties"].items()}}
+        return schema
+
+    return {
+        "type": "json_schema",
+        "json_schema": {"name": f"packed_{kind}", "strict": True, "schema": strict(response_schema(kind, ids))},
+    }
+
+
+def format_critique(item):
+    """Ghép 3 bước thành văn bản giống output của prompt 1 câu"""
+    return (
+        f"**Bước 1: Câu trả lời ban đầu:**\n{item['buoc_1'].strip()}\n\n"
+        f"**Bước 2: Tự phản biện:**\n{item['buoc_2'].strip()}\n\n"
+        f"**Bước 3: Câu trả lời cuối cùng (đã xác minh):**\n{item['buoc_3'].strip()}"
+    )
+
+
+def parse_packed_response(text, kind, ids):
+    """
+    Returns: dict id -> text cho các câu hợp lệ. Câu thiếu/sai kiểu/rỗng không có trong dict.
+    Chấp nhận JSON bọc trong ```json ... ``` hoặc có chữ thừa trước/sau object.
+    """
+    text = _FENCE.sub("", str(text or "").strip())
+    try:
+        data = json.loads(text)
+    except ValueError:
+        start, end = text.find("{"), text.rfind("}")
+        try:
+            data = json.loads(text[start:end + 1]) if 0 <= start < end else None
+        except ValueError:
+            data = None
+    if not isinstance(data, dict):
+        return {}
+
+    out = {}
+    for qid in ids:
+        value = data.get(qid)
+        if kind == "baseline":
+            if isinstance(value, str) and value.strip():
+                out[qid] = value.strip()
+        elif isinstance(value, dict) and all(isinstance(value.get(f), str) for f in CRITIQUE_FIELDS) \
+                and value["buoc_3"].strip():
+            out[qid] = format_critique(value)
+    return out
+
+
+class PackStats:
+    """Đếm số request gộp, số câu lấy được từ JSON và số câu phải gọi lại riêng"""
+
+    def __init__(self):
+        self.packs = 0
+        self.items = 0
+        self.parsed = 0
+        self.fallback = 0
+        self.failed_packs = 0
+        self._lock = threading.Lock()
+
+    def add(self, items, parsed, fallback, failed_pack=False):
+        with self._lock:
+            self.packs += 1
+            self.items += items
+            self.parsed += parsed
+            self.fallback += fallback
+            self.failed_packs += failed_pack
+
+    def format(self):
+        pct = self.parsed / self.items * 100 if self.items else 0.0
+        return (f"Packing: {self.packs} request gộp, {self.parsed}/{self.items} câu lấy từ JSON ({pct:.1f}%), "
+                f"{self.fallback} câu gọi lại riêng, {self.failed_packs} request gộp lỗi")
+
+
+def answer_pack(kind, questions, call_packed, call_single, stats=None):
+    """
+    Trả lời 1 nhóm câu hỏi bằng 1 request gộp, câu nào không lấy được thì gọi riêng.
+    call_packed(prompt, ids) -> text JSON; call_single(question) -> text (cả 2 raise khi lỗi).
+    Returns: list (text, error) theo đúng thứ tự questions, một trong hai là None.
+    """
+    ids = question_ids(len(questions))
+    parsed, pack_error = {}, None
+    try:
+        parsed = parse_packed_response(call_packed(packed_prompt(kind, zip(ids, questions)), ids), kind, ids)
+    except Exception as e:
+        pack_error = e
+
+    results = []
+    fallback = 0
+    for qid, question in zip(ids, questions):
+        if qid in parsed:
+            results.append((parsed[qid], None))
+        elif pack_error is not None and classify_error(pack_error) in _NO_FALLBACK_ERRORS:
+            # Đã hết lần retry vì quota/server: gọi lại K lần riêng lẻ chỉ làm quá tải thêm
+            results.append((None, pack_error))
+        else:
+            fallback += 1
+            try:
+                results.append((call_single(question), None))
+            except Exception as e:
+                results.append((None, e))
+    if stats is not None:
+        stats.add(len(questions), len(parsed), fallback, failed_pack=pack_error is not None)
+    return results
@@ -0,0 +1,197 @@
+"""
+So sánh gộp K câu hỏi/request (packing.py) với 1 câu/request trên cùng các câu hỏi:
+throughput (dòng/giây), số request, token, tỉ lệ câu phải gọi lại riêng và độ lệch
+accuracy (drift) của Baseline / Self-Critique so với K=1.
+
+Mặc định tự chạy mock_llm_server trong process (không cần API key, đáp án đúng theo
+--baseline-accuracy/--critique-accuracy nên drift chỉ đến từ các câu fallback/lỗi).
+Đo drift thật thì trỏ vào API OpenAI-compatible bằng --base-url (key lấy từ OPENAI_API_KEY):
+
+    python app/packing_benchmark.py data/benchmark_viquad_v2.parquet --rows 400 --pack-sizes 1 4 8 16
+    python app/packing_benchmark.py data/benchmark_viquad_v2.parquet --latency lognormal:800,0.5 \\
+        --ms-per-token 5 --json-drop 0.05
+    python app/packing_benchmark.py data/benchmark_viquad_v2.parquet --base-url https://api.openai.com/v1
+"""
+import argparse
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+import pandas as pd
+from openai import OpenAI
+
+from extraction import extract_final_answer
+from llm_cache import LLMCache
+from llm_calls import openai_chat
+from llm_tracing import get_tracer
+from mock_llm_server import MockHTTPServer, MockLLM, load_answers, make_handler
+from packing import PackStats, answer_pack, openai_response_format
+from prompts import get_baseline_prompt, get_critique_prompt
+from runner import AdaptiveLimiter, ConcurrentRunner, RetryPolicy
+from scoring import evaluate_answer
+from storage import read_table
+
+DEFAULT_OUT = Path("results") / "packing_benchmark.json"
+
+
+def start_mock(args):
+    mock = MockLLM(
+        latency=args.latency,
+        ms_per_token=args.ms_per_token,
+        json_drop=args.json_drop,
+        answers=load_answers([args.data]),
+        baseline_accuracy=args.baseline_accuracy,
+        critique_accuracy=args.critique_accuracy,
+    )
+    server = MockHTTPServer(("127.0.0.1", 0), make_handler(mock))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+
+def run_mode(client, model, questions, pack_size, concurrency):
+    """
+    Chạy Baseline + Self-Critique cho mọi câu hỏi với pack_size câu/request (1 = không gộp).
+    Returns: (list (baseline_text, critique_text), số giây, PackStats, bản ghi tracing của lần chạy)
+    """
+    cache = LLMCache(mode="off")
+    policy = RetryPolicy(limiter=AdaptiveLimiter(max_limit=concurrency), base_delay=0.2, max_delay=5.0)
+    stats = PackStats()
+
+    def call(prompt, response_format=None):
+        extra = {"response_format": response_format} if response_format else {}
+        return policy.call(lambda attempt: openai_chat(
+            client, cache=cache, attempt=attempt, model=model,
+            messages=[{"role": "user", "content": prompt}], temperature=0, **extra,
+        ).strip())
+
+    def task(item):
+        kind, pack = item
+        single_prompt = get_baseline_prompt if kind == "baseline" else get_critique_prompt
+        if pack_size <= 1:
+            try:
+                return [(call(single_prompt(pack[0])), None)]
+            except Exception as e:
+                return [(None, e)]
+        return answer_pack(
+            kind, pack,
+            call_packed=lambda prompt, ids: call(prompt, openai_response_format(kind, ids)),
+            call_single=lambda question: call(single_prompt(question)),
+            stats=stats,
+        )
+
+    tasks = []
+    for start in range(0, len(questions), max(1, pack_size)):
+        pack = questions[start:start + max(1, pack_size)]
+        tasks += [("baseline", pack), ("critique", pack)]
+
+    tracer = get_tracer()
+    first_record = len(tracer.records)
+    runner = ConcurrentRunner(max_workers=concurrency)
+    start = time.perf_counter()
+    outputs = runner.map(task, tasks)
+    answers = []
+    for out_bl, out_sc in zip(outputs, outputs):
+        for (bl, bl_err), (sc, sc_err) in zip(out_bl, out_sc):
+            answers.append((bl if bl_err is None else None, sc if sc_err is None else None))
+    seconds = time.perf_counter() - start
+    return answers, seconds, stats, tracer.records[first_record:]
+
+
+def score(answers, truths):
+    """Returns: (baseline_correct, critique_correct), None cho câu lỗi"""
+    bl_correct, sc_correct = [], []
+    for (bl, sc), gt in zip(answers, truths):
+        bl_correct.append(None if bl is None else evaluate_answer(bl, gt)[0])
+        sc_correct.append(None if sc is None else evaluate_answer(extract_final_answer(sc), gt)[0])
+    return bl_correct, sc_correct
+
+
+def accuracy(flags):
+    valid = [f for f in flags if f is not None]
+    return sum(valid) / len(valid) * 100 if valid else 0.0
+
+
+def agreement(flags, reference):
+    """Tỉ lệ câu có kết quả đúng/sai giống K=1 (trên các câu cả 2 bên đều không lỗi)"""
+    pairs = [(a, b) for a, b in zip(flags, reference) if a is not None and b is not None]
+    return sum(a == b for a, b in pairs) / len(pairs) * 100 if pairs else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark gộp K câu/request so với 1 câu/request")
+    parser.add_argument("data", help="Bảng benchmark (cột question, ground_truth)")
+    parser.add_argument("--rows", type=int, default=200)
+    parser.add_argument("--pack-sizes", nargs="+", type=int, default=[1, 4, 8, 16])
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--model", default="gpt-4o-mini")
+    parser.add_argument("--base-url", default=None, help="API OpenAI-compatible (mặc định: mock trong process)")
+    parser.add_argument("--latency", default="lognormal:300,0.3", help="Mock: độ trễ mỗi request")
+    parser.add_argument("--ms-per-token", type=float, default=2.0, help="Mock: độ trễ theo token output")
+    parser.add_argument("--json-drop", type=float, default=0.02, help="Mock: tỉ lệ câu bị thiếu/hỏng trong JSON")
+    parser.add_argument("--baseline-accuracy", type=float, default=0.5)
+    parser.add_argument("--critique-accuracy", type=float, default=0.6)
+    parser.add_argument("--out", default=str(DEFAULT_OUT))
+    args = parser.parse_args()
+
+    df = read_table(args.data, columns=["question", "ground_truth"]).drop_duplicates("question").head(args.rows)
+    questions = df["question"].astype(str).tolist()
+    truths = df["ground_truth"].astype(str).tolist()
+
+    server = None
+    base_url = args.base_url
+    if base_url is None:
+        server, base_url = start_mock(args)
+        print(f"🧪 Mock LLM trong process tại {base_url} (độ trễ {args.latency}, json-drop {args.json_drop})")
+    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY") or "mock", base_url=base_url, max_retries=0)
+
+    results = []
+    reference = None
+    try:
+        for pack_size in args.pack_sizes:
+            answers, seconds, stats, records = run_mode(client, args.model, questions, pack_size, args.concurrency)
+            bl_correct, sc_correct = score(answers, truths)
+            if reference is None:
+                reference = (bl_correct, sc_correct)
+            row = {
+                "pack_size": pack_size,
+                "rows": len(questions),
+                "seconds": seconds,
+                "rows_per_sec": len(questions) / max(seconds, 1e-9),
+                "requests": len(records),
+                "prompt_tokens": sum(r["prompt_tokens"] for r in records),
+                "completion_tokens": sum(r["completion_tokens"] for r in records),
+                "fallback_items": stats.fallback,
+                "failed_rows": sum(bl is None or sc is None for bl, sc in answers),
+                "baseline_acc": accuracy(bl_correct),
+                "critique_acc": accuracy(sc_correct),
+                "baseline_drift": accuracy(bl_correct) - accuracy(reference[0]),
+                "critique_drift": accuracy(sc_correct) - accuracy(reference[1]),
+                "baseline_agree": agreement(bl_correct, reference[0]),
+                "critique_agree": agreement(sc_correct, reference[1]),
+            }
+            results.append(row)
+            print(f"  K={pack_size:<3} {row['rows_per_sec']:7.2f} dòng/giây, {row['requests']} request, "
+                  f"drift baseline {row['baseline_drift']:+.2f}% / critique {row['critique_drift']:+.2f}%")
+    finally:
+        if server is not None:
+            server.shutdown()
+
+    table = pd.DataFrame(results)
+    print(f"\n📊 {len(questions)} câu hỏi, drift/agree so với K={args.pack_sizes[0]}")
+    print(table.to_string(index=False, float_format=lambda x: f"{x:.2f}"))
+
+    out_path = Path(args.out)
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    out_path.write_text(json.dumps({
+        "data": str(args.data),
+        "base_url": args.base_url or "mock",
+        "model": args.model,
+        "results": results,
+    }, ensure_ascii=False, indent=2), encoding="utf-8")
+    print(f"\n💾 Đã lưu {out_path}")
+
+
+if __name__ == "__main__":
+    main()
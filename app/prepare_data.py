@@ -1,9 +1,12 @@
 # app/prepare_data.py
 import sys, io
-import pandas as pd
+import argparse
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 from datasets import load_dataset
-from tqdm import tqdm
+from storage import TableWriter, export_csv, table_path
 
 # (tùy chọn) fix UTF-8 cho Windows console
 try:
@@ -48,83 +51,155 @@ DATASET_CONFIG = {
 # Số lượng mẫu tối đa để lấy từ mỗi dataset
 MAX_SAMPLES_PER_DATASET = 1000
 
-def get_nested_value(item, key):
+# Số dòng ghi xuống CSV mỗi lần / số dòng đọc từ dataset mỗi lần
+WRITE_CHUNK_ROWS = 5000
+READ_BATCH_ROWS = 1000
+
+_PATH_PART = re.compile(r"^([^\[\]]+)(?:\[(\d+)\])?$")
+
+
+def compile_path(key):
     """
-    Hàm helper để lấy giá trị từ key lồng nhau (ví dụ: 'answer.value')
+    Biên dịch đường dẫn lồng nhau như 'answers.text[0]' 1 lần thành hàm accessor(item),
+    không phải tách chuỗi lại cho từng item. Thiếu key hoặc index thì trả về None.
     """
-    keys = key.split('.')
-    value = item
-    for k in keys:
-        if '[' in k and ']' in k: # Xử lý trường hợp list index (ví dụ: text[0])
-            list_name, index_str = k.split('[')
-            index = int(index_str.replace(']', ''))
-            value = value.get(list_name)
-            if value and isinstance(value, list) and len(value) > index:
-                value = value[index]
-            else:
-                return None # Không tìm thấy list hoặc index
-        else:
-            value = value.get(k)
-        
-        if value is None:
-            return None
-    return value
+    steps = []
+    for part in key.split('.'):
+        match = _PATH_PART.match(part)
+        if not match:
+            raise ValueError(f"Đường dẫn cột không hợp lệ: {key}")
+        name, index = match.group(1), match.group(2)
+        steps.append((name, int(index) if index is not None else None))
+
+    def accessor(item):
+        value = item
+        for name, index in steps:
+            value = value.get(name) if isinstance(value, dict) else None
+            if index is not None:
+                if isinstance(value, list) and len(value) > index:
+                    value = value[index]
+                else:
+                    return None
+            if value is None:
+                return None
+        return value
+
+    return accessor
+
+
+def iter_items(ds, batch_size=READ_BATCH_ROWS):
+    """Đọc dataset theo batch (nhanh hơn truy cập từng dòng) nhưng vẫn trả về từng item"""
+    for batch in ds.iter(batch_size=batch_size):
+        columns = list(batch.keys())
+        for values in zip(*batch.values()):
+            yield dict(zip(columns, values))
+
+
+def iter_records(items, q_col, a_col, max_samples):
+    """Lọc + chuẩn hoá từng item thành (question, ground_truth), bỏ câu hỏi trùng"""
+    get_q = compile_path(q_col)
+    get_a = compile_path(a_col)
+    seen = set()
+    for item in items:
+        # Skip impossible questions (cho ViQuAD)
+        if item.get('is_impossible') == True:
+            continue
+
+        q = get_q(item)
+        a = get_a(item)
+
+        # Đảm bảo q và a là string và không rỗng
+        if not (isinstance(q, str) and q.strip() and isinstance(a, str) and a.strip()):
+            continue
+        q = q.strip()
+        if q in seen:
+            continue
+        seen.add(q)
+        yield q, a.strip()
+
+        # Dừng sớm nếu đã đủ số lượng mẫu
+        if len(seen) >= max_samples:
+            break
+
+
+def write_chunks(records, out_path, chunk_rows=WRITE_CHUNK_ROWS):
+    """Ghi bảng (question, ground_truth) theo từng chunk, không giữ toàn bộ dòng trong RAM"""
+    with TableWriter(out_path, ["question", "ground_truth"]) as writer:
+        chunk = []
+        for record in records:
+            chunk.append(record)
+            if len(chunk) >= chunk_rows:
+                writer.write_rows(chunk)
+                chunk = []
+        writer.write_rows(chunk)
+    if not writer.rows:
+        out_path.unlink(missing_ok=True)
+    return writer.rows
+
+
+def prepare_dataset(name, config, out_dir, max_samples, export_csv_copy=False):
+    """Chạy trong worker process: tải (hoặc đọc từ cache) 1 dataset, lọc và ghi bảng benchmark"""
+    start = time.perf_counter()
+    # Lấy thêm một chút để bù trừ cho impossible questions
+    samples_to_load = int(max_samples * 1.5)
+    split_str = f"{config['split']}[:{samples_to_load}]"
+
+    ds = load_dataset(
+        config['path'],
+        config.get('config'), # config=None nếu không có
+        split=split_str,
+        trust_remote_code=True  # Cho phép custom code (cần cho một số datasets)
+    )
+
+    records = iter_records(iter_items(ds), config['q_col'], config['a_col'], max_samples)
+    out_path = table_path(Path(out_dir) / f"benchmark_{name}")
+    count = write_chunks(records, out_path)
+    if count and export_csv_copy and out_path.suffix != ".csv":
+        export_csv(out_path)
+    return name, out_path, count, time.perf_counter() - start
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Tải và chuẩn bị các bộ benchmark tiếng Việt")
+    parser.add_argument("--max_rows", type=int, default=MAX_SAMPLES_PER_DATASET,
+                        help="Số mẫu tối đa mỗi dataset")
+    parser.add_argument("--workers", type=int, default=len(DATASET_CONFIG),
+                        help="Số dataset xử lý song song (mỗi dataset 1 process)")
+    parser.add_argument("--datasets", nargs="+", choices=list(DATASET_CONFIG), default=list(DATASET_CONFIG),
+                        help="Chỉ chuẩn bị các dataset này")
+    parser.add_argument("--csv", action="store_true",
+                        help="Ghi thêm bản CSV cạnh file Parquet")
+    return parser.parse_args()
+
 
 def main():
+    args = parse_args()
     out_dir = Path("data")
     out_dir.mkdir(parents=True, exist_ok=True)
-    print(f"Chuẩn bị tải {len(DATASET_CONFIG)} bộ dataset Tiếng Việt. Lấy tối đa {MAX_SAMPLES_PER_DATASET} mẫu/dataset.")
-    
-    for name, config in DATASET_CONFIG.items():
-        print(f"\n📥 Đang tải {name} ({config['path']})...")
-        try:
-            # Lấy thêm một chút để bù trừ cho impossible questions
-            samples_to_load = int(MAX_SAMPLES_PER_DATASET * 1.5)
-            split_str = f"{config['split']}[:{samples_to_load}]"
-            
-            ds = load_dataset(
-                config['path'], 
-                config.get('config'), # config=None nếu không có
-                split=split_str,
-                trust_remote_code=True  # Cho phép custom code (cần cho một số datasets)
-            )
-            
-            rows = []
-            for item in tqdm(ds, desc=f"   -> Xử lý {name}"):
-                # Skip impossible questions (cho ViQuAD)
-                if item.get('is_impossible') == True:
-                    continue
-                
-                q = get_nested_value(item, config['q_col'])
-                a = get_nested_value(item, config['a_col'])
-                
-                # Đảm bảo q và a là string và không rỗng
-                if isinstance(q, str) and q.strip() and isinstance(a, str) and a.strip():
-                    rows.append({"question": q.strip(), "ground_truth": a.strip()})
-                
-                # Dừng sớm nếu đã đủ số lượng mẫu
-                if len(rows) >= MAX_SAMPLES_PER_DATASET:
-                    break
-            
-            if not rows:
+    names = args.datasets
+    print(f"Chuẩn bị tải {len(names)} bộ dataset Tiếng Việt. Lấy tối đa {args.max_rows} mẫu/dataset "
+          f"({min(args.workers, len(names))} process song song).")
+
+    with ProcessPoolExecutor(max_workers=max(1, min(args.workers, len(names)))) as pool:
+        futures = {}
+        for name in names:
+            config = DATASET_CONFIG[name]
+            print(f"📥 Đang tải {name} ({config['path']})...")
+            futures[pool.submit(prepare_dataset, name, config, out_dir, args.max_rows, args.csv)] = name
+
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                _, out_path, count, seconds = future.result()
+            except Exception as e:
+                print(f"❌ Lỗi khi tải hoặc xử lý {name}: {e}")
+                continue
+            if not count:
                 print(f"⚠️ Không thu được dòng nào cho {name}.")
                 continue
-                
-            df = pd.DataFrame(rows)
-            df.drop_duplicates(subset=["question"], inplace=True)
-            
-            # Đảm bảo chúng ta chỉ lấy đúng MAX_SAMPLES sau khi lọc trùng
-            if len(df) > MAX_SAMPLES_PER_DATASET:
-                df = df.head(MAX_SAMPLES_PER_DATASET)
-            
-            out_path = out_dir / f"benchmark_{name}.csv"
-            df.to_csv(out_path, index=False, encoding="utf-8-sig")
-            print(f"✅ Đã lưu {len(df)} mẫu vào {out_path}")
-            
-        except Exception as e:
-            print(f"❌ Lỗi khi tải hoặc xử lý {name}: {e}")
+            print(f"✅ Đã lưu {count} mẫu vào {out_path} ({seconds:.1f}s, {count / max(seconds, 1e-9):.0f} dòng/giây)")
 
     print("\n--- Tải và chuẩn bị dữ liệu tiếng Việt hoàn tất! ---")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,3 +1,5 @@
+import hashlib
+
 ANSWER_PROMPT = (
 "Bạn là trợ lý tiếng Việt, trả lời ngắn gọn, chính xác.\n"
 "Câu hỏi người dùng: {question}\n"
@@ -17,4 +19,50 @@ CRITIQUE_PROMPT = (
 "Câu trả lời đề xuất từ dataset: {candidate}\n\n"
 "Phản biện (chỉ dựa vào dataset ViQuAD):\n"
 "Đáp án cuối:"
-)
\ No newline at end of file
+)
+
+
+def build_critique_prompt(question, matched_question, candidate, score):
+    """Prompt Self-Critique của app (gpt.py): context từ dataset ViQuAD + CRITIQUE_PROMPT"""
+    # Cung cấp thêm context từ dataset để AI hiểu rõ hơn về nguồn dữ liệu
+    context_info = "Nguồn dữ liệu: Dataset ViQuAD (Vietnamese Question Answering Dataset)\n"
+    context_info += f"Câu hỏi gốc trong dataset: {matched_question}\n"
+    context_info += f"Độ tin cậy semantic: {score:.3f}\n\n"
+    return context_info + CRITIQUE_PROMPT.format(question=question, candidate=candidate)
+
+
+def critique_prompt_version(model):
+    """
+    Phiên bản prompt Self-Critique của app: hash của template và model.
+    Sửa prompt hoặc đổi model thì các critique tính trước (critique_table.py) không còn được dùng.
+    """
+    template = build_critique_prompt("{question}", "{matched_question}", "{candidate}", 0.0)
+    return hashlib.sha1(f"{model}\n{template}".encode("utf-8")).hexdigest()[:12]
+
+
+# Prompt 1 câu hỏi cho thí nghiệm Baseline vs Self-Critique (gemini.py, openai_experiment.py)
+
+def get_baseline_prompt(question):
+    """Trả về prompt đơn giản"""
+    return f"Hãy trả lời câu hỏi sau một cách ngắn gọn và chính xác: {question}"
+
+def get_critique_prompt(question):
+    """Trả về prompt tự phản biện 3 bước"""
+    return f"""
+Bạn là một trợ lý AI cẩn trọng, luôn kiểm tra lại thông tin.
+Nhiệm vụ của bạn là trả lời câu hỏi sau bằng quy trình 3 bước.
+
+Câu hỏi: {question}
+
+---
+[BẮT ĐẦU QUY TRÌNH]
+
+**Bước 1: Câu trả lời ban đầu:**
+[Hãy tạo câu trả lời ban đầu của bạn ở đây]
+
+**Bước 2: Tự phản biện:**
+[Hãy xem xét lại câu trả lời ở Bước 1. Nó có chính xác không? Có "hallucinate" điểm nào không? Có thể cải thiện ở đâu?]
+
+**Bước 3: Câu trả lời cuối cùng (đã xác minh):**
+[Dựa trên phản biện ở Bước 2, hãy đưa ra câu trả lời cuối cùng, chính xác nhất.]
+"""
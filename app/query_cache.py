@@ -0,0 +1,173 @@
+"""
+Các tầng tra cứu truy vấn đặt trước encoder (dùng chung cho gpt.py và retrieval_service.py).
+
+Mỗi truy vấn được chuẩn hoá như khoá của kho embedding (embedding_store.normalize_text: Unicode NFC,
+gộp khoảng trắng, giữ hoa/thường vì encoder phân biệt) rồi lần lượt thử:
+1. result:    LRU top-k gần đây theo truy vấn đã chuẩn hoá, trả về ngay
+2. exact:     truy vấn trùng 1 câu hỏi trong index (bảng hash) -> dùng embedding đã lưu của câu đó
+3. embedding: LRU embedding của các truy vấn gần đây
+4. encoder:   chạy model (các truy vấn còn lại trong batch được encode 1 lần)
+Tầng 1-3 không chạy model. Số truy vấn và độ trễ mỗi tầng được đếm trong Registry
+(query_lookup_total, query_lookup_seconds).
+"""
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from embedding_store import normalize_text
+from metrics import Registry
+from retrieval import encode_queries, search_vectors
+
+TIERS = ("result", "exact", "embedding", "encoder")
+# Tầng cache chỉ tốn vài micro giây, bucket mặc định (từ 5 ms) quá thô
+LOOKUP_BUCKETS = (1e-5, 5e-5, 1e-4, 5e-4, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)
+
+
+class LRUCache:
+    """Dict giới hạn maxsize phần tử, bỏ phần tử lâu không dùng nhất (thread-safe)"""
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+
+class QuestionHashIndex:
+    """Câu hỏi đã chuẩn hoá -> id đầu tiên trong index có câu đó"""
+
+    def __init__(self, questions):
+        self._ids = {}
+        for i, question in enumerate(questions):
+            self._ids.setdefault(normalize_text(question), i)
+
+    def get(self, normalized):
+        return self._ids.get(normalized)
+
+    def __len__(self):
+        return len(self._ids)
+
+
+class TieredSearcher:
+    """
+    search(queries, topk) như retrieval.search nhưng đi qua các tầng ở trên.
+    corpus: resources.Corpus (questions, emb, index). Tạo mới khi corpus được nạp lại
+    (id thay đổi), truyền registry cũ vào để giữ số liệu.
+    """
+
+    def __init__(self, corpus, embedder, cache_size=1024, registry=None):
+        self.corpus = corpus
+        self.embedder = embedder
+        self.exact = QuestionHashIndex(corpus.questions)
+        self.results = LRUCache(cache_size)
+        self.embeddings = LRUCache(cache_size)
+        self.registry = registry or Registry()
+        self.lookups = self.registry.counter("query_lookup_total", "Số truy vấn theo tầng trả lời")
+        self.seconds = self.registry.histogram(
+            "query_lookup_seconds", "Độ trễ 1 truy vấn theo tầng trả lời", buckets=LOOKUP_BUCKETS
+        )
+
+    def lookup(self, queries, topk, knob_value=None, sources=None):
+        """
+        sources: chỉ tìm trong các nguồn dữ liệu này (None = mọi nguồn).
+        Returns: (list kết quả (id, score) theo từng query, list tầng đã trả lời từng query)
+        """
+        start = time.perf_counter()
+        sources = tuple(sorted(sources)) if sources is not None else None
+        keys = [normalize_text(q) for q in queries]
+        results = [None] * len(keys)
+        tiers = [None] * len(keys)
+        vectors = {}
+        to_encode = {}
+        for j, key in enumerate(keys):
+            # LRU kết quả lưu (k, hits): dùng được cho mọi topk <= k
+            cached = self.results.get((key, knob_value, sources))
+            if cached is not None and cached[0] >= topk:
+                results[j], tiers[j] = cached[1][:topk], "result"
+                self._observe("result", start)
+                continue
+            i = self.exact.get(key)
+            if i is not None:
+                vectors[j], tiers[j] = np.asarray(self.corpus.emb[i], dtype=np.float32), "exact"
+                continue
+            vector = self.embeddings.get(key)
+            if vector is not None:
+                vectors[j], tiers[j] = vector, "embedding"
+                continue
+            to_encode.setdefault(key, []).append(j)
+            tiers[j] = "encoder"
+
+        if to_encode:
+            # Query trùng nhau (sau chuẩn hoá) trong cùng batch chỉ encode 1 lần
+            groups = list(to_encode.values())
+            encoded = encode_queries(self.embedder, [queries[group[0]] for group in groups])
+            for group, vector in zip(groups, encoded):
+                self.embeddings.put(keys[group[0]], vector)
+                for j in group:
+                    vectors[j] = vector
+        if vectors:
+            order = sorted(vectors)
+            hits = search_vectors(
+                self.corpus.index, np.stack([vectors[j] for j in order]), topk, knob_value, sources
+            )
+            for j, found in zip(order, hits):
+                results[j] = found
+                self.results.put((keys[j], knob_value, sources), (topk, found))
+                self._observe(tiers[j], start)
+        return results, tiers
+
+    def search(self, queries, topk, knob_value=None, sources=None):
+        return self.lookup(queries, topk, knob_value, sources)[0]
+
+    def _observe(self, tier, start):
+        self.lookups.inc(tier=tier)
+        self.seconds.observe(time.perf_counter() - start, tier=tier)
+
+    def stats(self):
+        """Theo từng tầng: số truy vấn, tỉ lệ, độ trễ trung bình/p95 (giây)"""
+        latency = {s["labels"]["tier"]: s for s in self.seconds.snapshot()}
+        total = sum(self.lookups.value(tier=tier) for tier in TIERS)
+        out = {}
+        for tier in TIERS:
+            count = self.lookups.value(tier=tier)
+            series = latency.get(tier, {})
+            out[tier] = {
+                "count": count,
+                "rate": count / total if total else 0.0,
+                "mean_seconds": series.get("mean", 0.0),
+                "p95_seconds": series.get("p95", 0.0),
+            }
+        return out
+
+    def format_stats(self):
+        stats = self.stats()
+        total = sum(s["count"] for s in stats.values())
+        if not total:
+            return "Tra cứu truy vấn: chưa có truy vấn nào"
+        parts = [
+            f"{tier} {s['rate'] * 100:.0f}% (tb {s['mean_seconds'] * 1000:.2f} ms)"
+            for tier, s in stats.items() if s["count"]
+        ]
+        skipped = total - stats["encoder"]["count"]
+        return (f"Tra cứu truy vấn: {total} lần, {skipped} lần không chạy encoder "
+                f"({skipped / total * 100:.0f}%)\n" + ", ".join(parts))
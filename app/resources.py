@@ -0,0 +1,180 @@
+"""
+Tài nguyên dùng chung trong 1 process (encoder, dữ liệu index, bảng critique tính trước,
+client OpenAI, thread pool, cache tra cứu truy vấn).
+
+Streamlit chạy lại cả script gpt.py mỗi lần người dùng tương tác, nhưng module
+này chỉ được import 1 lần/process nên encoder và index chỉ nạp 1 lần và được
+chia sẻ giữa mọi session. embeddings.npy được mở memory-mapped, chỉ đọc;
+corpus.parquet cũng được đọc qua memory map (xem storage.py). Index chia shard theo nguồn dữ liệu,
+mỗi shard chỉ nạp khi được search lần đầu (xem sharded_index.py).
+Khi file index trên đĩa thay đổi (mtime/kích thước), lần gọi sau sẽ tự nạp lại. Mọi file của
+1 lần nạp đều lấy từ thư mục phiên bản mà index_manifest.json trỏ tới (xem embedding_store.py).
+TieredSearcher (query_cache.py) giữ cache truy vấn; được tạo lại khi corpus nạp lại.
+Client OpenAI giữ connection pool keep-alive, nên các câu hỏi sau không phải mở lại kết nối/TLS.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+
+from critique_table import CritiqueTable, critique_table_path
+from embedding_store import current_dir, read_manifest
+from encoders import DEFAULT_MODEL_NAME, default_backend, load_encoder
+from query_cache import TieredSearcher
+from sharded_index import load_sharded_index
+from storage import corpus_files as corpus_table_files, read_corpus
+from vector_index import index_path
+
+# OpenAI là optional – chỉ cần khi bật Self-Critique
+try:
+    from openai import OpenAI
+except Exception:
+    OpenAI = None
+
+_lock = threading.Lock()
+_encoders = {}
+_corpora = {}
+_critique_tables = {}
+_clients = {}
+_searchers = {}
+_executor = None
+
+
+@dataclass
+class Corpus:
+    questions: list
+    answers: list
+    emb: np.ndarray
+    index: object
+    signature: tuple
+
+
+def get_encoder(model_name=DEFAULT_MODEL_NAME, backend=None):
+    """
+    Encoder dùng chung, chỉ khởi tạo 1 lần cho mỗi (model, backend).
+    backend mặc định lấy từ ENCODER_BACKEND (torch | onnx).
+    """
+    backend = backend or default_backend()
+    with _lock:
+        if (model_name, backend) not in _encoders:
+            _encoders[(model_name, backend)] = load_encoder(model_name, backend)
+        return _encoders[(model_name, backend)]
+
+
+def get_openai_client(api_key, base_url=None, **options):
+    """
+    Client OpenAI dùng chung cho mỗi (api_key, base_url, options), vd timeout / max_retries.
+    Client (và connection pool HTTP keep-alive bên trong) an toàn khi dùng từ nhiều thread.
+    Returns None nếu chưa cài openai.
+    """
+    if OpenAI is None:
+        return None
+    key = (api_key, base_url, tuple(sorted(options.items())))
+    with _lock:
+        if key not in _clients:
+            _clients[key] = OpenAI(api_key=api_key, base_url=base_url, **options)
+        return _clients[key]
+
+
+def get_executor(max_workers=8):
+    """Thread pool dùng chung để chạy lời gọi LLM nền (không chặn script Streamlit)"""
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="llm")
+        return _executor
+
+
+def corpus_files(data_dir, index_kind="exact"):
+    data_dir = Path(data_dir)
+    return corpus_table_files(data_dir) + [
+        data_dir / "embeddings.npy",
+        index_path(data_dir, index_kind),
+        data_dir / "index_manifest.json",
+    ]
+
+
+def files_signature(paths):
+    """(tên, mtime_ns, size) của từng file, file không tồn tại thì là None"""
+    signature = []
+    for path in paths:
+        try:
+            stat = path.stat()
+            signature.append((path.name, stat.st_mtime_ns, stat.st_size))
+        except FileNotFoundError:
+            signature.append((path.name, None))
+    return tuple(signature)
+
+
+def _load_corpus(data_dir, index_kind, signature, attempts=3):
+    data_dir = Path(data_dir)
+    for attempt in range(1, attempts + 1):
+        # Đọc manifest 1 lần, mọi file lấy từ cùng thư mục phiên bản
+        manifest = read_manifest(data_dir)
+        version_dir = current_dir(data_dir, manifest)
+        try:
+            questions, answers = read_corpus(version_dir)
+            emb = np.load(version_dir / "embeddings.npy", mmap_mode="r")
+            index = load_sharded_index(version_dir, emb, index_kind, manifest)
+            return Corpus(questions, answers, emb, index, signature)
+        except FileNotFoundError:
+            # Phiên bản vừa bị dọn trong lúc đang nạp (đã có 2 bản build mới hơn): đọc lại manifest
+            if attempt == attempts or read_manifest(data_dir) == manifest:
+                raise
+
+
+def get_corpus(data_dir="data", index_kind="exact"):
+    """
+    Câu hỏi, đáp án, embeddings (mmap) và index (sharded_index.ShardedIndex), dùng chung trong process.
+    Tự nạp lại khi các file trên đĩa thay đổi.
+    """
+    key = (str(Path(data_dir).resolve()), index_kind)
+    signature = files_signature(corpus_files(data_dir, index_kind))
+    with _lock:
+        corpus = _corpora.get(key)
+        if corpus is None or corpus.signature != signature:
+            corpus = _load_corpus(data_dir, index_kind, signature)
+            _corpora[key] = corpus
+        return corpus
+
+
+def get_critique_table(data_dir="data", prompt_version=None):
+    """
+    Bảng critique tính trước (critique_table.py) của 1 prompt_version, dùng chung trong process.
+    Tự nạp lại khi file bảng thay đổi (vd batch job vừa chạy xong).
+    """
+    key = (str(Path(data_dir).resolve()), prompt_version)
+    signature = files_signature([critique_table_path(data_dir)])
+    with _lock:
+        table = _critique_tables.get(key)
+        if table is None or table[0] != signature:
+            table = (signature, CritiqueTable.load(data_dir, prompt_version))
+            _critique_tables[key] = table
+        return table[1]
+
+
+def get_searcher(data_dir="data", index_kind="exact", model_name=DEFAULT_MODEL_NAME, backend=None,
+                 registry=None):
+    """
+    TieredSearcher dùng chung cho mỗi (data_dir, index, model): cache kết quả/embedding của truy vấn
+    gần đây (QUERY_CACHE_SIZE phần tử mỗi loại, mặc định 1024). Khi corpus nạp lại thì tạo searcher
+    mới (cache cũ không còn đúng) nhưng giữ Registry để số liệu hit rate cộng dồn.
+    registry chỉ dùng ở lần tạo đầu tiên (vd Registry của retrieval_service để /metrics có các tầng).
+    """
+    corpus = get_corpus(data_dir, index_kind)
+    embedder = get_encoder(model_name, backend)
+    key = (str(Path(data_dir).resolve()), index_kind, model_name, backend or default_backend())
+    with _lock:
+        searcher = _searchers.get(key)
+        if searcher is None or searcher.corpus is not corpus:
+            searcher = TieredSearcher(
+                corpus,
+                embedder,
+                cache_size=int(os.getenv("QUERY_CACHE_SIZE", "1024")),
+                registry=searcher.registry if searcher is not None else registry,
+            )
+            _searchers[key] = searcher
+        return searcher
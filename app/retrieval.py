@@ -0,0 +1,29 @@
+"""
+Đường tìm kiếm câu hỏi tương tự, dùng chung cho gpt.py và retrieval_service.py
+để cả hai có cùng cách tính score.
+"""
+import numpy as np
+
+
+def encode_queries(embedder, queries):
+    """Encode nhiều câu truy vấn trong 1 lần gọi (embedding đã chuẩn hoá)"""
+    return np.asarray(embedder.encode(list(queries), normalize_embeddings=True), dtype=np.float32)
+
+
+def search_vectors(index, q_vecs, topk, knob_value=None, sources=None):
+    """
+    Returns: list (theo từng query) các cặp (id, cosine score) giảm dần.
+    sources: chỉ tìm trong các nguồn này (cần ShardedIndex, None = mọi nguồn)
+    """
+    if sources is None:
+        top_scores, top_ids = index.search(q_vecs, topk, knob_value)
+    else:
+        top_scores, top_ids = index.search(q_vecs, topk, knob_value, sources=sources)
+    return [
+        [(int(i), float(sc)) for i, sc in zip(ids, scores) if i >= 0]
+        for ids, scores in zip(top_ids, top_scores)
+    ]
+
+
+def search(embedder, index, queries, topk, knob_value=None, sources=None):
+    return search_vectors(index, encode_queries(embedder, queries), topk, knob_value, sources)
@@ -0,0 +1,219 @@
+"""
+Service HTTP tìm câu hỏi tương tự (cùng cách tính score với gpt.py), có micro-batching:
+các request đến cùng lúc được gom thành 1 batch (tối đa --max-batch-size câu, chờ tối đa
+--max-wait-ms) rồi encode + search 1 lần. Truy vấn trùng câu hỏi trong index hoặc đã hỏi gần đây
+không cần encode (query_cache.py, số liệu query_lookup_* trong /metrics).
+
+    python app/retrieval_service.py --port 8765
+
+    POST /search   {"query": "Thủ đô Việt Nam là gì?", "topk": 5, "sources": ["xquad_vi"]}
+                   (sources tuỳ chọn: chỉ quét shard của các nguồn đó; mỗi kết quả có "source")
+    GET  /metrics  Prometheus text (phân bố batch size, độ trễ, tầng tra cứu truy vấn)
+    GET  /stats    cùng số liệu dạng JSON
+    GET  /health
+"""
+import argparse
+import json
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from metrics import Registry
+from resources import DEFAULT_MODEL_NAME, get_corpus, get_searcher
+
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+
+
+class MicroBatcher:
+    """
+    Gom các item được submit đồng thời thành batch rồi gọi handler(list_item) 1 lần.
+    handler trả về list kết quả cùng thứ tự với list_item.
+    """
+
+    def __init__(self, handler, max_batch_size=32, max_wait_ms=5.0, registry=None, name="batcher"):
+        self.handler = handler
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue = queue.Queue()
+        registry = registry or Registry()
+        self.batch_sizes = registry.histogram(f"{name}_batch_size", "Số request trong mỗi batch", BATCH_SIZE_BUCKETS)
+        self.queue_wait = registry.histogram(f"{name}_queue_wait_seconds", "Thời gian request chờ trong hàng đợi")
+        self.batch_seconds = registry.histogram(f"{name}_batch_seconds", "Thời gian xử lý 1 batch")
+        self.errors = registry.counter(f"{name}_errors_total", "Số batch bị lỗi")
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def submit(self, item):
+        future = Future()
+        self._queue.put((item, future, time.perf_counter()))
+        return future
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._collect()
+            start = time.perf_counter()
+            for _, _, enqueued in batch:
+                self.queue_wait.observe(start - enqueued)
+            self.batch_sizes.observe(len(batch))
+            try:
+                results = self.handler([item for item, _, _ in batch])
+                for (_, future, _), result in zip(batch, results):
+                    future.set_result(result)
+            except Exception as e:
+                self.errors.inc()
+                for _, future, _ in batch:
+                    future.set_exception(e)
+            self.batch_seconds.observe(time.perf_counter() - start)
+
+
+class RetrievalService:
+    def __init__(self, data_dir="data", index_kind="exact", max_batch_size=32, max_wait_ms=5.0):
+        self.data_dir = data_dir
+        self.index_kind = index_kind
+        self.registry = Registry()
+        self.requests = self.registry.counter("retrieval_requests_total", "Số request /search")
+        self.latency = self.registry.histogram("retrieval_request_seconds", "Độ trễ 1 request /search")
+        # Tạo searcher ngay (nạp encoder) với Registry của service
+        get_searcher(data_dir, index_kind, DEFAULT_MODEL_NAME, registry=self.registry)
+        self.batcher = MicroBatcher(
+            self._search_batch, max_batch_size, max_wait_ms, self.registry, name="retrieval"
+        )
+
+    def _search_batch(self, items):
+        """
+        items: list (query, topk, sources). Các query phải encode được encode cả batch 1 lần,
+        search theo từng nhóm cùng sources.
+        """
+        searcher = get_searcher(self.data_dir, self.index_kind, DEFAULT_MODEL_NAME)
+        corpus = searcher.corpus
+        groups = {}
+        for j, (_, _, sources) in enumerate(items):
+            groups.setdefault(sources, []).append(j)
+        results = [None] * len(items)
+        for sources, rows in groups.items():
+            max_k = max(items[j][1] for j in rows)
+            for j, hits in zip(rows, searcher.search([items[j][0] for j in rows], max_k, sources=sources)):
+                results[j] = hits
+        return [
+            [
+                {"id": i, "score": sc, "source": corpus.index.source_of(i),
+                 "question": corpus.questions[i], "answer": corpus.answers[i]}
+                for i, sc in hits[:k]
+            ]
+            for (_, k, _), hits in zip(items, results)
+        ]
+
+    def search(self, query, topk=5, sources=None):
+        start = time.perf_counter()
+        sources = tuple(sorted(sources)) if sources is not None else None
+        try:
+            return self.batcher.submit((query, topk, sources)).result()
+        finally:
+            self.requests.inc()
+            self.latency.observe(time.perf_counter() - start)
+
+
+class RetrievalHTTPServer(ThreadingHTTPServer):
+    # Hàng đợi kết nối đủ lớn cho tải đồng thời cao (mặc định chỉ 5)
+    request_queue_size = 256
+    daemon_threads = True
+
+
+def make_handler(service):
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, status, body, content_type="application/json; charset=utf-8"):
+            data = body.encode("utf-8") if isinstance(body, str) else body
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _json(self, status, obj):
+            self._send(status, json.dumps(obj, ensure_ascii=False))
+
+        def do_GET(self):
+            if self.path == "/health":
+                self._json(200, {"status": "ok"})
+            elif self.path == "/metrics":
+                self._send(200, service.registry.render_prometheus(), "text/plain; version=0.0.4")
+            elif self.path == "/stats":
+                self._json(200, service.registry.snapshot())
+            else:
+                self._json(404, {"error": "not found"})
+
+        def do_POST(self):
+            if self.path != "/search":
+                self._json(404, {"error": "not found"})
+                return
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                payload = json.loads(self.rfile.read(length) or b"{}")
+                if not isinstance(payload, dict):
+                    raise ValueError("body phải là JSON object")
+                query = str(payload["query"]).strip()
+                topk = max(1, min(int(payload.get("topk", 5)), 100))
+                sources = payload.get("sources")
+                if sources is not None and (
+                    not isinstance(sources, list) or not sources or not all(isinstance(s, str) for s in sources)
+                ):
+                    raise ValueError("sources phải là list tên nguồn không rỗng")
+            except (KeyError, TypeError, ValueError) as e:
+                self._json(400, {"error": f"request không hợp lệ: {e}"})
+                return
+            if not query:
+                self._json(400, {"error": "query rỗng"})
+                return
+            try:
+                self._json(200, {"query": query, "results": service.search(query, topk, sources)})
+            except Exception as e:
+                self._json(500, {"error": str(e)})
+
+        def log_message(self, format, *args):
+            pass  # không in log mỗi request
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Service tìm câu hỏi tương tự có micro-batching")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--data-dir", default="data")
+    parser.add_argument("--index", default=os.getenv("VECTOR_INDEX", "exact"))
+    parser.add_argument("--max-batch-size", type=int, default=32)
+    parser.add_argument("--max-wait-ms", type=float, default=5.0)
+    args = parser.parse_args()
+
+    print("🧠 Nạp encoder và index...")
+    service = RetrievalService(args.data_dir, args.index, args.max_batch_size, args.max_wait_ms)
+    get_corpus(args.data_dir, args.index)
+    server = RetrievalHTTPServer((args.host, args.port), make_handler(service))
+    print(f"🚀 Retrieval service tại http://{args.host}:{args.port} "
+          f"(batch tối đa {args.max_batch_size}, chờ tối đa {args.max_wait_ms} ms)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
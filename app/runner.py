@@ -0,0 +1,309 @@
+"""
+Chạy song song các lời gọi API với giới hạn concurrency, RPM và TPM.
+Kết quả luôn được trả về đúng theo thứ tự đầu vào.
+Lỗi tạm thời (429/5xx/timeout) được gọi lại có backoff, số request đồng thời tự điều chỉnh (AIMD).
+"""
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from llm_tracing import classify_error
+
+
+def estimate_tokens(prompt, expected_output_tokens=256):
+    """
+    Ước lượng số token của 1 request (prompt + output dự kiến).
+    Tiếng Việt trung bình ~3 ký tự/token nên chia 3 cho an toàn.
+    """
+    return len(str(prompt)) // 3 + expected_output_tokens
+
+
+class RateLimiter:
+    """
+    Giới hạn số request/phút (RPM) và token/phút (TPM) theo cửa sổ trượt.
+    rpm/tpm = None hoặc <= 0 nghĩa là không giới hạn.
+    """
+
+    def __init__(self, rpm=None, tpm=None, window=60.0):
+        self.rpm = rpm if rpm and rpm > 0 else None
+        self.tpm = tpm if tpm and tpm > 0 else None
+        self.window = window
+        self._lock = threading.Lock()
+        self._events = deque()  # (thời điểm, số token)
+        self._tokens_in_window = 0
+
+    def _purge(self, now):
+        while self._events and now - self._events[0][0] >= self.window:
+            _, tokens = self._events.popleft()
+            self._tokens_in_window -= tokens
+
+    def acquire(self, tokens=0):
+        """Chặn cho tới khi còn quota cho 1 request tiêu tốn `tokens` token"""
+        if self.rpm is None and self.tpm is None:
+            return
+        if self.tpm is not None:
+            # Request lớn hơn cả quota/phút vẫn phải chạy được, chỉ là chờ lâu hơn
+            tokens = min(tokens, self.tpm)
+
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._purge(now)
+                rpm_ok = self.rpm is None or len(self._events) < self.rpm
+                tpm_ok = self.tpm is None or self._tokens_in_window + tokens <= self.tpm
+                if rpm_ok and tpm_ok:
+                    self._events.append((now, tokens))
+                    self._tokens_in_window += tokens
+                    return
+                # Chờ tới khi request cũ nhất rời khỏi cửa sổ
+                wait = self.window - (now - self._events[0][0]) if self._events else 0.05
+            time.sleep(max(wait, 0.01))
+
+
+class ConcurrentRunner:
+    """
+    Thread pool có giới hạn số request đồng thời + RPM/TPM.
+    max_workers=1 tương đương chạy tuần tự như trước.
+    """
+
+    def __init__(self, max_workers=8, rpm=None, tpm=None, retry=None):
+        self.max_workers = max(1, int(max_workers))
+        self.limiter = RateLimiter(rpm=rpm, tpm=tpm)
+        self.retry = retry
+        # Số item đã thực sự bắt đầu chạy trong lần map gần nhất (item bị huỷ khi dừng sớm không tính)
+        self.started = 0
+        self._started_lock = threading.Lock()
+
+    def map(self, fn, items, cost=None):
+        """
+        Gọi fn(item) song song cho từng item và yield kết quả theo đúng thứ tự đầu vào.
+        cost(item) trả về số token ước lượng để tính vào TPM.
+        Chỉ giữ tối đa 2*max_workers task chờ để bộ nhớ không tăng theo số dòng.
+
+        Khi có retry (RetryPolicy): gọi fn(item, attempt) qua retry.call, mỗi lần thử đều tính
+        vào RPM/TPM, và yield (kết quả, None) hoặc (None, lỗi cuối cùng) thay vì raise.
+        """
+        limiter = self.limiter
+        retry = self.retry
+        self.started = 0
+
+        def task(item):
+            with self._started_lock:
+                self.started += 1
+            tokens = cost(item) if cost else 0
+            if retry is None:
+                limiter.acquire(tokens)
+                return fn(item)
+            try:
+                return retry.call(lambda attempt: fn(item, attempt), lambda: limiter.acquire(tokens)), None
+            except Exception as e:
+                return None, e
+
+        pending = deque()
+        window = self.max_workers * 2
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            try:
+                for item in items:
+                    pending.append(pool.submit(task, item))
+                    if len(pending) >= window:
+                        yield pending.popleft().result()
+                while pending:
+                    yield pending.popleft().result()
+            finally:
+                # Nếu bên gọi dừng sớm thì huỷ các task chưa chạy
+                for future in pending:
+                    future.cancel()
+
+
+# --- Điều chỉnh concurrency thích ứng (AIMD) + retry có backoff ---
+
+# Lỗi tạm thời, gọi lại có thể thành công
+RETRYABLE_ERRORS = ("rate_limit", "server", "timeout")
+# Lỗi cho thấy provider đang quá tải: giảm số request đồng thời
+THROTTLE_ERRORS = ("rate_limit", "server")
+
+
+class AdaptiveLimiter:
+    """
+    Giới hạn số request đang chạy (in-flight) theo kiểu AIMD, như điều khiển tắc nghẽn TCP:
+    - mỗi request thành công: tăng limit thêm increase/limit (≈ +increase sau 1 "vòng" request)
+    - gặp 429/5xx hoặc độ trễ ngắn hạn vượt latency_tolerance lần độ trễ dài hạn: nhân limit với decrease
+    Mỗi lần giảm cách nhau ít nhất 1 khoảng độ trễ, để cả loạt 429 của cùng 1 đợt chỉ tính là 1 lần.
+    """
+
+    def __init__(self, max_limit=8, min_limit=1, initial=None, increase=1.0, decrease=0.5,
+                 latency_tolerance=2.0, min_latency_sample=0.05):
+        self.max_limit = max(1, int(max_limit))
+        self.min_limit = max(1, min(int(min_limit), self.max_limit))
+        self.limit = float(initial or max(self.min_limit, self.max_limit // 2))
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_tolerance = latency_tolerance
+        # Lời gọi nhanh hơn ngưỡng này (cache hit...) không phản ánh tải của provider
+        self.min_latency_sample = min_latency_sample
+        self.stats = {"ok": 0, "throttled": 0, "errors": 0, "decreases": 0}
+        self._inflight = 0
+        self._latency_short = None
+        self._latency_long = None
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self._inflight >= int(self.limit):
+                self._cond.wait()
+            self._inflight += 1
+
+    def release(self, seconds, error_type=None):
+        """Trả slot và cập nhật limit theo kết quả của lời gọi (error_type theo llm_tracing.classify_error)"""
+        with self._cond:
+            self._inflight -= 1
+            if error_type in THROTTLE_ERRORS:
+                self.stats["throttled"] += 1
+                self._backoff()
+            elif error_type is not None:
+                self.stats["errors"] += 1
+            else:
+                self.stats["ok"] += 1
+                if self._congested(seconds):
+                    self._backoff()
+                else:
+                    self.limit = min(self.max_limit, self.limit + self.increase / self.limit)
+            self._cond.notify_all()
+
+    def _congested(self, seconds):
+        if seconds < self.min_latency_sample or self.latency_tolerance is None:
+            return False
+        if self._latency_long is None:
+            self._latency_short = self._latency_long = seconds
+            return False
+        self._latency_short += 0.2 * (seconds - self._latency_short)
+        self._latency_long += 0.02 * (seconds - self._latency_long)
+        return self._latency_short > self.latency_tolerance * self._latency_long
+
+    def _backoff(self):
+        now = time.monotonic()
+        if now - self._last_decrease < (self._latency_short or 0.5):
+            return
+        self._last_decrease = now
+        self.limit = max(self.min_limit, self.limit * self.decrease)
+        self.stats["decreases"] += 1
+
+    def snapshot(self):
+        with self._cond:
+            return {"limit": round(self.limit, 2), "inflight": self._inflight, **self.stats}
+
+
+class RetryBudget:
+    """
+    Giới hạn tổng số lần retry: tối đa min_retries + ratio * số request gốc.
+    Khi provider lỗi hàng loạt, retry dừng lại thay vì nhân số request lên (retry storm).
+    """
+
+    def __init__(self, ratio=0.2, min_retries=10):
+        self.ratio = ratio
+        self.min_retries = min_retries
+        self.requests = 0
+        self.retries = 0
+        self.exhausted = 0
+        self._lock = threading.Lock()
+
+    def record_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def try_spend(self):
+        with self._lock:
+            if self.retries < self.min_retries + self.ratio * self.requests:
+                self.retries += 1
+                return True
+            self.exhausted += 1
+            return False
+
+
+def retry_after_seconds(exc):
+    """Header Retry-After (giây) trong response lỗi của SDK OpenAI/Gemini REST, nếu có"""
+    headers = getattr(getattr(exc, "response", None), "headers", None)
+    try:
+        return float(headers.get("retry-after")) if headers else None
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy:
+    """
+    Gọi lại lỗi tạm thời (429, 5xx, timeout) với exponential backoff + full jitter:
+    chờ ngẫu nhiên trong [0, min(max_delay, base_delay * 2^(lần thử - 1))], không ít hơn Retry-After.
+    Mỗi lần thử chiếm 1 slot của AdaptiveLimiter và báo kết quả cho limiter.
+    """
+
+    def __init__(self, limiter=None, budget=None, max_attempts=5, base_delay=1.0, max_delay=30.0, seed=None):
+        self.limiter = limiter or AdaptiveLimiter()
+        self.budget = budget or RetryBudget()
+        self.max_attempts = max(1, int(max_attempts))
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._rng = random.Random(seed)
+
+    def backoff_delay(self, attempt, exc=None):
+        delay = self._rng.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+        hint = retry_after_seconds(exc) if exc is not None else None
+        return min(self.max_delay, max(delay, hint or 0.0))
+
+    def call(self, fn, before_attempt=None):
+        """
+        fn(attempt) với attempt = 1, 2, ... Raise lỗi cuối cùng nếu hết số lần thử,
+        hết retry budget hoặc lỗi không nên thử lại (auth, bad_request...).
+        before_attempt(): gọi trước mỗi lần thử (vd RateLimiter.acquire để retry cũng tính vào RPM).
+        """
+        self.budget.record_request()
+        attempt = 1
+        while True:
+            if before_attempt is not None:
+                before_attempt()
+            self.limiter.acquire()
+            start = time.perf_counter()
+            try:
+                result = fn(attempt)
+            except Exception as e:
+                error_type = classify_error(e)
+                self.limiter.release(time.perf_counter() - start, error_type)
+                if (error_type not in RETRYABLE_ERRORS or attempt >= self.max_attempts
+                        or not self.budget.try_spend()):
+                    raise
+                time.sleep(self.backoff_delay(attempt, e))
+                attempt += 1
+                continue
+            self.limiter.release(time.perf_counter() - start)
+            return result
+
+    def format_stats(self):
+        s = self.limiter.snapshot()
+        return (f"Concurrency thích ứng: limit={s['limit']} (giảm {s['decreases']} lần, {s['throttled']} lỗi 429/5xx), "
+                f"retry {self.budget.retries} lần, hết budget {self.budget.exhausted} lần")
+
+
+_policies = {}
+_policies_lock = threading.Lock()
+
+
+def get_retry_policy(key, max_concurrency=8):
+    """
+    RetryPolicy (kèm AdaptiveLimiter, RetryBudget) dùng chung cho mọi nơi gọi cùng `key`
+    (vd "gemini/<model>") trong process: quota của provider tính theo model, không theo script.
+    Cấu hình qua env LLM_MAX_ATTEMPTS, LLM_BACKOFF_BASE, LLM_BACKOFF_MAX, LLM_RETRY_BUDGET.
+    """
+    with _policies_lock:
+        policy = _policies.get(key)
+        if policy is None:
+            policy = _policies[key] = RetryPolicy(
+                limiter=AdaptiveLimiter(max_limit=max_concurrency),
+                budget=RetryBudget(ratio=float(os.getenv("LLM_RETRY_BUDGET", "0.2"))),
+                max_attempts=int(os.getenv("LLM_MAX_ATTEMPTS", "5")),
+                base_delay=float(os.getenv("LLM_BACKOFF_BASE", "1.0")),
+                max_delay=float(os.getenv("LLM_BACKOFF_MAX", "30.0")),
+            )
+        return policy
@@ -0,0 +1,219 @@
+"""
+Chấm điểm câu trả lời theo lô (cả cột dự đoán và ground truth cùng lúc).
+
+Chế độ similarity:
+- compat: giống hệt SequenceMatcher(...).ratio() như evaluate_answer cũ trong gemini.py
+          (chỉ tính 1 lần cho mỗi cặp khác nhau, có thể chạy song song nhiều process)
+- fast:   ratio dựa trên LCS = 2*LCS/(len1+len2), tính bằng thuật toán bit-parallel
+          (tuyến tính theo độ dài thay vì bậc 2 như SequenceMatcher với output dài)
+
+Chạy lại điểm cho các file kết quả (.parquet hoặc .csv) với nhiều ngưỡng:
+    python app/scoring.py results/results_*.parquet --thresholds 0.5 0.6 0.7
+"""
+import argparse
+import os
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from difflib import SequenceMatcher
+
+import numpy as np
+import pandas as pd
+
+from storage import read_table
+
+SCORING_MODES = ("compat", "fast")
+
+# Các cột rescore_results cần (không đọc cột critique_answer_full rất dài)
+RESULT_COLUMNS = ["baseline_answer", "critique_answer_final", "ground_truth"]
+
+# Câu trả lời của lời gọi thất bại (sau mọi lần retry) được ghi dạng "[LỖI: ...]"
+ERROR_PREFIX = "[LỖI"
+FAILURE_COLUMNS = ["baseline_failed", "critique_failed"]
+
+# Dưới ngưỡng này chạy trong 1 process sẽ nhanh hơn chi phí khởi tạo pool
+_PARALLEL_MIN_PAIRS = 2000
+
+
+def normalize_column(values):
+    """str -> lower -> strip cho cả cột (None/NaN thành chuỗi như str() cũ)"""
+    return pd.Series(list(values), dtype=object).map(str).str.lower().str.strip()
+
+
+def sequence_ratio(pair):
+    """SequenceMatcher.ratio() cho 1 cặp (a, b) đã chuẩn hoá"""
+    a, b = pair
+    return SequenceMatcher(None, a, b).ratio()
+
+
+def lcs_length(a, b):
+    """
+    Độ dài LCS theo thuật toán bit-parallel (Hyyrö): mỗi ký tự của chuỗi ngắn
+    chỉ tốn vài phép toán trên số nguyên lớn có len(chuỗi dài) bit.
+    """
+    if len(a) < len(b):
+        a, b = b, a
+    if not b:
+        return 0
+    masks = {}
+    for i, ch in enumerate(a):
+        masks[ch] = masks.get(ch, 0) | (1 << i)
+    full = (1 << len(a)) - 1
+    v = full
+    for ch in b:
+        u = v & masks.get(ch, 0)
+        v = ((v + u) | (v - u)) & full
+    return len(a) - bin(v).count("1")
+
+
+def lcs_ratio(pair):
+    a, b = pair
+    total = len(a) + len(b)
+    return 2.0 * lcs_length(a, b) / total if total else 1.0
+
+
+def token_f1(pred, truth):
+    """Token-F1 kiểu SQuAD trên các âm tiết (tách theo khoảng trắng)"""
+    pred_tokens = pred.split()
+    truth_tokens = truth.split()
+    if not pred_tokens or not truth_tokens:
+        return 0.0
+    common = sum((Counter(pred_tokens) & Counter(truth_tokens)).values())
+    if common == 0:
+        return 0.0
+    precision = common / len(pred_tokens)
+    recall = common / len(truth_tokens)
+    return 2 * precision * recall / (precision + recall)
+
+
+def _pairwise(fn, pairs, n_jobs):
+    if n_jobs > 1 and len(pairs) >= _PARALLEL_MIN_PAIRS:
+        chunksize = max(1, len(pairs) // (n_jobs * 8))
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            return np.fromiter(pool.map(fn, pairs, chunksize=chunksize), dtype=np.float64, count=len(pairs))
+    return np.fromiter(map(fn, pairs), dtype=np.float64, count=len(pairs))
+
+
+def score_batch(predictions, ground_truths, thresholds=(0.6,), mode="compat", n_jobs=None):
+    """
+    Chấm điểm cả cột dự đoán so với cột ground truth.
+    Returns: DataFrame với các cột exact_match, similarity, token_f1
+             và correct@<ngưỡng> cho từng ngưỡng trong `thresholds`.
+    Với mode="compat", (correct@t, similarity) trùng khớp evaluate_answer(pred, gt, t).
+    """
+    if mode not in SCORING_MODES:
+        raise ValueError(f"Scoring mode không hợp lệ: {mode} (chọn {SCORING_MODES})")
+    n_jobs = n_jobs or os.cpu_count() or 1
+
+    pred = normalize_column(predictions)
+    truth = normalize_column(ground_truths)
+    if len(pred) != len(truth):
+        raise ValueError("predictions và ground_truths phải có cùng độ dài")
+
+    empty = ((pred == "") | (truth == "")).to_numpy()
+    exact = (pred == truth).to_numpy() & ~empty
+
+    # Chỉ tính similarity 1 lần cho mỗi cặp (pred, truth) khác nhau
+    need = ~empty & ~exact
+    pair_ids = {}
+    codes = np.fromiter(
+        (pair_ids.setdefault(pair, len(pair_ids)) for pair in zip(pred[need], truth[need])),
+        dtype=np.int64,
+        count=int(need.sum()),
+    )
+    unique_pairs = list(pair_ids)
+    fn = sequence_ratio if mode == "compat" else lcs_ratio
+    unique_scores = _pairwise(fn, unique_pairs, n_jobs)
+
+    similarity = np.zeros(len(pred), dtype=np.float64)
+    similarity[exact] = 1.0
+    similarity[need] = unique_scores[codes]
+
+    f1 = np.fromiter(
+        (token_f1(p, t) for p, t in zip(pred, truth)), dtype=np.float64, count=len(pred)
+    )
+
+    result = pd.DataFrame({
+        "exact_match": exact,
+        "similarity": similarity,
+        "token_f1": f1,
+    })
+    # Quét nhiều ngưỡng cùng lúc bằng broadcast
+    thresholds = np.asarray(list(thresholds), dtype=np.float64)
+    correct = (similarity[:, None] >= thresholds[None, :]) & ~empty[:, None]
+    correct |= exact[:, None]
+    for j, t in enumerate(thresholds):
+        result[f"correct@{t:g}"] = correct[:, j]
+    return result
+
+
+def evaluate_answer(predicted, ground_truth, threshold=0.6):
+    """
+    Bản 1 dòng của score_batch (mode compat), dùng khi chấm ngay lúc chạy thí nghiệm.
+    Returns: (is_correct, similarity_score)
+    """
+    predicted_str = str(predicted).lower().strip()
+    ground_truth_str = str(ground_truth).lower().strip()
+    if not predicted_str or not ground_truth_str:
+        return False, 0.0
+    if predicted_str == ground_truth_str:
+        return True, 1.0
+    sim = sequence_ratio((predicted_str, ground_truth_str))
+    return sim >= threshold, sim
+
+
+def failed_rows(df):
+    """
+    Mask các dòng có lời gọi Baseline hoặc Self-Critique thất bại. Các dòng này không phải
+    câu trả lời sai nên không tính vào mẫu số accuracy. Log cũ chưa có cột *_failed
+    thì nhận diện qua câu trả lời bắt đầu bằng "[LỖI".
+    """
+    mask = pd.Series(False, index=df.index)
+    for col in FAILURE_COLUMNS:
+        if col in df:
+            mask |= df[col].fillna(False).astype(bool)
+    for col in ("baseline_answer", "critique_answer_final"):
+        if col in df:
+            mask |= df[col].astype(str).str.startswith(ERROR_PREFIX)
+    return mask
+
+
+def rescore_results(df, thresholds=(0.6,), mode="compat", n_jobs=None):
+    """
+    Chấm lại 1 file kết quả (cột baseline_answer, critique_answer_final, ground_truth).
+    Bỏ qua các dòng lỗi (xem failed_rows).
+    Returns: bảng accuracy (%) của Baseline và Self-Critique theo từng ngưỡng.
+    """
+    df = df[~failed_rows(df)]
+    rows = []
+    for method, col in [("baseline", "baseline_answer"), ("critique", "critique_answer_final")]:
+        scores = score_batch(df[col], df["ground_truth"], thresholds, mode=mode, n_jobs=n_jobs)
+        for t in thresholds:
+            rows.append({
+                "method": method,
+                "threshold": t,
+                "accuracy": scores[f"correct@{t:g}"].mean() * 100,
+                "avg_similarity": scores["similarity"].mean(),
+                "exact_match": scores["exact_match"].mean() * 100,
+                "token_f1": scores["token_f1"].mean(),
+            })
+    return pd.DataFrame(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chấm lại điểm các file results/* theo lô")
+    parser.add_argument("files", nargs="+", help="Các file kết quả (.parquet hoặc .csv)")
+    parser.add_argument("--thresholds", nargs="+", type=float, default=[0.6])
+    parser.add_argument("--mode", choices=SCORING_MODES, default="compat")
+    parser.add_argument("--jobs", type=int, default=None, help="Số process (mặc định = số CPU)")
+    args = parser.parse_args()
+
+    for path in args.files:
+        df = read_table(path, columns=RESULT_COLUMNS)
+        table = rescore_results(df, args.thresholds, mode=args.mode, n_jobs=args.jobs)
+        failed = int(failed_rows(df).sum())
+        print(f"\n📊 {path} ({len(df)} dòng, {failed} dòng lỗi bị loại, mode={args.mode})")
+        print(table.to_string(index=False, float_format=lambda x: f"{x:.4f}"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+Dừng sớm khi so sánh Baseline vs Self-Critique (kiểm định tuần tự trên cặp kết quả).
+
+Chỉ các cặp bất đồng (discordant) mang thông tin, như kiểm định McNemar:
+- b = số câu Baseline đúng, Self-Critique sai
+- c = số câu Self-Critique đúng, Baseline sai
+H0: P(c | bất đồng) = 0.5 (hai phương pháp tốt như nhau).
+
+Dùng mixture SPRT: likelihood ratio của p ~ Beta(prior, prior) so với p = 0.5,
+LR = B(c + prior, b + prior) / B(prior, prior) / 0.5^(b + c).
+Theo bất đẳng thức Ville, P(LR từng vượt 1/alpha | H0) <= alpha, nên được kiểm tra
+sau mỗi lô dòng (peeking) mà không làm tăng sai lầm loại I, và kiểm định 2 phía.
+
+Ngoài ra có thể dừng khi khoảng tin cậy (xấp xỉ chuẩn) của chênh lệch accuracy
+đã hẹp hơn ±precision, kể cả khi chưa có khác biệt.
+"""
+import math
+from statistics import NormalDist
+
+
+class SequentialComparison:
+    """
+    update(baseline_correct, critique_correct) cho từng dòng theo thứ tự đã xáo trộn,
+    check() sau mỗi check_every dòng: trả về lý do dừng hoặc None.
+    """
+
+    def __init__(self, alpha=0.05, precision=None, min_rows=100, check_every=50, prior=1.0):
+        self.alpha = alpha
+        self.precision = precision
+        self.min_rows = min_rows
+        self.check_every = max(1, int(check_every))
+        self.prior = prior
+        self.n = 0
+        self.b = 0
+        self.c = 0
+        self.baseline_correct = 0
+        self.critique_correct = 0
+        self.decision = None
+
+    def update(self, baseline_correct, critique_correct):
+        baseline_correct, critique_correct = bool(baseline_correct), bool(critique_correct)
+        self.n += 1
+        self.baseline_correct += baseline_correct
+        self.critique_correct += critique_correct
+        if baseline_correct and not critique_correct:
+            self.b += 1
+        elif critique_correct and not baseline_correct:
+            self.c += 1
+
+    def log_likelihood_ratio(self):
+        a, b, c = self.prior, self.b, self.c
+        log_beta = lambda x, y: math.lgamma(x) + math.lgamma(y) - math.lgamma(x + y)
+        return log_beta(c + a, b + a) - log_beta(a, a) + (b + c) * math.log(2)
+
+    def difference(self):
+        """Chênh lệch accuracy (critique - baseline) và nửa độ rộng khoảng tin cậy 1 - alpha"""
+        if self.n == 0:
+            return 0.0, float("inf")
+        diff = (self.c - self.b) / self.n
+        var = ((self.b + self.c) / self.n - diff ** 2) / self.n
+        z = NormalDist().inv_cdf(1 - self.alpha / 2)
+        return diff, z * math.sqrt(max(var, 0.0))
+
+    def due(self):
+        """Đã tới lúc kiểm tra (đủ min_rows và đúng chu kỳ check_every)"""
+        return self.n >= self.min_rows and self.n % self.check_every == 0
+
+    def check(self):
+        """
+        Returns: "critique_better" / "baseline_better" khi LR >= 1/alpha,
+        "precision" khi khoảng tin cậy đã hẹp hơn ±precision, ngược lại None.
+        """
+        if self.n < self.min_rows:
+            return None
+        if self.log_likelihood_ratio() >= math.log(1 / self.alpha):
+            self.decision = "critique_better" if self.c > self.b else "baseline_better"
+        elif self.precision and self.difference()[1] <= self.precision:
+            self.decision = "precision"
+        return self.decision
+
+    def summary(self):
+        diff, half_width = self.difference()
+        return {
+            "rows": self.n,
+            "baseline_only_correct": self.b,
+            "critique_only_correct": self.c,
+            "log_likelihood_ratio": self.log_likelihood_ratio(),
+            "threshold": math.log(1 / self.alpha),
+            "accuracy_difference": diff,
+            "ci_half_width": half_width,
+            "decision": self.decision,
+        }
+
+    def format_summary(self, total_rows=None, calls_saved=None):
+        s = self.summary()
+        reasons = {
+            "critique_better": "Self-Critique tốt hơn có ý nghĩa thống kê",
+            "baseline_better": "Baseline tốt hơn có ý nghĩa thống kê",
+            "precision": f"khoảng tin cậy đã hẹp hơn ±{self.precision:.3f}" if self.precision else "",
+            None: "chưa đạt mục tiêu, đã chạy hết dữ liệu",
+        }
+        lines = [
+            f"Dừng tuần tự: {reasons[s['decision']]}",
+            f"  - Dừng sau {s['rows']}" + (f"/{total_rows}" if total_rows else "") + " dòng "
+            f"(b={s['baseline_only_correct']}, c={s['critique_only_correct']})",
+            f"  - log LR = {s['log_likelihood_ratio']:.2f} (ngưỡng {s['threshold']:.2f}, alpha={self.alpha})",
+            f"  - Chênh lệch accuracy: {s['accuracy_difference'] * 100:+.2f}% ± {s['ci_half_width'] * 100:.2f}%",
+        ]
+        if calls_saved is not None:
+            lines.append(f"  - Tiết kiệm {calls_saved} lời gọi API")
+        return "\n".join(lines)
@@ -0,0 +1,179 @@
+"""
+Index chia shard theo nguồn dữ liệu (mỗi file benchmark_<nguồn> 1 shard, nguồn lớn có thể chia
+tiếp theo số dòng).
+
+Corpus và embeddings.npy vẫn là 1 bảng chung, các dòng cùng nguồn nằm liền nhau; mỗi shard là
+1 đoạn dòng [start, stop) với index riêng (data/index_v<N>/index_<kind>-<shard>.npz, vector đọc
+từ đoạn tương ứng của embeddings.npy memory-mapped). Danh sách shard lưu trong index_manifest.json.
+- Shard chỉ được nạp ở lần search đầu tiên cần tới nó
+- Các shard được search song song (thread pool), top-k của từng shard gộp lại bằng heap
+- search(..., sources=[...]) chỉ quét shard của các nguồn đó; source_of(id) cho biết nguồn của kết quả
+- Câu trùng giữa các nguồn có 1 dòng trong shard của mỗi nguồn (để lọc theo nguồn vẫn thấy);
+  canonical.npy (id dòng đại diện của cụm cho từng dòng) giúp search không trả về cùng 1 câu 2 lần
+"""
+import bisect
+import heapq
+import itertools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from vector_index import INDEX_CLASSES, ExactIndex, _stack, index_path, load_index
+
+TABLE_PREFIX = "benchmark_"
+CANONICAL_FILE = "canonical.npy"
+
+
+def source_name(path):
+    """data/benchmark_xquad_vi.parquet -> xquad_vi"""
+    name = Path(path).with_suffix("").name
+    return name[len(TABLE_PREFIX):] if name.startswith(TABLE_PREFIX) else name
+
+
+def shard_index_path(data_dir, kind, shard):
+    return Path(data_dir) / f"index_{kind}-{shard}.npz"
+
+
+def plan_shards(sources, shard_size=0):
+    """
+    sources: nguồn của từng dòng (các dòng cùng nguồn liền nhau).
+    shard_size > 0: chia tiếp mỗi nguồn thành các shard tối đa shard_size dòng.
+    Returns: list dict {name, source, start, stop}
+    """
+    shards = []
+    start = 0
+    for source, rows in itertools.groupby(sources):
+        n = sum(1 for _ in rows)
+        size = shard_size if shard_size > 0 else n
+        parts = range(0, n, size) if n else []
+        for part, offset in enumerate(parts):
+            shards.append({
+                "name": source if len(parts) == 1 else f"{source}-{part}",
+                "source": source,
+                "start": start + offset,
+                "stop": start + min(offset + size, n),
+            })
+        start += n
+    return shards
+
+
+class ShardedIndex:
+    """
+    Cùng giao diện VectorIndex (search trả về (scores, ids) với id toàn cục), thêm lọc theo nguồn.
+    data_dir: nơi đọc file index của từng shard (thiếu file thì shard đó quét exact).
+    indexes: index đã có sẵn theo tên shard (vd lúc build), không cần đọc file.
+    canonical: id dòng đại diện cho từng dòng (None = không có dòng trùng giữa các shard);
+    các dòng cùng đại diện chỉ xuất hiện 1 lần trong kết quả.
+    """
+
+    def __init__(self, emb, shards, kind="exact", params=None, data_dir=None, indexes=None, max_workers=None,
+                 canonical=None):
+        self.emb = emb
+        self.shards = [dict(s) for s in shards]
+        self.data_dir = data_dir
+        self._indexes = dict(indexes or {})
+        if data_dir is not None and any(
+            s["name"] not in self._indexes and not shard_index_path(data_dir, kind, s["name"]).exists()
+            for s in self.shards
+        ):
+            # Chưa build loại index này: quét exact như khi không có file index_<kind>.npz
+            kind, params = "exact", {}
+        self.kind = kind
+        self.knob = INDEX_CLASSES[kind].knob
+        self.params = dict(params or {})
+        self.canonical = canonical
+        self.max_workers = max_workers or max(1, min(len(self.shards), os.cpu_count() or 1))
+        self._starts = [s["start"] for s in self.shards]
+        self._lock = threading.Lock()
+        # Mỗi shard 1 lock: nạp lần đầu các shard khác nhau không phải chờ nhau
+        self._shard_locks = {s["name"]: threading.Lock() for s in self.shards}
+        self._pool = None
+
+    @property
+    def sources(self):
+        """Các nguồn theo thứ tự trong corpus"""
+        return list(dict.fromkeys(s["source"] for s in self.shards))
+
+    def source_of(self, i):
+        """Nguồn của dòng id toàn cục i"""
+        return self.shards[bisect.bisect_right(self._starts, int(i)) - 1]["source"]
+
+    def loaded(self):
+        return sorted(self._indexes.copy())
+
+    def _shard_index(self, shard):
+        index = self._indexes.get(shard["name"])
+        if index is not None:
+            return index
+        with self._shard_locks[shard["name"]]:
+            index = self._indexes.get(shard["name"])
+            if index is None:
+                emb = self.emb[shard["start"]:shard["stop"]]
+                path = shard_index_path(self.data_dir, self.kind, shard["name"]) if self.data_dir else None
+                index = load_index(path, emb) if path is not None and path.exists() else ExactIndex(emb)
+                self._indexes[shard["name"]] = index
+            return index
+
+    def _search_shard(self, shard, q_vecs, topk, knob_value):
+        scores, ids = self._shard_index(shard).search(q_vecs, topk, knob_value)
+        return scores, np.where(ids >= 0, ids + shard["start"], -1)
+
+    def search(self, q_vecs, topk, knob_value=None, sources=None):
+        q_vecs = np.atleast_2d(np.asarray(q_vecs, dtype=np.float32))
+        shards = [s for s in self.shards if sources is None or s["source"] in sources]
+        if len(shards) == 1:
+            parts = [self._search_shard(shards[0], q_vecs, topk, knob_value)]
+        else:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="shard")
+            parts = list(self._pool.map(lambda s: self._search_shard(s, q_vecs, topk, knob_value), shards))
+
+        all_scores, all_ids = [], []
+        for row in range(q_vecs.shape[0]):
+            # Kết quả mỗi shard đã giảm dần theo score: heap merge rồi lấy topk đầu tiên
+            merged = heapq.merge(
+                *[[(sc, i) for sc, i in zip(scores[row], ids[row]) if i >= 0] for scores, ids in parts],
+                key=lambda hit: -hit[0],
+            )
+            top = list(itertools.islice(self._unique(merged), topk))
+            all_scores.append([sc for sc, _ in top])
+            all_ids.append([i for _, i in top])
+        return _stack(all_scores, all_ids, topk)
+
+    def _unique(self, hits):
+        """
+        Bỏ các dòng trùng 1 dòng đứng trước (cùng đại diện). Mỗi shard không có 2 dòng cùng cụm nên
+        top-k của từng shard vẫn đủ cho top-k sau khi gộp.
+        """
+        if self.canonical is None:
+            yield from hits
+            return
+        seen = set()
+        for sc, i in hits:
+            group = int(self.canonical[i])
+            if group not in seen:
+                seen.add(group)
+                yield sc, i
+
+
+def load_sharded_index(data_dir, emb, kind, manifest=None):
+    """
+    Index của corpus theo index_manifest.json. Bản build cũ (1 file index_<kind>.npz cho cả corpus,
+    không có danh sách shard) được coi là 1 shard.
+    """
+    manifest = manifest or {}
+    if manifest.get("shards"):
+        params = manifest.get("index_params") if manifest.get("index") == kind else None
+        canonical_path = Path(data_dir) / CANONICAL_FILE
+        canonical = np.load(canonical_path) if canonical_path.exists() else None
+        return ShardedIndex(emb, manifest["shards"], kind, params, data_dir=data_dir, canonical=canonical)
+    path = index_path(data_dir, kind)
+    index = load_index(path, emb) if path.exists() else ExactIndex(emb)
+    datasets = manifest.get("datasets") or []
+    source = source_name(datasets[0]["path"]) if len(datasets) == 1 else "all"
+    shard = {"name": "all", "source": source, "start": 0, "stop": emb.shape[0]}
+    return ShardedIndex(emb, [shard], index.kind, index.params, indexes={"all": index})
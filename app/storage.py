@@ -0,0 +1,222 @@
+"""
+Định dạng lưu trữ dạng cột dùng chung cho benchmark, corpus của index và kết quả thí nghiệm.
+
+- Parquet nén zstd (pyarrow): đọc bằng memory map, chỉ giải nén các cột được yêu cầu
+  (read_table(path, columns=["question"]) không đụng tới cột text dài như critique_answer_full).
+- Không có pyarrow thì tự lùi về CSV (bảng) và JSON (corpus) như trước.
+- Vẫn xuất được CSV khi cần mở bằng Excel:
+
+    python app/storage.py export results/results_viquad_v2.parquet
+    python app/storage.py convert data/benchmark_*.csv results/results_*.csv
+"""
+import argparse
+import csv
+import json
+import os
+from pathlib import Path
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    HAS_ARROW = True
+except ImportError:  # pyarrow là tuỳ chọn
+    pa = pq = None
+    HAS_ARROW = False
+
+TABLE_SUFFIX = ".parquet" if HAS_ARROW else ".csv"
+TABLE_SUFFIXES = (".parquet", ".csv")
+COMPRESSION = "zstd"
+ROW_GROUP_ROWS = 8192
+
+CORPUS_FILE = "corpus.parquet"
+CORPUS_JSON_FILES = ("questions.json", "answers.json")
+
+
+def table_path(stem):
+    """Đường dẫn file bảng theo định dạng mặc định, vd data/benchmark_x -> data/benchmark_x.parquet"""
+    stem = Path(stem)
+    if stem.suffix in TABLE_SUFFIXES:
+        stem = stem.with_suffix("")
+    return stem.with_name(stem.name + TABLE_SUFFIX)
+
+
+def resolve_table(path):
+    """
+    Tìm file bảng: đúng đường dẫn nếu tồn tại, nếu không thì thử .parquet rồi .csv cùng tên.
+    Nhờ vậy benchmark CSV cũ vẫn đọc được khi chưa chuyển sang Parquet.
+    """
+    path = Path(path)
+    if path.exists():
+        return path
+    stem = path.with_suffix("") if path.suffix in TABLE_SUFFIXES else path
+    suffixes = TABLE_SUFFIXES if HAS_ARROW else (".csv",)
+    for suffix in suffixes:
+        candidate = stem.with_name(stem.name + suffix)
+        if candidate.exists():
+            return candidate
+    raise FileNotFoundError(f"Không tìm thấy bảng {path} (.parquet/.csv)")
+
+
+def find_tables(directory, pattern):
+    """Các bảng khớp pattern (không có đuôi), mỗi tên chỉ lấy 1 file, ưu tiên Parquet"""
+    suffixes = TABLE_SUFFIXES if HAS_ARROW else (".csv",)
+    found = {}
+    for suffix in reversed(suffixes):
+        for path in Path(directory).glob(pattern + suffix):
+            found[path.with_suffix("").name] = path
+    return [found[name] for name in sorted(found)]
+
+
+def read_table(path, columns=None):
+    """
+    Đọc bảng thành DataFrame. columns: chỉ đọc các cột này (Parquet chỉ giải nén
+    đúng các cột đó, CSV vẫn phải quét cả file nhưng không giữ cột thừa).
+    """
+    path = resolve_table(path)
+    if path.suffix == ".parquet":
+        if not HAS_ARROW:
+            raise ImportError(f"Cần cài pyarrow để đọc {path}")
+        return pq.read_table(path, columns=columns, memory_map=True).to_pandas()
+    return pd.read_csv(path, usecols=columns, encoding="utf-8-sig")
+
+
+def _replace(tmp_path, path):
+    with open(tmp_path, "rb") as f:
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class TableWriter:
+    """
+    Ghi bảng theo từng chunk (mỗi chunk là 1 row group Parquet), không giữ cả bảng trong RAM.
+    File được ghi vào .tmp rồi đổi tên khi close() nên không bao giờ thấy file dở dang.
+    """
+
+    def __init__(self, path, columns):
+        self.path = Path(path)
+        self.columns = list(columns)
+        self.rows = 0
+        self._tmp = self.path.with_name(self.path.name + ".tmp")
+        self._parquet = self.path.suffix == ".parquet"
+        if self._parquet:
+            schema = pa.schema([(c, pa.string()) for c in self.columns])
+            self._writer = pq.ParquetWriter(self._tmp, schema, compression=COMPRESSION)
+        else:
+            self._file = open(self._tmp, "w", encoding="utf-8-sig", newline="")
+            self._writer = csv.writer(self._file, lineterminator="\n")
+            self._writer.writerow(self.columns)
+
+    def write_rows(self, rows):
+        """rows: list tuple theo thứ tự columns"""
+        if not rows:
+            return
+        if self._parquet:
+            arrays = [pa.array(list(col), pa.string()) for col in zip(*rows)]
+            self._writer.write_table(pa.Table.from_arrays(arrays, names=self.columns))
+        else:
+            self._writer.writerows(rows)
+        self.rows += len(rows)
+
+    def close(self, keep=True):
+        if self._parquet:
+            self._writer.close()
+        else:
+            self._file.close()
+        if keep:
+            _replace(self._tmp, self.path)
+        else:
+            self._tmp.unlink(missing_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close(keep=exc_type is None)
+        return False
+
+
+def write_table(df, path):
+    """Ghi cả DataFrame (atomic). Định dạng theo đuôi file: .parquet (zstd) hoặc .csv (UTF-8 BOM)"""
+    path = Path(path)
+    tmp_path = path.with_name(path.name + ".tmp")
+    if path.suffix == ".parquet":
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        pq.write_table(table, tmp_path, compression=COMPRESSION, row_group_size=ROW_GROUP_ROWS)
+    else:
+        df.to_csv(tmp_path, index=False, encoding="utf-8-sig")
+    _replace(tmp_path, path)
+    return path
+
+
+def export_csv(path, out_path=None):
+    """Xuất 1 bảng (thường là .parquet) ra CSV UTF-8 BOM cạnh file gốc"""
+    path = resolve_table(path)
+    out_path = Path(out_path) if out_path else path.with_suffix(".csv")
+    read_table(path).to_csv(out_path, index=False, encoding="utf-8-sig")
+    return out_path
+
+
+# --- Corpus của index (câu hỏi + đáp án, cùng thứ tự với embeddings.npy) ---
+
+def corpus_files(data_dir):
+    """Mọi file corpus có thể có (dùng để theo dõi thay đổi trên đĩa)"""
+    data_dir = Path(data_dir)
+    return [data_dir / CORPUS_FILE] + [data_dir / name for name in CORPUS_JSON_FILES]
+
+
+def write_corpus(data_dir, questions, answers):
+    """
+    Ghi corpus vào data_dir: corpus.parquet nếu có pyarrow, ngược lại questions.json + answers.json.
+    Returns: list tên file đã ghi.
+    """
+    data_dir = Path(data_dir)
+    if HAS_ARROW:
+        table = pa.table({
+            "question": pa.array(questions, pa.string()),
+            "answer": pa.array(answers, pa.string()),
+        })
+        pq.write_table(table, data_dir / CORPUS_FILE, compression=COMPRESSION, row_group_size=ROW_GROUP_ROWS)
+        return [CORPUS_FILE]
+    for name, values in zip(CORPUS_JSON_FILES, (questions, answers)):
+        (data_dir / name).write_text(json.dumps(values, ensure_ascii=False, indent=2), encoding="utf-8")
+    return list(CORPUS_JSON_FILES)
+
+
+def read_corpus(data_dir, columns=("question", "answer")):
+    """
+    Returns: tuple list theo columns, vd (questions, answers).
+    Đọc corpus.parquet nếu có, nếu không thì questions.json/answers.json của phiên bản cũ.
+    """
+    data_dir = Path(data_dir)
+    if HAS_ARROW and (data_dir / CORPUS_FILE).exists():
+        table = pq.read_table(data_dir / CORPUS_FILE, columns=list(columns), memory_map=True)
+        return tuple(table.column(c).to_pylist() for c in columns)
+    json_files = dict(zip(("question", "answer"), CORPUS_JSON_FILES))
+    paths = [data_dir / json_files[c] for c in columns]
+    if not all(p.exists() for p in paths):
+        raise FileNotFoundError(f"Không tìm thấy corpus trong {data_dir} ({CORPUS_FILE} hoặc *.json)")
+    return tuple(json.loads(p.read_text(encoding="utf-8")) for p in paths)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chuyển đổi giữa CSV và Parquet")
+    parser.add_argument("command", choices=["convert", "export"],
+                        help="convert: CSV -> Parquet, export: Parquet -> CSV")
+    parser.add_argument("files", nargs="+")
+    args = parser.parse_args()
+
+    if not HAS_ARROW:
+        raise SystemExit("❌ Cần cài pyarrow (pip install pyarrow)")
+    for path in map(Path, args.files):
+        if args.command == "export":
+            print(f"📤 {path} -> {export_csv(path)}")
+            continue
+        df = read_table(path)
+        out_path = write_table(df, path.with_suffix(".parquet"))
+        print(f"📦 {path} ({path.stat().st_size / 1e3:.0f} KB) -> {out_path} ({out_path.stat().st_size / 1e3:.0f} KB)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,433 @@
+"""
+Index tìm top-k theo cosine (embedding đã chuẩn hoá nên cosine = tích vô hướng).
+
+Các backend:
+- exact: quét toàn bộ nhưng chỉ lấy top-k bằng argpartition (không sort cả vector score)
+- ivf:   phân cụm k-means, chỉ quét `nprobe` cụm gần query nhất
+- graph: đồ thị k láng giềng gần nhất, tìm kiếm tham lam với beam rộng `ef`
+- float16 / int8 / binary: lượt 1 quét vector nén (ít RAM), lượt 2 tính lại score
+  chính xác (float32, đọc từ embeddings.npy memory-mapped) cho shortlist topk*rescore
+
+Mỗi index được lưu thành index_<kind>.npz cạnh embeddings.npy (index chia shard: mỗi shard
+1 file index_<kind>-<shard>.npz trong thư mục phiên bản data/index_v<N>/, xem sharded_index.py),
+vector gốc không lưu lại mà đọc từ embeddings.npy khi load.
+"""
+import heapq
+import json
+from pathlib import Path
+
+import numpy as np
+
+INDEX_KINDS = ("exact", "ivf", "graph", "float16", "int8", "binary")
+
+
+def index_path(data_dir, kind):
+    return Path(data_dir) / f"index_{kind}.npz"
+
+
+def topk_rows(scores, topk):
+    """
+    Top-k theo từng hàng của ma trận scores (nq, n) bằng argpartition.
+    Returns: (scores, ids) đều có shape (nq, k), sắp xếp giảm dần.
+    """
+    scores = np.atleast_2d(scores)
+    k = min(topk, scores.shape[1])
+    if k <= 0:
+        empty = np.empty((scores.shape[0], 0))
+        return empty, empty.astype(np.int64)
+    if k < scores.shape[1]:
+        part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        part = np.tile(np.arange(scores.shape[1]), (scores.shape[0], 1))
+    part_scores = np.take_along_axis(scores, part, axis=1)
+    order = np.argsort(-part_scores, axis=1)
+    return np.take_along_axis(part_scores, order, axis=1), np.take_along_axis(part, order, axis=1)
+
+
+class VectorIndex:
+    """Lớp cơ sở: build(emb) -> search(q_vecs, topk) -> save(path) / load(path, emb)"""
+
+    kind = None
+    # Tên tham số đánh đổi recall/độ trễ khi search (None nếu không có)
+    knob = None
+
+    def __init__(self, emb, **params):
+        self.emb = emb
+        self.params = params
+
+    @classmethod
+    def build(cls, emb, **params):
+        return cls(emb, **params)
+
+    def search(self, q_vecs, topk, knob_value=None):
+        raise NotImplementedError
+
+    def _arrays(self):
+        return {}
+
+    def save(self, path):
+        path = Path(path)
+        tmp = path.with_name(path.stem + ".tmp.npz")
+        np.savez(tmp, kind=self.kind, params=json.dumps(self.params), **self._arrays())
+        tmp.replace(path)
+
+    @classmethod
+    def _from_arrays(cls, emb, params, arrays):
+        return cls(emb, **params)
+
+
+class ExactIndex(VectorIndex):
+    """Quét toàn bộ, chính xác 100%"""
+
+    kind = "exact"
+
+    def search(self, q_vecs, topk, knob_value=None):
+        q_vecs = np.atleast_2d(np.asarray(q_vecs, dtype=np.float32))
+        return topk_rows(q_vecs @ self.emb.T, topk)
+
+
+def spherical_kmeans(x, nlist, n_iter=20, sample_size=None, seed=0):
+    """K-means trên mặt cầu đơn vị (gán cụm theo cosine), trả về centroids đã chuẩn hoá"""
+    rng = np.random.default_rng(seed)
+    n = x.shape[0]
+    sample_size = min(n, sample_size or 256 * nlist)
+    sample = x[rng.choice(n, size=sample_size, replace=False)]
+    centroids = sample[rng.choice(sample_size, size=nlist, replace=False)].copy()
+    for _ in range(n_iter):
+        assign = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, sample)
+        empty = np.linalg.norm(sums, axis=1) == 0
+        # Cụm rỗng: lấy lại 1 điểm ngẫu nhiên làm tâm
+        sums[empty] = sample[rng.choice(sample_size, size=int(empty.sum()))]
+        centroids = sums / np.linalg.norm(sums, axis=1, keepdims=True)
+    return centroids.astype(np.float32)
+
+
+def assign_clusters(x, centroids, batch_size=65536):
+    return np.concatenate([
+        np.argmax(x[i:i + batch_size] @ centroids.T, axis=1)
+        for i in range(0, x.shape[0], batch_size)
+    ]) if x.shape[0] else np.empty(0, dtype=np.int64)
+
+
+class IVFIndex(VectorIndex):
+    """Inverted file: chỉ quét các cụm gần nhất. nprobe lớn hơn -> recall cao hơn, chậm hơn"""
+
+    kind = "ivf"
+    knob = "nprobe"
+
+    def __init__(self, emb, centroids, order, offsets, nprobe=8, **params):
+        super().__init__(emb, nprobe=nprobe, **params)
+        self.centroids = centroids
+        self.order = order
+        self.offsets = offsets
+
+    @classmethod
+    def build(cls, emb, nlist=None, nprobe=8, n_iter=20, **params):
+        n = emb.shape[0]
+        nlist = nlist or max(1, int(4 * np.sqrt(n)))
+        nlist = min(nlist, n)
+        centroids = spherical_kmeans(emb, nlist, n_iter=n_iter)
+        assign = assign_clusters(emb, centroids)
+        order = np.argsort(assign, kind="stable").astype(np.int64)
+        offsets = np.searchsorted(assign[order], np.arange(nlist + 1)).astype(np.int64)
+        return cls(emb, centroids, order, offsets, nprobe=nprobe, nlist=nlist, **params)
+
+    def candidates(self, q_vec, nprobe):
+        probe = topk_rows(q_vec @ self.centroids.T, nprobe)[1][0]
+        return np.concatenate([self.order[self.offsets[c]:self.offsets[c + 1]] for c in probe])
+
+    def search(self, q_vecs, topk, knob_value=None):
+        nprobe = int(knob_value or self.params["nprobe"])
+        q_vecs = np.atleast_2d(np.asarray(q_vecs, dtype=np.float32))
+        all_scores, all_ids = [], []
+        for q in q_vecs:
+            cand = self.candidates(q, nprobe)
+            scores, pos = topk_rows(self.emb[cand] @ q, topk)
+            all_scores.append(scores[0])
+            all_ids.append(cand[pos[0]])
+        return _stack(all_scores, all_ids, topk)
+
+    def _arrays(self):
+        return {"centroids": self.centroids, "order": self.order, "offsets": self.offsets}
+
+    @classmethod
+    def _from_arrays(cls, emb, params, arrays):
+        return cls(emb, arrays["centroids"], arrays["order"], arrays["offsets"], **params)
+
+
+class GraphIndex(VectorIndex):
+    """
+    Đồ thị k-NN xấp xỉ (láng giềng tìm trong các cụm IVF gần nhau, nên build không tốn O(N^2)).
+    Search: beam search tham lam từ tâm các cụm gần query. ef lớn hơn -> recall cao hơn, chậm hơn.
+    """
+
+    kind = "graph"
+    knob = "ef"
+
+    def __init__(self, emb, neighbors, entry_points, entry_vectors, ef=64, **params):
+        super().__init__(emb, ef=ef, **params)
+        self.neighbors = neighbors
+        self.entry_points = entry_points
+        self.entry_vectors = entry_vectors
+
+    @classmethod
+    def build(cls, emb, degree=16, build_probe=4, ef=64, n_entry=4, **params):
+        ivf = IVFIndex.build(emb, nprobe=build_probe)
+        n = emb.shape[0]
+        degree = min(degree, max(n - 1, 1))
+        neighbors = np.zeros((n, degree), dtype=np.int32)
+        centroid_sims = ivf.centroids @ ivf.centroids.T
+        nlist = ivf.centroids.shape[0]
+        entry_points = np.zeros(nlist, dtype=np.int64)
+        for c in range(nlist):
+            members = ivf.order[ivf.offsets[c]:ivf.offsets[c + 1]]
+            if len(members) == 0:
+                continue
+            near = topk_rows(centroid_sims[c], build_probe)[1][0]
+            pool = np.concatenate([ivf.order[ivf.offsets[p]:ivf.offsets[p + 1]] for p in near])
+            sims = emb[members] @ emb[pool].T
+            sims[pool[None, :] == members[:, None]] = -np.inf  # bỏ chính nó
+            _, pos = topk_rows(sims, degree)
+            found = pool[pos]
+            if found.shape[1] < degree:  # cụm quá nhỏ: lặp lại láng giềng để đủ số cột
+                found = np.pad(found, ((0, 0), (0, degree - found.shape[1])), mode="edge")
+            neighbors[members] = found
+            entry_points[c] = members[np.argmax(emb[members] @ ivf.centroids[c])]
+        return cls(
+            emb, neighbors, entry_points, ivf.centroids,
+            ef=ef, degree=degree, n_entry=min(n_entry, nlist), **params,
+        )
+
+    def _search_one(self, q, topk, ef):
+        entry_ids = self.entry_points[topk_rows(q @ self.entry_vectors.T, self.params["n_entry"])[1][0]]
+        entry_ids = np.unique(entry_ids)
+        visited = set(entry_ids.tolist())
+        entry_scores = self.emb[entry_ids] @ q
+        frontier = [(-float(s), int(i)) for s, i in zip(entry_scores, entry_ids)]
+        heapq.heapify(frontier)
+        best = [(float(s), int(i)) for s, i in zip(entry_scores, entry_ids)]  # min-heap, giữ ef phần tử
+        heapq.heapify(best)
+        while len(best) > ef:
+            heapq.heappop(best)
+
+        while frontier:
+            neg_score, node = heapq.heappop(frontier)
+            if len(best) >= ef and -neg_score < best[0][0]:
+                break
+            new = [n for n in self.neighbors[node].tolist() if n not in visited]
+            if not new:
+                continue
+            visited.update(new)
+            scores = self.emb[new] @ q
+            for s, n in zip(scores.tolist(), new):
+                if len(best) < ef or s > best[0][0]:
+                    heapq.heappush(frontier, (-s, n))
+                    heapq.heappush(best, (s, n))
+                    if len(best) > ef:
+                        heapq.heappop(best)
+
+        top = heapq.nlargest(topk, best)
+        return np.array([s for s, _ in top]), np.array([i for _, i in top], dtype=np.int64)
+
+    def search(self, q_vecs, topk, knob_value=None):
+        ef = max(int(knob_value or self.params["ef"]), topk)
+        q_vecs = np.atleast_2d(np.asarray(q_vecs, dtype=np.float32))
+        results = [self._search_one(q, topk, ef) for q in q_vecs]
+        return _stack([s for s, _ in results], [i for _, i in results], topk)
+
+    def _arrays(self):
+        return {
+            "neighbors": self.neighbors,
+            "entry_points": self.entry_points,
+            "entry_vectors": self.entry_vectors,
+        }
+
+    @classmethod
+    def _from_arrays(cls, emb, params, arrays):
+        return cls(emb, arrays["neighbors"], arrays["entry_points"], arrays["entry_vectors"], **params)
+
+
+def _stack(all_scores, all_ids, topk):
+    """Gộp kết quả từng query thành mảng (nq, k); thiếu kết quả thì điền score -inf, id -1"""
+    k = max([len(s) for s in all_scores] + [0])
+    k = min(k, topk)
+    scores = np.full((len(all_scores), k), -np.inf)
+    ids = np.full((len(all_ids), k), -1, dtype=np.int64)
+    for row, (s, i) in enumerate(zip(all_scores, all_ids)):
+        scores[row, :len(s[:k])] = s[:k]
+        ids[row, :len(i[:k])] = i[:k]
+    return scores, ids
+
+
+# Số bit 1 của từng giá trị uint8, dùng tính khoảng cách Hamming
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint16)
+
+
+class QuantizedIndex(VectorIndex):
+    """
+    Lượt 1: score xấp xỉ trên vector nén. Lượt 2: lấy shortlist topk*rescore
+    rồi tính lại cosine chính xác bằng vector float32. rescore=0 -> bỏ lượt 2.
+    """
+
+    knob = "rescore"
+    block_size = 65536
+
+    def __init__(self, emb, codes, scale=None, rescore=4, **params):
+        super().__init__(emb, rescore=rescore, **params)
+        self.codes = codes
+        self.scale = scale
+
+    @classmethod
+    def quantize(cls, emb):
+        raise NotImplementedError
+
+    @classmethod
+    def build(cls, emb, rescore=4, **params):
+        codes, scale = cls.quantize(np.asarray(emb, dtype=np.float32))
+        return cls(emb, codes, scale, rescore=rescore, **params)
+
+    def _block_scores(self, q_vecs, block):
+        raise NotImplementedError
+
+    def approx_scores(self, q_vecs):
+        n = self.codes.shape[0]
+        return np.concatenate([
+            self._block_scores(q_vecs, slice(i, i + self.block_size))
+            for i in range(0, n, self.block_size)
+        ], axis=1) if n else np.empty((q_vecs.shape[0], 0), dtype=np.float32)
+
+    def search(self, q_vecs, topk, knob_value=None):
+        factor = int(self.params["rescore"] if knob_value is None else knob_value)
+        q_vecs = np.atleast_2d(np.asarray(q_vecs, dtype=np.float32))
+        approx = self.approx_scores(q_vecs)
+        if factor <= 0:
+            return topk_rows(approx, topk)
+        _, shortlist = topk_rows(approx, topk * factor)
+        all_scores, all_ids = [], []
+        for q, cand in zip(q_vecs, shortlist):
+            cand = np.sort(cand)  # đọc mmap theo thứ tự tăng dần
+            scores, pos = topk_rows(np.asarray(self.emb[cand]) @ q, topk)
+            all_scores.append(scores[0])
+            all_ids.append(cand[pos[0]])
+        return _stack(all_scores, all_ids, topk)
+
+    def memory_bytes(self):
+        return self.codes.nbytes + (self.scale.nbytes if self.scale is not None else 0)
+
+    def _arrays(self):
+        arrays = {"codes": self.codes}
+        if self.scale is not None:
+            arrays["scale"] = self.scale
+        return arrays
+
+    @classmethod
+    def _from_arrays(cls, emb, params, arrays):
+        return cls(emb, arrays["codes"], arrays.get("scale"), **params)
+
+
+class Float16Index(QuantizedIndex):
+    """float16: 1/2 bộ nhớ, gần như không mất recall"""
+
+    kind = "float16"
+
+    @classmethod
+    def quantize(cls, emb):
+        return emb.astype(np.float16), None
+
+    def _block_scores(self, q_vecs, block):
+        return q_vecs @ self.codes[block].astype(np.float32).T
+
+
+class Int8Index(QuantizedIndex):
+    """int8 với scale riêng cho từng chiều: 1/4 bộ nhớ"""
+
+    kind = "int8"
+
+    @classmethod
+    def quantize(cls, emb):
+        scale = np.abs(emb).max(axis=0) / 127.0
+        scale[scale == 0] = 1.0
+        codes = np.clip(np.rint(emb / scale), -127, 127).astype(np.int8)
+        return codes, scale.astype(np.float32)
+
+    def _block_scores(self, q_vecs, block):
+        # q·(codes*scale) = (q*scale)·codes
+        return (q_vecs * self.scale) @ self.codes[block].astype(np.float32).T
+
+
+class BinaryIndex(QuantizedIndex):
+    """Chỉ giữ dấu của từng chiều (1 bit): 1/32 bộ nhớ, xếp hạng theo khoảng cách Hamming"""
+
+    kind = "binary"
+
+    @classmethod
+    def quantize(cls, emb):
+        return np.packbits(emb > 0, axis=1), None
+
+    def _block_scores(self, q_vecs, block):
+        q_bits = np.packbits(q_vecs > 0, axis=1)
+        codes = self.codes[block]
+        n_bits = self.emb.shape[1]
+        scores = np.empty((q_vecs.shape[0], codes.shape[0]), dtype=np.float32)
+        for row, q in enumerate(q_bits):
+            hamming = _POPCOUNT[np.bitwise_xor(codes, q)].sum(axis=1)
+            scores[row] = n_bits - 2.0 * hamming
+        return scores
+
+
+INDEX_CLASSES = {
+    cls.kind: cls
+    for cls in (ExactIndex, IVFIndex, GraphIndex, Float16Index, Int8Index, BinaryIndex)
+}
+
+
+def build_index(kind, emb, **params):
+    if kind not in INDEX_CLASSES:
+        raise ValueError(f"Loại index không hợp lệ: {kind} (chọn {INDEX_KINDS})")
+    return INDEX_CLASSES[kind].build(emb, **params)
+
+
+def load_index(path, emb):
+    """Đọc index đã lưu; vector gốc lấy từ `emb` (thường là embeddings.npy)"""
+    with np.load(path, allow_pickle=False) as data:
+        kind = str(data["kind"])
+        params = json.loads(str(data["params"]))
+        arrays = {k: data[k] for k in data.files if k not in ("kind", "params")}
+    return INDEX_CLASSES[kind]._from_arrays(emb, params, arrays)
+
+
+def recall_at_k(index, emb, topk=10, n_queries=200, knob_value=None, seed=0):
+    """Recall@k của index so với tìm kiếm chính xác, query lấy ngẫu nhiên từ chính các vector"""
+    rng = np.random.default_rng(seed)
+    queries = emb[rng.choice(emb.shape[0], size=min(n_queries, emb.shape[0]), replace=False)]
+    _, exact_ids = ExactIndex(emb).search(queries, topk)
+    _, ids = index.search(queries, topk, knob_value)
+    hits = sum(len(set(a.tolist()) & set(b.tolist())) for a, b in zip(exact_ids, ids))
+    return hits / exact_ids.size
+
+
+def quantization_report(emb, topk=10, rescore=4, n_queries=200):
+    """
+    So sánh bộ nhớ và recall@k của các kiểu nén (có/không tính lại score float32).
+    Returns: list dict, mỗi dict 1 kiểu nén.
+    """
+    emb = np.asarray(emb, dtype=np.float32)
+    rows = [{
+        "kind": "float32",
+        "memory_mb": emb.nbytes / 1024 / 1024,
+        "compression": 1.0,
+        "recall_first_pass": 1.0,
+        "recall_rescored": 1.0,
+    }]
+    for kind in ("float16", "int8", "binary"):
+        index = build_index(kind, emb, rescore=rescore)
+        rows.append({
+            "kind": kind,
+            "memory_mb": index.memory_bytes() / 1024 / 1024,
+            "compression": emb.nbytes / index.memory_bytes(),
+            "recall_first_pass": recall_at_k(index, emb, topk, n_queries, knob_value=0),
+            "recall_rescored": recall_at_k(index, emb, topk, n_queries, knob_value=rescore),
+        })
+    return rows